@@ -1,18 +1,65 @@
 #!/usr/bin/env python
 # vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+import sys
 
 #  Must comply with http://legacy.python.org/dev/peps/pep-0440/#version-scheme
 __version__ = "0.5.0"
 
-from . import prompt
-from . import functions
-from . import functionBase
-from . import functionContainer
-from . import colours
-from . import compiler
-from . import parser
-from . import lexer
-from . import userdir
-from . import config
-from . import git
-from . import svn
+# Submodules are imported on first attribute access, so that a prompt
+# only pays for the modules it actually uses (e.g. a prompt outside of
+# a repository never loads the svn XML parser).
+__all__ = [
+    "prompt",
+    "functions",
+    "functionBase",
+    "functionContainer",
+    "colours",
+    "compiler",
+    "optimiser",
+    "parser",
+    "lexer",
+    "userdir",
+    "config",
+    "status",
+    "vcs",
+    "git",
+    "gitdir",
+    "svn",
+    "daemon",
+    "cache",
+    "timing",
+    "inotify",
+]
+
+if sys.version_info >= (3, 7):
+    import importlib
+
+    def __getattr__(name):
+        if name in __all__:
+            return importlib.import_module("." + name, __name__)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__))
+else:
+    # No module level __getattr__ (PEP 562), so import everything up front
+    from . import prompt
+    from . import functions
+    from . import functionBase
+    from . import functionContainer
+    from . import colours
+    from . import compiler
+    from . import optimiser
+    from . import parser
+    from . import lexer
+    from . import userdir
+    from . import config
+    from . import status
+    from . import vcs
+    from . import git
+    from . import gitdir
+    from . import svn
+    from . import daemon
+    from . import cache
+    from . import timing
+    from . import inotify
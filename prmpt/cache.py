@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Import external modules
+import os
+import sys
+import time
+import zlib
+import marshal
+
+# Import prmpt modules
+import prmpt
+from prmpt import parser
+
+
+def _atomicWrite(filename, data):
+    """
+    Write ``data`` to ``filename`` such that readers see either the old
+    or the new contents, never a partial file.
+    """
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmpFile = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmpFile, "wb") as f:
+        f.write(data)
+    os.rename(tmpFile, filename)
+
+
+class ParseCache(object):
+    """
+    An on-disk cache of parsed prompt files, so that unchanged prompts
+    do not need to be lexed and parsed on every render.
+
+    Entries are keyed on the prompt file's path, modification time and
+    size, together with the prmpt and Python versions and the format of
+    the stored nodes (see :func:`prmpt.parser.dump`). An entry whose
+    key does not match, or which cannot be read back, is treated as a
+    miss and rebuilt by the caller.
+    """
+    PREFIX = "parse-"
+    # Bump when the serialised node format changes
+    FORMAT = 2
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    @staticmethod
+    def makeKey(promptFile, mtime, size):
+        return (prmpt.__version__, sys.hexversion, ParseCache.FORMAT, promptFile, mtime, size)
+
+    def _filename(self, key):
+        promptFile = key[3]
+        return os.path.join(
+            self.cacheDir,
+            "%s%08x" % (self.PREFIX, zlib.crc32(promptFile.encode('utf-8')) & 0xffffffff)
+        )
+
+    def load(self, key):
+        """
+        Get the list of nodes stored for ``key``, or ``None``.
+        """
+        try:
+            with open(self._filename(key), "rb") as f:
+                storedKey, data = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # Missing or corrupt
+            return None
+
+        if storedKey != key or not isinstance(data, list):
+            # Stale
+            return None
+        try:
+            return parser.load(data)
+        except (ValueError, TypeError):
+            # Corrupt
+            return None
+
+    def store(self, key, nodes):
+        try:
+            _atomicWrite(self._filename(key), marshal.dumps((key, parser.dump(nodes))))
+        except (IOError, OSError, ValueError):
+            # The cache is only an optimisation
+            pass
+
+
+class VCSCache(object):
+    """
+    An on-disk cache of version control status, so that a prompt can
+    reuse the results of a previous prompt (possibly in another
+    terminal) in the same repository instead of running the VCS again.
+
+    There is one entry per repository root. Each is keyed on a
+    fingerprint of the repository (see :meth:`prmpt.vcs.VCSBase.fingerprint`),
+    and expires after ``maxAge`` seconds, as some changes (e.g. editing
+    a file deep in the tree) do not alter the fingerprint. Only the
+    ``maxEntries`` most recently stored entries are kept.
+    """
+    PREFIX = "vcs-"
+    # Bump when the stored attributes change
+    FORMAT = 1
+
+    def __init__(self, cacheDir, maxAge=30, maxEntries=64):
+        self.cacheDir = cacheDir
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+
+    @staticmethod
+    def makeKey(root, fingerprint):
+        return (prmpt.__version__, sys.hexversion, VCSCache.FORMAT, root, fingerprint)
+
+    def _filename(self, key):
+        root = key[3]
+        return os.path.join(
+            self.cacheDir,
+            "%s%08x" % (self.PREFIX, zlib.crc32(root.encode('utf-8')) & 0xffffffff)
+        )
+
+    def load(self, key, stale=False):
+        """
+        Get the dictionary of attributes stored for ``key``, or
+        ``None``. If ``stale`` is ``True``, whatever was last stored
+        for the same repository is returned, however old.
+        """
+        try:
+            with open(self._filename(key), "rb") as f:
+                storedKey, stored, data = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # Missing or corrupt
+            return None
+
+        if not isinstance(data, dict) or not isinstance(storedKey, tuple):
+            # Corrupt
+            return None
+        if stale:
+            # Only the versions and the root have to match
+            return data if storedKey[:4] == key[:4] else None
+        if storedKey != key:
+            # Stale
+            return None
+        if not 0 <= time.time() - stored < self.maxAge:
+            # Expired
+            return None
+        return data
+
+    def store(self, key, data):
+        try:
+            _atomicWrite(self._filename(key), marshal.dumps((key, time.time(), data)))
+            self._prune()
+        except (IOError, OSError, ValueError):
+            # The cache is only an optimisation
+            pass
+
+    def _prune(self):
+        """
+        Remove the least recently stored entries, leaving
+        ``maxEntries``.
+        """
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            # Skip temporary files and any kept alongside an entry
+            if name.startswith(self.PREFIX) and "." not in name:
+                filename = os.path.join(self.cacheDir, name)
+                try:
+                    entries.append((os.path.getmtime(filename), filename))
+                except OSError:
+                    # Removed by another prompt
+                    pass
+        entries.sort()
+        for _, filename in entries[:max(0, len(entries) - self.maxEntries)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+class RepoStats(VCSCache):
+    """
+    Details of each repository that are kept between prompts whether or
+    not the repository changes, such as how long its status took to
+    read. Only the ``maxEntries`` most recently stored are kept.
+    """
+    PREFIX = "repo-"
+
+    def __init__(self, cacheDir, maxEntries=64):
+        super(RepoStats, self).__init__(cacheDir, float("inf"), maxEntries)
+
+    def filename(self, root):
+        """
+        The path of the entry for ``root``. Other files for the
+        repository can be kept alongside, with a suffix added.
+        """
+        return self._filename(self.makeKey(root, None))
+
+    def get(self, root):
+        """
+        Get the dictionary stored for ``root`` (empty if there is none).
+        """
+        return self.load(self.makeKey(root, None)) or {}
+
+    def set(self, root, data):
+        self.store(self.makeKey(root, None), data)
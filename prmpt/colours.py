@@ -15,6 +15,8 @@ from prmpt import functionBase
 
 
 class Colours(functionBase.PrmptFunctions):
+    PURE = True
+
     NAME_KEY = 0
     CODE_KEY = 1
     VAL_KEY = 2
@@ -77,6 +79,19 @@ class Colours(functionBase.PrmptFunctions):
         self._populateFunctions()
         super(Colours, self).__init__(container)
 
+    @classmethod
+    def _setShell(cls, shell):
+        """
+        Select the non-printing character delimiters for the given
+        shell dialect (e.g. ``bash`` or ``zsh``).
+        """
+        if shell == "zsh":
+            cls.NOCOUNT_START = cls.NOCOUNT_START_ZSH
+            cls.NOCOUNT_END = cls.NOCOUNT_END_ZSH
+        else:
+            cls.NOCOUNT_START = cls.NOCOUNT_START_BASH
+            cls.NOCOUNT_END = cls.NOCOUNT_END_BASH
+
     def _encode(self, code, wrap=True):
         """
         Add the bash escape codes for colours
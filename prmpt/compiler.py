@@ -6,66 +6,272 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import str
 
+# Import external modules
+import time
+from collections import OrderedDict
+
 from prmpt import parser
+from prmpt import optimiser
 from prmpt import colours
 from prmpt import status
+from prmpt import functionBase
+
+# The function that marks a segment of the prompt
+SEGMENT = "segment"
+
+# Most segment outputs kept, for when segments are skipped
+MAX_SEGMENT_OUTPUTS = 256
+
+# How much a skipped segment's time is reduced by each time it is
+# skipped, so that it is tried again, and measured, before long
+SKIPPED_SEGMENT_DECAY = 0.5
 
 
 class Compiler(object):
-    """ Compiles and executes the parsed dictionary list output
-    from the Parser.
+    """ Compiles and executes the list of nodes output from the
+    Parser.
 
     Literals are output verbatim, or passed into functions for
-    processing.
+    processing. Unless ``optimise`` is ``False``, the parsed nodes
+    are passed through the :class:`prmpt.optimiser.Optimiser` before
+    they are first executed.
+
+    If there is a render budget (see :class:`prmpt.config.Config`), the
+    top level segments of the prompt (calls to ``\\segment``, or to
+    functions with a priority, see :func:`prmpt.functionBase.priority`)
+    are executed first, highest priority first. A segment is skipped if
+    it would not be expected to finish, together with the rest of the
+    prompt, within the budget (going by how long they took last time),
+    and its last output in the working directory is used instead. Each
+    time a segment is skipped its expected time is halved, so one that
+    was slow once is soon run again. The rest of the prompt is always
+    executed.
     """
-    def __init__(self, functionContainer):
+    def __init__(self, functionContainer, parseCache=None, optimise=True):
         # Compiler requires a valid FunctionContainer in order
         # to execute functions
         self.funcs = functionContainer
 
         self.parser = parser.Parser()
+        self.parseCache = parseCache
         self.parsedStruct = []
+        self.optimiser = optimiser.Optimiser(functionContainer) if optimise else None
+        self.optimisedStruct = None
+        # Calls to prefetch at the start of each render
+        self.blockingCalls = None
+        # The (index, priority) of each top level segment, in the order
+        # to execute them
+        self.segments = None
+        # Seconds each segment, and the rest of the prompt, took last time
+        self.segmentTimes = {}
+        self.essentialTime = 0
+        # The last output of each segment, by working directory and index
+        self.segmentOutputs = OrderedDict()
 
-    def compile(self, promptString):
+    def compile(self, promptString, fileKey=None):
         """ Parse a given promptString. Add the resulting
-        list of dictionary items to the internal buffer
+        list of nodes to the internal buffer
         ready for executing.
+
+        If the string was read from a file, ``fileKey`` is the
+        (path, mtime, size) tuple of that file, and is used to look up
+        a previously parsed copy in the parse cache.
         """
-        self.parsedStruct.extend(self.parser.parse(promptString))
+        self.optimisedStruct = None
+        self.blockingCalls = None
+        self.segments = None
+        self.segmentTimes = {}
+        self.essentialTime = 0
+        self.segmentOutputs.clear()
+        if self.parseCache is None or fileKey is None:
+            self.parsedStruct.extend(self.parser.parseNodes(promptString))
+            return
+
+        key = self.parseCache.makeKey(*fileKey)
+        parsed = self.parseCache.load(key)
+        if parsed is None:
+            parsed = self.parser.parseNodes(promptString)
+            self.parseCache.store(key, parsed)
+        self.parsedStruct.extend(parsed)
 
     def execute(self):
         """ Execute the internal buffer and return the output
-        string.
+        string. Each execution is a separate render, so stable
+        functions are called again.
+
+        Calls to blocking functions (see
+        :func:`prmpt.functionBase.blocking`) with constant arguments are
+        all started before anything else, so that the render waits for
+        the slowest of them rather than for each in turn.
         """
-        return self._execute(self.parsedStruct)
+        start = time.time()
+        if self.optimiser is None:
+            parsedStruct = self.parsedStruct
+        else:
+            if self.optimisedStruct is None:
+                self.optimisedStruct = self.optimiser.optimise(self.parsedStruct)
+            parsedStruct = self.optimisedStruct
+        if self.blockingCalls is None:
+            self.blockingCalls = self._findBlocking(parsedStruct, [])
+        if self.segments is None:
+            self.segments = self._findSegments(parsedStruct)
+        budget = self.funcs.status.config.renderBudget
+        self.funcs.startRender()
+        self.funcs.prefetch(self.blockingCalls)
+        try:
+            if budget and self.segments:
+                return self._executeBudgeted(parsedStruct, start + budget)
+            return self._execute(parsedStruct, move=True)
+        finally:
+            self.funcs.endRender()
 
-    def _move(self, string):
-        self.funcs.status.pos.incFromString(string)
-        return string
+    def _findSegments(self, parsedStruct):
+        """ Get the (index, priority) of each top level segment in
+        ``parsedStruct``, highest priority first, then in order.
+        """
+        segments = []
+        for idx, element in enumerate(parsedStruct):
+            if type(element) is not parser.Call:
+                continue
+            if element.name == SEGMENT:
+                priority = self._segmentPriority(element)
+            else:
+                priority = self.funcs.getPriority(element.name)
+            if priority is not None:
+                segments.append((-priority, idx))
+        segments.sort()
+        return [(idx, -priority) for priority, idx in segments]
+
+    @staticmethod
+    def _segmentPriority(element):
+        """ The priority of a call to ``\\segment``, or ``None`` if it
+        is not a constant number (the call then reports the error).
+        """
+        if len(element.args) != 1 or len(element.optargs) > 1:
+            return None
+        if not element.optargs:
+            return 0.0
+        if any(type(node) is not parser.Literal for node in element.optargs[0]):
+            return None
+        try:
+            return float("".join(node.value for node in element.optargs[0]))
+        except ValueError:
+            return None
 
-    def _execute(self, parsedStruct):
-        out = ""
+    def _executeBudgeted(self, parsedStruct, deadline):
+        """ Execute the segments of ``parsedStruct`` in order of
+        priority, while there is enough time before ``deadline``, and
+        then the rest of it. Skipped segments are reported in the
+        timer's info.
+        """
+        status = self.funcs.status
+        workingDir = status.getWorkingDir()
+        fragments = {}
+        skipped = []
+        # Blocking calls in segments cannot wait past the deadline
+        self.funcs.deadline = deadline
+        try:
+            for idx, priority in self.segments:
+                start = time.time()
+                key = (workingDir, idx)
+                segmentTime = self.segmentTimes.get(idx, 0)
+                if start + segmentTime + self.essentialTime > deadline:
+                    self.segmentTimes[idx] = segmentTime * SKIPPED_SEGMENT_DECAY
+                    fragment = self.segmentOutputs.get(key)
+                    skipped.append("line %d (priority %g%s)" % (
+                        parsedStruct[idx].lineno, priority,
+                        ", cached" if fragment is not None else ""
+                    ))
+                    fragments[idx] = fragment or ""
+                    continue
+                fragment = fragments[idx] = self._execute(parsedStruct[idx:idx+1])
+                self.segmentTimes[idx] = time.time() - start
+                self.segmentOutputs.pop(key, None)
+                self.segmentOutputs[key] = fragment
+                while len(self.segmentOutputs) > MAX_SEGMENT_OUTPUTS:
+                    self.segmentOutputs.popitem(False)
+        finally:
+            self.funcs.deadline = None
+
+        if skipped:
+            status.timer.info["skipped segments"] = ", ".join(skipped)
+        start = time.time()
+        output = self._execute(parsedStruct, move=True, fragments=fragments)
+        self.essentialTime = time.time() - start
+        return output
+
+    def _findBlocking(self, parsedStruct, calls):
+        """ Collect the (name, arguments...) of each call to a blocking
+        function with constant arguments in ``parsedStruct``, including
+        those in lazy arguments that may not be evaluated.
+        """
         for element in parsedStruct:
-            if element['type'] == 'literal':
+            if type(element) is not parser.Call:
+                continue
+            argStructs = element.args + element.optargs
+            for arg in argStructs:
+                self._findBlocking(arg, calls)
+            if self.funcs.isBlocking(element.name) and \
+                    all(type(node) is parser.Literal for arg in argStructs for node in arg):
+                call = (element.name,) + tuple(
+                    "".join(node.value for node in arg) for arg in argStructs
+                )
+                if call not in calls:
+                    calls.append(call)
+        return calls
+
+    def _thunk(self, parsedStruct):
+        return functionBase.Thunk(lambda: self._execute(parsedStruct))
+
+    def _execute(self, parsedStruct, move=False, fragments=None):
+        """ Execute ``parsedStruct``. Fragments are collected in a list
+        and joined once. Only the top level (``move=True``) updates the
+        cursor position, as the output of nested structures is part of
+        the output of the enclosing function, and will be counted then.
+
+        ``fragments`` maps the index of any element that has been
+        executed already to its output.
+
+        The dictionary form returned by :meth:`Parser.parse` is also
+        accepted.
+        """
+        if parsedStruct and type(parsedStruct[0]) is dict:
+            parsedStruct = parser.fromDicts(parsedStruct)
+        out = []
+        for idx, element in enumerate(parsedStruct):
+            if fragments is not None and idx in fragments:
+                fragment = fragments[idx]
+            elif type(element) is parser.Literal:
                 # Literals go to the output verbatim
-                out += self._move(element['value'])
-            elif element['type'] == 'function':
+                fragment = element.value
+                if move and element.movement is not None:
+                    # Already measured by the optimiser
+                    self.funcs.status.pos.move(element.movement)
+                    out.append(fragment)
+                    continue
+            else:
                 # First arg is the function name and current char position
-                args = [element['name']]
-                # Then the required arguments
-                if 'args' in element:
-                    for arg in element['args']:
+                args = [element.name]
+                # Then the required arguments, followed by any optional
+                # arguments
+                argStructs = element.args + element.optargs
+                lazy = self.funcs.getLazyArgs(element.name)
+                for argIdx, arg in enumerate(argStructs):
+                    if lazy == functionBase.ALL or (lazy and argIdx in lazy):
+                        # Only evaluated if the function asks for it
+                        args.append(self._thunk(arg))
+                    else:
                         args.append(self._execute(arg))
-                # Finally any optional arguments
-                if 'optargs' in element:
-                    for optarg in element['optargs']:
-                        args.append(self._execute(optarg))
                 # Call the function!
                 try:
-                    out += self._move(str(self.funcs._call(*args)))
+                    fragment = str(self.funcs._call(*args))
                 except ValueError as e:
-                    return "Prmpt error on line %d: %s\n$ " % (element['lineno'], str(e))
+                    return "Prmpt error on line %d: %s\n$ " % (element.lineno, str(e))
                 except KeyError as e:
-                    return "Prmpt error on line %d: No such function %s\n$ " % (element['lineno'], str(e))
+                    return "Prmpt error on line %d: No such function %s\n$ " % (element.lineno, str(e))
+
+            if move:
+                self.funcs.status.pos.incFromString(fragment)
+            out.append(fragment)
 
-        return out
+        return "".join(out)
@@ -16,21 +16,98 @@ class Config(object):
         self.configDir = None
         self.configParser = ConfigParser()
         self.promptFile = None
+        self.promptFileKey = None
+        self.promptFileString = None
+        # Seconds for which VCS status is reused between prompts (0 to
+        # disable), and the number of repositories to remember
+        self.vcsCacheMaxAge = 30
+        self.vcsCacheSize = 64
+        # Repositories with at least this many files in the index, or
+        # whose status last took at least this many seconds, are read
+        # in the cheaper way described in git.Git (0 to disable either)
+        self.largeRepoFiles = 100000
+        self.largeRepoTime = 1.0
+        # Seconds between counts of untracked files in large repositories
+        self.untrackedInterval = 300
+        # Counts of files above this are shown as e.g. "999+" (0 for no limit)
+        self.countLimit = 999
+        # Seconds that a blocking function (see functionBase.blocking)
+        # may take, and that a command may run before it is killed (0 for
+        # no limit). A function that times out shows its last value in
+        # the same directory, or the placeholder.
+        self.functionTimeout = 3.0
+        self.commandTimeout = 2.0
+        self.timeoutPlaceholder = "\u2026"
+        # Timeouts for particular functions, by lower case name
+        self.functionTimeouts = {}
+        # Seconds that executing the prompt may take before segments
+        # (see functions.MiscFunctions.segment) are skipped (0 for no
+        # limit)
+        self.renderBudget = 0
 
     def load(self, filename):
         self.configFile = filename
         self.configDir = os.path.dirname(filename)
 
         # Read and parse the config file
-        self.configParser.read(filename)
+        self.configParser.read(filename, encoding="utf-8")
 
         self.promptFile = os.path.join(
             self.configDir,
             self.configParser.get('prompt', 'prompt_file')
         )
+        self.vcsCacheMaxAge = self.configParser.getfloat(
+            'vcs', 'cache_max_age', fallback=self.vcsCacheMaxAge
+        )
+        self.vcsCacheSize = self.configParser.getint(
+            'vcs', 'cache_size', fallback=self.vcsCacheSize
+        )
+        self.largeRepoFiles = self.configParser.getint(
+            'vcs', 'large_repo_files', fallback=self.largeRepoFiles
+        )
+        self.largeRepoTime = self.configParser.getfloat(
+            'vcs', 'large_repo_time', fallback=self.largeRepoTime
+        )
+        self.untrackedInterval = self.configParser.getfloat(
+            'vcs', 'untracked_interval', fallback=self.untrackedInterval
+        )
+        self.countLimit = self.configParser.getint(
+            'vcs', 'count_limit', fallback=self.countLimit
+        )
+        self.functionTimeout = self.configParser.getfloat(
+            'timeouts', 'function', fallback=self.functionTimeout
+        )
+        self.commandTimeout = self.configParser.getfloat(
+            'timeouts', 'command', fallback=self.commandTimeout
+        )
+        self.timeoutPlaceholder = self.configParser.get(
+            'timeouts', 'placeholder', fallback=self.timeoutPlaceholder
+        )
+        self.renderBudget = self.configParser.getfloat(
+            'timeouts', 'render', fallback=self.renderBudget
+        )
+        if self.configParser.has_section('function_timeouts'):
+            # Option names are lower case
+            for name in self.configParser.options('function_timeouts'):
+                self.functionTimeouts[name] = self.configParser.getfloat(
+                    'function_timeouts', name
+                )
 
         self.loadPromptFile()
 
     def loadPromptFile(self):
         with open(self.promptFile, "r") as pFile:
             self.promptString = pFile.read()
+            st = os.fstat(pFile.fileno())
+        self.promptFileKey = (self.promptFile, st.st_mtime, st.st_size)
+        self.promptFileString = self.promptString
+
+    def getPromptFileKey(self):
+        """
+        Get a (path, mtime, size) tuple that identifies the version of the
+        prompt file that ``promptString`` was read from. Returns ``None``
+        if ``promptString`` has been modified since it was read.
+        """
+        if self.promptString is not self.promptFileString:
+            return None
+        return self.promptFileKey
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Import external modules
+# (the client must start quickly, so anything only needed by the
+# daemon itself is imported where it is used)
+import os
+import sys
+import json
+import time
+import errno
+import socket
+
+# Import prmpt modules
+import prmpt
+
+
+SOCKET_NAME = "prmpt.sock"
+LOCK_NAME = "prmpt.lock"
+
+# Seconds without a request before the daemon exits
+IDLE_TIMEOUT = 15*60
+
+# Seconds the client will wait for the daemon to reply before
+# giving up and rendering in-process
+CLIENT_TIMEOUT = 2.0
+
+# Seconds a newly started daemon will wait for an old one to exit
+LOCK_TIMEOUT = 2.0
+
+
+def getRuntimeDir():
+    """
+    Get the per-user directory in which the daemon socket lives.
+    ``$XDG_RUNTIME_DIR`` is used if it is set, otherwise a private
+    directory is created in ``$TMPDIR``.
+    """
+    runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtimeDir and os.path.isdir(runtimeDir):
+        return runtimeDir
+
+    runtimeDir = os.path.join(
+        os.environ.get("TMPDIR", "/tmp"),
+        "prmpt-%d" % os.getuid()
+    )
+    try:
+        os.mkdir(runtimeDir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Refuse to use a directory that somebody else could have planted
+    st = os.lstat(runtimeDir)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise IOError("Insecure runtime directory %s" % runtimeDir)
+    return runtimeDir
+
+
+def getSocketPath():
+    return os.path.join(getRuntimeDir(), SOCKET_NAME)
+
+
+def getShell():
+    """
+    The shell dialect of the calling shell, e.g. ``bash`` or ``zsh``.
+    """
+    return os.environ.get('SHELL', 'sh').split(os.sep)[-1]
+
+
+def _send(sock, message):
+    sock.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+
+def _receive(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    if not data:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+class Client(object):
+    """
+    A thin client that asks a running :class:`Daemon` to render the
+    prompt.
+    """
+    def __init__(self, socketPath=None, timeout=CLIENT_TIMEOUT, version=None):
+        self.socketPath = socketPath
+        self.timeout = timeout
+        if version is None:
+            version = prmpt.__version__
+        self.version = version
+
+    def render(self, exitCode, workingDir=None, columns=None, lines=None, shell=None,
+               timer=None):
+        """
+        Request a prompt from the daemon. If ``timer`` is enabled, the
+        phases timed by the daemon are added to it.
+
+        :return: The rendered prompt, or ``None`` if the daemon is not
+                 available (in which case the caller should render the
+                 prompt itself).
+        """
+        request = {
+            "version": self.version,
+            "exitCode": int(exitCode),
+            "workingDir": workingDir or os.getenv('PWD') or os.getcwd(),
+            "columns": columns if columns is not None else os.getenv('COLUMNS'),
+            "lines": lines if lines is not None else os.getenv('LINES'),
+            "shell": shell or getShell(),
+            # e.g. GIT_DIR, or anything user functions look at
+            "environ": dict(os.environ),
+        }
+        if timer is not None and timer.enabled:
+            request["timer"] = timer.origin
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socketPath or getSocketPath())
+            _send(sock, request)
+            reply = _receive(sock)
+        except (socket.error, socket.timeout, IOError, ValueError):
+            return None
+        finally:
+            sock.close()
+
+        if not reply or "prompt" not in reply:
+            return None
+        if timer is not None and "timer" in reply:
+            timer.merge(reply["timer"]["phases"], reply["timer"]["info"])
+        return reply["prompt"]
+
+    @staticmethod
+    def startDaemon(command):
+        """
+        Start a daemon in the background, detached from the calling
+        shell. ``command`` is the argument list that runs the daemon
+        in the foreground (e.g. ``prmpt --serve``).
+        """
+        import subprocess
+        with open(os.devnull, "r+b") as devnull:
+            subprocess.Popen(command,
+                             stdin=devnull,
+                             stdout=devnull,
+                             stderr=devnull,
+                             close_fds=True,
+                             preexec_fn=os.setsid)
+
+
+class Daemon(object):
+    """
+    A long-lived process that holds a loaded :class:`prmpt.prompt.Prompt`
+    in memory and renders it on behalf of :class:`Client` requests
+    received over a per-user Unix socket.
+
+    The daemon exits when it has been idle for ``idleTimeout`` seconds,
+    or when a client of a different version connects (so that the
+    client can start a replacement).
+    """
+    def __init__(self, socketPath=None, idleTimeout=IDLE_TIMEOUT):
+        self.socketPath = socketPath or getSocketPath()
+        self.lockPath = os.path.join(os.path.dirname(self.socketPath), LOCK_NAME)
+        self.idleTimeout = idleTimeout
+        self.prompt = None
+        self.signature = None
+        self.running = False
+        # Watches visited repositories, if inotify is available
+        self.watcher = None
+
+    def serve(self):
+        """
+        Serve requests until idle or told to stop.
+
+        :return: ``False`` if another daemon already owns the socket.
+        """
+        lockFile = open(self.lockPath, "a")
+        try:
+            if not self._lock(lockFile):
+                return False
+
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(self.socketPath)
+            os.chmod(self.socketPath, 0o600)
+            server.listen(16)
+            server.settimeout(self.idleTimeout)
+
+            self.running = True
+            try:
+                while self.running:
+                    try:
+                        conn, _ = server.accept()
+                    except socket.timeout:
+                        # Idle for too long
+                        break
+                    try:
+                        self.handle(conn)
+                    finally:
+                        conn.close()
+            finally:
+                self.running = False
+                server.close()
+                os.unlink(self.socketPath)
+                if self.watcher:
+                    self.watcher.close()
+                    self.watcher = None
+        finally:
+            lockFile.close()
+        return True
+
+    @staticmethod
+    def _lock(lockFile):
+        """
+        Take an exclusive lock so that only one daemon serves the socket.
+        A daemon that is shutting down is given a moment to let go.
+        """
+        import fcntl
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES) or time.time() > deadline:
+                    return False
+            time.sleep(0.05)
+
+    def handle(self, conn):
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            request = _receive(conn)
+        except (socket.error, socket.timeout, ValueError):
+            return
+        if not request:
+            return
+
+        if request.get("version") != prmpt.__version__:
+            # A different version of prmpt is installed. Exit and let
+            # the client start a fresh daemon.
+            self.running = False
+            reply = {"error": "version mismatch"}
+        else:
+            timer = None
+            if request.get("timer") is not None:
+                from prmpt import timing
+                # Timed from when the client started
+                timer = timing.Timer(request["timer"])
+            try:
+                reply = {"prompt": self.render(request, timer)}
+            except Exception as e:
+                reply = {"error": str(e)}
+            if timer is not None:
+                reply["timer"] = {"phases": timer.phases, "info": timer.info}
+
+        try:
+            _send(conn, reply)
+        except (socket.error, socket.timeout):
+            pass
+
+    def render(self, request, timer=None):
+        """
+        Render the prompt for ``request``, in the client's environment.
+        If there is a ``timer``, each phase of the render is recorded
+        in it.
+        """
+        environ = request.get("environ")
+        if environ is None:
+            return self._render(request, timer)
+        daemonEnviron = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(environ)
+        try:
+            return self._render(request, timer)
+        finally:
+            os.environ.clear()
+            os.environ.update(daemonEnviron)
+
+    def _render(self, request, timer):
+        from prmpt import colours
+        from prmpt import status as statusmod
+
+        colours.Colours._setShell(request.get("shell"))
+
+        p = self._getPrompt()
+        p.status.reset(request.get("exitCode", 0), request.get("workingDir"))
+        if request.get("columns"):
+            p.status.window = statusmod.Coords(
+                int(request["columns"]),
+                int(request.get("lines") or 0)
+            )
+        if timer is None:
+            return p.getPrompt()
+        daemonTimer, p.status.timer = p.status.timer, timer
+        try:
+            return p.getPrompt()
+        finally:
+            p.status.timer = daemonTimer
+
+    def _getPrompt(self):
+        """
+        Get the loaded prompt, reloading it if the config, the prompt
+        file or any user functions have changed on disk.
+        """
+        from prmpt import prompt as promptmod
+        from prmpt import status as statusmod
+
+        signature = self._signature()
+        if self.prompt is None or signature != self.signature:
+            self.prompt = promptmod.Prompt(statusmod.Status())
+            self.prompt.status.vcsWatcher = self._getWatcher(
+                self.prompt.config.vcsCacheMaxAge
+            )
+            self.signature = self._signature()
+        return self.prompt
+
+    def _getWatcher(self, maxAge):
+        """
+        Get a :class:`prmpt.inotify.RepoWatcher` that reuses a status for
+        at most ``maxAge`` seconds, or ``None`` if inotify is not
+        available (in which case VCS status is cached as it is for a
+        single prompt).
+        """
+        if self.watcher is None:
+            from prmpt import inotify
+            try:
+                self.watcher = inotify.RepoWatcher()
+            except OSError:
+                self.watcher = False
+        if self.watcher:
+            self.watcher.maxAge = maxAge
+        return self.watcher or None
+
+    def _signature(self):
+        import glob
+        if self.prompt is None:
+            return None
+        userDir = self.prompt.status.userDir
+        files = [userDir.getConfigFile(), self.prompt.config.promptFile]
+        files.extend(glob.glob(os.path.join(userDir.promtyUserFunctionsDir, "*.py")))
+        signature = []
+        for filename in files:
+            try:
+                signature.append((filename, os.path.getmtime(filename)))
+            except OSError:
+                signature.append((filename, None))
+        return signature
+
+
+def main():
+    return 0 if Daemon().serve() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,16 @@ from __future__ import unicode_literals
 import types
 
 
+class Timeout(Exception):
+    """
+    Raised when a function (or a command that it runs) takes longer
+    than it is allowed to. The function's last value in the same
+    directory, or the placeholder, is shown instead (see
+    :class:`prmpt.config.Config`).
+    """
+    pass
+
+
 def getmembers(obj, predicate=None):
     """ ** Extracted from inspect module for optimisation purposes **
     Return all members of an object as (name, value) pairs sorted by name.
@@ -66,7 +76,225 @@ def isclass(obj):
     return isinstance(obj, type)
 
 
+class Thunk(object):
+    """
+    A deferred function argument. The argument is only evaluated when
+    the thunk is called, and then only once.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.evaluated = False
+        self.value = None
+
+    def __call__(self):
+        if not self.evaluated:
+            self.value = self.func()
+            self.evaluated = True
+        return self.value
+
+
+def force(value):
+    """
+    Get the value of an argument that may have been passed lazily.
+    """
+    if isinstance(value, Thunk):
+        return value()
+    return value
+
+
+# Sentinel meaning that every argument of a function is lazy
+ALL = "all"
+
+
+def lazy(*params):
+    """
+    Decorator declaring that the named parameters of a prmpt function
+    should be passed as :class:`Thunk` objects, rather than being
+    evaluated before the call. If no parameters are named then all
+    arguments are lazy. Use :func:`force` to get the value.
+
+    Example::
+
+        @functionBase.lazy("thenval", "elseval")
+        def ifexpr(self, cond, thenval='', elseval=''):
+            ...
+    """
+    def decorator(func):
+        func._prmptLazy = params or ALL
+        return func
+    return decorator
+
+
+def lazyPositions(func):
+    """
+    Get the positional indices of the lazy parameters of ``func``,
+    :data:`ALL` or ``None``.
+    """
+    params = getattr(func, "_prmptLazy", None)
+    if params is None or params == ALL:
+        return params
+
+    code = func.__code__
+    names = code.co_varnames[:code.co_argcount]
+    if ismethod(func):
+        # Skip self
+        names = names[1:]
+    return frozenset(i for i, name in enumerate(names) if name in params)
+
+
+def pure(func):
+    """
+    Decorator declaring that a prmpt function is pure, i.e. its output
+    depends only on its arguments. Calls to pure functions with constant
+    arguments are evaluated once, when the prompt is compiled.
+    """
+    func._prmptPure = True
+    return func
+
+
+def impure(func):
+    """
+    Decorator declaring that a prmpt function is not pure, overriding
+    the ``PURE`` default of its class.
+    """
+    func._prmptPure = False
+    return func
+
+
+def stable(func):
+    """
+    Decorator declaring that a prmpt function gives the same output for
+    the same arguments throughout a render, e.g. because it depends on
+    the working directory or the repository status, but not on the
+    cursor position. Such calls are made at most once per render.
+    Pure functions are also stable.
+    """
+    func._prmptStable = True
+    return func
+
+
+def volatile(func):
+    """
+    Decorator declaring that a prmpt function must be called every time
+    it is used, overriding the ``PURE`` and ``STABLE`` defaults of its
+    class. This is the default for functions that are not declared
+    otherwise.
+    """
+    func._prmptPure = False
+    func._prmptStable = False
+    return func
+
+
+def blocking(func):
+    """
+    Decorator declaring that a prmpt function is stable (see
+    :func:`stable`) and spends most of its time waiting, e.g. for a
+    command or a host name lookup. Calls to blocking functions whose
+    arguments are all constant are started on a pool of threads at the
+    start of a render, so that they wait at the same time.
+    """
+    func._prmptBlocking = True
+    return stable(func)
+
+
+def priority(level):
+    """
+    Decorator giving a prmpt function a priority, so that a call to it
+    at the top level of a prompt is a segment of that priority, like
+    ``\\segment[level]{...}`` (see :meth:`prmpt.functions.MiscFunctions.segment`).
+
+    Example::
+
+        @functionBase.priority(-1)
+        def weather(self):
+            ...
+    """
+    def decorator(func):
+        func._prmptPriority = float(level)
+        return func
+    return decorator
+
+
+def priorityOf(func):
+    """
+    Get the priority of ``func`` (see :func:`priority`), or ``None``.
+    """
+    return getattr(func, "_prmptPriority", None)
+
+
+# Set in the code flags of functions defined with "async def"
+# (inspect.CO_COROUTINE, which is slow to import)
+CO_COROUTINE = 0x80
+
+
+def isAsync(func):
+    """
+    Return ``True`` if ``func`` was defined with ``async def``. Async
+    prmpt functions are stable and blocking unless declared otherwise,
+    and their coroutines are run on a shared event loop.
+    """
+    code = getattr(func, "__code__", None)
+    return code is not None and bool(code.co_flags & CO_COROUTINE)
+
+
+def _classDefault(func, name):
+    return getattr(getattr(func, "__self__", None), name, False)
+
+
+def isPure(func):
+    """
+    Return ``True`` if ``func`` was declared pure, either directly or by
+    the ``PURE`` attribute of the class it is bound to.
+    """
+    purity = getattr(func, "_prmptPure", None)
+    if purity is None:
+        purity = _classDefault(func, "PURE")
+    return purity is True
+
+
+def isStable(func):
+    """
+    Return ``True`` if ``func`` was declared stable (or pure), either
+    directly or by the ``STABLE`` (or ``PURE``) attribute of the class
+    it is bound to.
+    """
+    if isPure(func):
+        return True
+    stability = getattr(func, "_prmptStable", None)
+    if stability is None:
+        stability = _classDefault(func, "STABLE") or isAsync(func)
+    return stability is True
+
+
+def isBlocking(func):
+    """
+    Return ``True`` if ``func`` is stable and was declared blocking,
+    either directly or by the ``BLOCKING`` attribute of the class it is
+    bound to.
+    """
+    blocking = getattr(func, "_prmptBlocking", None)
+    if blocking is None:
+        blocking = _classDefault(func, "BLOCKING") or isAsync(func)
+    return blocking is True and isStable(func)
+
+
 class PrmptFunctions(object):
+    """
+    A group of prmpt functions. Each public method is registered as a
+    function of the same name.
+
+    Methods may be defined with ``async def``, e.g. to wait on a
+    subprocess with :func:`asyncio.create_subprocess_exec`. The
+    coroutines of all of the async calls that can be prefetched run at
+    the same time, on one event loop.
+    """
+    # Set to True in subclasses whose functions are all pure
+    PURE = False
+    # Set to True in subclasses whose functions are all stable
+    STABLE = False
+    # Set to True in subclasses whose functions are all blocking
+    BLOCKING = False
+
     def __init__(self, container=None):
         self.functions = container
         if self.functions:
@@ -81,6 +309,10 @@ class PrmptFunctions(object):
     def register(self):
         for name, func in getmembers(self, ismethod):
             if name[0] != "_":
+                if name[-1] == "_":
+                    # Allows functions named after python keywords,
+                    # e.g. 'and_' is registered as 'and'
+                    name = name[:-1]
                 self.functions.addFunction(name, func)
 
     def call(self, func, *args, **kwargs):
@@ -8,25 +8,383 @@ from __future__ import unicode_literals
 # Import external modules
 # import inspect    # Removed for being slow to import
 # import types      # Not used
-import imp
 import glob
 import os
+import functools
+import time
+import threading
+from collections import deque, OrderedDict
 
 # Import prmpt modules
 from prmpt import functionBase
 from prmpt import status as statusmod
 
 
+# Most threads used to prefetch blocking calls
+MAX_THREADS = 8
+
+# Most calls whose last values are kept, for when they time out
+MAX_LAST_VALUES = 256
+
+
+class Pending(object):
+    """
+    A call that may be made on another thread. It is made by whichever
+    thread gets to it first, and any others wait for the result.
+
+    ``onResult``, if given, is passed the result once the call has
+    succeeded, whether or not anything is still waiting for it.
+    """
+    def __init__(self, func, args, onResult=None):
+        self.func = func
+        self.args = args
+        self.onResult = onResult
+        self.claimed = threading.Lock()
+        self.done = threading.Event()
+        self.started = None
+        self.result = None
+        self.exception = None
+
+    def _claim(self):
+        if not self.claimed.acquire(False):
+            return False
+        self.started = time.time()
+        return True
+
+    def run(self):
+        """
+        Make the call, unless another thread has started it already.
+        """
+        if self._claim():
+            self._call()
+
+    def runThread(self):
+        """
+        Start making the call on a new thread, unless another thread has
+        started it already.
+        """
+        if self._claim():
+            thread = threading.Thread(target=self._call)
+            thread.daemon = True
+            thread.start()
+
+    def _call(self):
+        try:
+            self._setResult(self.func(*self.args))
+        except Exception as e:
+            # Raised where the call is used
+            self.exception = e
+        finally:
+            self.done.set()
+
+    def runOn(self, eventLoop):
+        """
+        Start the coroutine of an async call on ``eventLoop``, without
+        waiting for it.
+        """
+        if not self._claim():
+            return
+        try:
+            future = eventLoop.submit(self.func(*self.args))
+        except Exception as e:
+            self.exception = e
+            self.done.set()
+        else:
+            future.add_done_callback(self._finish)
+
+    def _finish(self, future):
+        try:
+            self._setResult(future.result())
+        except Exception as e:
+            self.exception = e
+        finally:
+            self.done.set()
+
+    def _setResult(self, result):
+        self.result = result
+        if self.onResult is not None:
+            self.onResult(result)
+
+    def get(self, timeout=0, deadline=None):
+        """
+        Wait for the result. If ``timeout`` is not 0, or there is a
+        ``deadline`` (a time), the call is made on another thread
+        (unless it has been started already), and
+        :class:`functionBase.Timeout` is raised if it has not finished
+        ``timeout`` seconds after it started, or by the deadline.
+        """
+        if not timeout and deadline is None:
+            self.run()
+            self.done.wait()
+        else:
+            self.runThread()
+            end = deadline
+            if timeout:
+                end = (self.started or time.time()) + timeout
+                if deadline is not None:
+                    end = min(end, deadline)
+            if not self.done.wait(max(0, end - time.time())):
+                raise functionBase.Timeout()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class EventLoop(object):
+    """
+    An asyncio event loop, running on its own thread, for the
+    coroutines of async prmpt functions.
+    """
+    def __init__(self):
+        # Only imported when there are async functions
+        import asyncio
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        self.asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Start running ``coroutine``, returning a
+        :class:`concurrent.futures.Future` for its result.
+        """
+        return self.asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """
+        Run ``coroutine`` and wait for its result.
+        """
+        if threading.current_thread() is self.thread:
+            # It would wait for itself
+            coroutine.close()
+            raise RuntimeError("an async function cannot call another with call()")
+        return self.submit(coroutine).result()
+
+
 class FunctionContainer(object):
+    """
+    The registered prmpt functions.
+
+    During a render (between :meth:`startRender` and :meth:`endRender`)
+    the results of calls to stable functions (see
+    :func:`functionBase.stable`) are memoised, keyed on the function
+    name and arguments. Calls to blocking functions can be started
+    early, on other threads (or for async functions, on the event loop),
+    with :meth:`prefetch`.
+
+    Calls to functions with a timeout (see :meth:`getTimeout`) are made
+    on another thread. If one takes too long, or a function raises
+    :class:`functionBase.Timeout`, the last value of the same call in
+    the same directory is used instead, or the placeholder if there is
+    none. While ``deadline`` is set, calls to blocking functions also
+    give up at that time.
+    """
 
     def _call(self, *args, **kwargs):
         if len(args) < 1:
             raise TypeError("call requires a name")
         name = args[0]
-        return self.functions[name](*args[1:], **kwargs)
+        key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+        if self.memo is None or not self.stable.get(name, False):
+            return self._invoke(name, args, kwargs, key)
+
+        try:
+            result = self.memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments
+            return self._invoke(name, args, kwargs, None)
+        else:
+            if type(result) is Pending:
+                # Prefetched, so this is the first use
+                self.memoMisses += 1
+                result = self.memo[key] = self._wait(name, result, key)
+            else:
+                self.memoHits += 1
+            return result
+        self.memoMisses += 1
+        result = self.memo[key] = self._invoke(name, args, kwargs, key)
+        return result
+
+    def _invoke(self, name, args, kwargs, key):
+        if self.getTimeout(name) or (self.deadline is not None and self.blocking.get(name, False)):
+            func = self.functions[name]
+            if kwargs:
+                func = functools.partial(func, **kwargs)
+            pending = Pending(func, args[1:], self._rememberer(key))
+            if self.isAsync.get(name, False):
+                pending.runOn(self.getEventLoop())
+            else:
+                pending.runThread()
+            return self._wait(name, pending, key)
+
+        try:
+            result = self.functions[name](*args[1:], **kwargs)
+            if self.isAsync.get(name, False):
+                result = self.getEventLoop().run(result)
+        except functionBase.Timeout:
+            return self._lastValue(key)
+        if self.blocking.get(name, False):
+            self._remember(self.status.getWorkingDir(), key, result)
+        return result
+
+    def _wait(self, name, pending, key):
+        """
+        Get the result of ``pending``, or the last value of the call if
+        it times out.
+        """
+        timeout = self.getTimeout(name)
+        try:
+            return pending.get(timeout, self.deadline)
+        except functionBase.Timeout:
+            if pending.done.is_set():
+                # It raised the timeout itself
+                pass
+            elif self.deadline is not None and time.time() >= self.deadline:
+                self.status.recordTimeout("\\%s ran out of render budget" % name)
+            else:
+                self.status.recordTimeout("\\%s timed out after %gs" % (name, timeout))
+            return self._lastValue(key)
+
+    def getPriority(self, name):
+        """
+        Get the priority of function ``name`` (see
+        :func:`functionBase.priority`), or ``None``.
+        """
+        return self.priorities.get(name)
+
+    def getTimeout(self, name):
+        """
+        Get the seconds that a call to function ``name`` may take, or 0
+        for no limit. Unless one is set for the function itself, only
+        blocking functions have a timeout.
+        """
+        config = self.status.config
+        try:
+            return config.functionTimeouts[name.lower()]
+        except KeyError:
+            return config.functionTimeout if self.blocking.get(name, False) else 0
+
+    def _remember(self, workingDir, key, result):
+        if key is None:
+            return
+        with self.lastValuesLock:
+            try:
+                self.lastValues[(workingDir, key)] = result
+            except TypeError:
+                # Unhashable arguments
+                return
+            while len(self.lastValues) > MAX_LAST_VALUES:
+                self.lastValues.popitem(False)
+
+    def _rememberer(self, key):
+        """
+        Get a function that remembers the result of the call ``key`` in
+        the current working directory, for :class:`Pending`.
+        """
+        workingDir = self.status.getWorkingDir()
+        return lambda result: self._remember(workingDir, key, result)
+
+    def _lastValue(self, key):
+        try:
+            return self.lastValues[(self.status.getWorkingDir(), key)]
+        except (KeyError, TypeError):
+            return self.status.config.timeoutPlaceholder
+
+    def getEventLoop(self):
+        """
+        Get the event loop that async functions run on, starting it if
+        need be.
+        """
+        if self.eventLoop is None:
+            self.eventLoop = EventLoop()
+        return self.eventLoop
+
+    def startRender(self):
+        """
+        Start memoising stable calls.
+        """
+        self.memo = {}
+        self.memoHits = 0
+        self.memoMisses = 0
+
+    def prefetch(self, calls):
+        """
+        Start making ``calls`` (each a tuple of a function name and its
+        arguments) to blocking functions, on up to ``MAX_THREADS``
+        threads in the order given. Their results are memoised for when
+        they are used.
+        """
+        if self.memo is None:
+            return
+        queue = self.prefetchQueue = deque()
+        for args in calls:
+            name = args[0]
+            if self.blocking.get(name, False) and args not in self.memo:
+                pending = self.memo[args] = Pending(self.functions[name], args[1:],
+                                                    self._rememberer(args))
+                if self.isAsync.get(name, False):
+                    # All coroutines run at once, without using a thread each
+                    pending.runOn(self.getEventLoop())
+                else:
+                    queue.append(pending)
+
+        def work():
+            while True:
+                try:
+                    pending = queue.popleft()
+                except IndexError:
+                    return
+                pending.run()
+
+        for _ in range(min(len(queue), MAX_THREADS)):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+
+    def endRender(self):
+        """
+        Forget the memoised calls, and report how many calls they saved.
+        """
+        self.memo = None
+        # Calls in branches that were not taken need not be made at all
+        self.prefetchQueue.clear()
+        self.status.timer.info["memo"] = "%d hits, %d misses" % (self.memoHits, self.memoMisses)
 
     def addFunction(self, name, func):
         self.functions[name] = func
+        self.lazyArgs[name] = functionBase.lazyPositions(func)
+        self.pure[name] = functionBase.isPure(func)
+        # Lazy arguments are different on every call
+        self.stable[name] = functionBase.isStable(func) and self.lazyArgs[name] is None
+        self.blocking[name] = self.stable[name] and functionBase.isBlocking(func)
+        self.isAsync[name] = functionBase.isAsync(func)
+        self.priorities[name] = functionBase.priorityOf(func)
+
+    def getLazyArgs(self, name):
+        """
+        Get the positional indices of the arguments that function
+        ``name`` takes lazily, :data:`functionBase.ALL` or ``None``.
+        """
+        return self.lazyArgs.get(name)
+
+    def isPure(self, name):
+        """
+        Return ``True`` if function ``name`` is known to be pure.
+        """
+        return self.pure.get(name, False)
+
+    def isBlocking(self, name):
+        """
+        Return ``True`` if calls to function ``name`` can be prefetched.
+        """
+        return self.blocking.get(name, False)
 
     def addFunctionsFromModule(self, module):
         for _, cls in functionBase.getmembers(
@@ -40,7 +398,11 @@ class FunctionContainer(object):
             obj.register()
 
     def addFunctionsFromDir(self, directory):
-        for filename in glob.glob(os.path.join(directory, "*.py")):
+        filenames = glob.glob(os.path.join(directory, "*.py"))
+        if filenames:
+            # Only import the module loader if there are user functions
+            import imp
+        for filename in filenames:
             module = imp.load_source('user', filename)
             self.addFunctionsFromModule(module)
 
@@ -49,4 +411,25 @@ class FunctionContainer(object):
             status = statusmod.Status()
         self.status = status
         self.functions = {}
+        self.lazyArgs = {}
+        self.pure = {}
+        self.stable = {}
+        self.blocking = {}
+        self.isAsync = {}
+        self.priorities = {}
         self.instances = []
+        # Results of stable calls, while rendering
+        self.memo = None
+        # Blocking calls not yet started
+        self.prefetchQueue = deque()
+        # The time by which blocking calls must finish, if any (see
+        # compiler.Compiler)
+        self.deadline = None
+        # Runs the coroutines of async functions, once there are any
+        self.eventLoop = None
+        # The last result of each call that can time out, keyed on the
+        # working directory and the call
+        self.lastValues = OrderedDict()
+        self.lastValuesLock = threading.Lock()
+        self.memoHits = 0
+        self.memoMisses = 0
@@ -8,12 +8,10 @@ from builtins import str
 from builtins import chr
 
 # Import external modules
+# (modules only needed by individual functions, such as socket and
+# datetime, are imported where they are used to keep start-up fast)
 import os
 import re
-import getpass
-import socket
-import datetime
-import random
 
 from . import functionBase
 
@@ -22,6 +20,8 @@ class SpecialCharacters(functionBase.PrmptFunctions):
     """
     Functions to print special characters.
     """
+    PURE = True
+
     def unichar(self, code):
         """
         Generate a unicode character.
@@ -118,6 +118,8 @@ class PowerlineFunctions(functionBase.PrmptFunctions):
     You must have the `powerline fonts <https://github.com/powerline/fonts>`_
     package installed in order for these to render properly.
     """
+    PURE = True
+
     def powerline(self, content, bg="blue", bg_next="default", fg="white", dir="right"):
         """
         Render ``content`` inside powerline arrows. It is possible to string
@@ -219,6 +221,10 @@ class BashPromptEscapes(functionBase.PrmptFunctions):
     # - \! - the history number of this command
     # - \# - the command number of this command
 
+    # Nothing changes during a render (including the date, as far as
+    # one prompt is concerned)
+    STABLE = True
+
     def date(self):
         """
         The date  in  "Weekday Month Date"  format (e.g., ``Tue May 26``).
@@ -242,6 +248,7 @@ class BashPromptEscapes(functionBase.PrmptFunctions):
         :param fmt: format string, defaults to ``#X`` - Locale's appropriate time
                     representation, e.g.: ``21:30:00``.
         """
+        import datetime
         now = datetime.datetime.now()
         fmt = fmt.replace('#', '%')
         return now.strftime(fmt)
@@ -252,22 +259,27 @@ class BashPromptEscapes(functionBase.PrmptFunctions):
 
         Equivalent to the bash prompt escape sequence ``\\u``.
         """
+        import getpass
         return getpass.getuser()
 
+    @functionBase.blocking
     def hostname(self):
         """
         The hostname up to the first ``.``.
 
         Equivalent to the bash prompt escape sequence ``\\h``.
         """
+        import socket
         return socket.gethostname().split(".")[0]
 
+    @functionBase.blocking
     def hostnamefull(self):
         """
         The hostname.
 
         Equivalent to the bash prompt escape sequence ``\\H``.
         """
+        import socket
         return socket.gethostname()
 
     def workingdir(self):
@@ -305,6 +317,7 @@ class BashPromptEscapes(functionBase.PrmptFunctions):
 
 
 class MiscFunctions(functionBase.PrmptFunctions):
+    @functionBase.stable
     def isrealpath(self, path=None):
         """
         If the current directory is a real path (i.e. not via a symbolic link)
@@ -321,6 +334,7 @@ class MiscFunctions(functionBase.PrmptFunctions):
             return False
 
     # ----- Expression Functions --------
+    @functionBase.stable
     def exitsuccess(self):
         """
         If the last command executed with a 0 status code, return ``True``. Otherwise
@@ -333,6 +347,7 @@ class MiscFunctions(functionBase.PrmptFunctions):
         else:
             return False
 
+    @functionBase.pure
     def equals(self, a, b):
         """
         Return ``True`` if the two parameters ``a`` and ``b`` are equal (by value).
@@ -341,6 +356,7 @@ class MiscFunctions(functionBase.PrmptFunctions):
         """
         return a == b
 
+    @functionBase.pure
     def max(self, a, b):
         """
         Return the maximum of ``a`` and ``b``.
@@ -349,11 +365,12 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :type b: number
         :rtype: number
         """
-        if float(a) > float(b):
+        if _tofloat(a) > _tofloat(b):
             return a
         else:
             return b
 
+    @functionBase.pure
     def min(self, a, b):
         """
         Return the minimum of ``a`` and ``b``.
@@ -362,11 +379,12 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :type b: number
         :rtype: number
         """
-        if float(a) < float(b):
+        if _tofloat(a) < _tofloat(b):
             return a
         else:
             return b
 
+    @functionBase.pure
     def gt(self, a, b):
         """
         Return ``True`` if ``a`` > ``b``.
@@ -375,8 +393,9 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :type b: number
         :rtype: bool
         """
-        return float(a) > float(b)
+        return _tofloat(a) > _tofloat(b)
 
+    @functionBase.pure
     def lt(self, a, b):
         """
         Return ``True`` if ``a`` < ``b``.
@@ -385,8 +404,9 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :type b: number
         :rtype: bool
         """
-        return float(a) < float(b)
+        return _tofloat(a) < _tofloat(b)
 
+    @functionBase.pure
     def gte(self, a, b):
         """
         Return ``True`` if ``a`` >= ``b``.
@@ -395,8 +415,9 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :type b: number
         :rtype: bool
         """
-        return float(a) >= float(b)
+        return _tofloat(a) >= _tofloat(b)
 
+    @functionBase.pure
     def lte(self, a, b):
         """
         Return ``True`` if ``a`` <= ``b``.
@@ -405,14 +426,16 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :type b: number
         :rtype: bool
         """
-        return float(a) <= float(b)
+        return _tofloat(a) <= _tofloat(b)
 
     # ----- Control Functions --------
 
+    @functionBase.pure
+    @functionBase.lazy("thenval", "elseval")
     def ifexpr(self, cond, thenval='', elseval=''):
         """
         If ``cond`` is equivalent to ``True``, then return ``thenval``, else
-        return ``elseval``.
+        return ``elseval``. Only the returned value is evaluated.
 
         :param cond: Condition
         :type cond: bool
@@ -420,26 +443,91 @@ class MiscFunctions(functionBase.PrmptFunctions):
         :param elseval: Value returned if condition is equivalent to ``False``, defaults to an empty string.
         """
         if _tobool(cond):
-            return thenval
+            return functionBase.force(thenval)
         else:
+            elseval = functionBase.force(elseval)
             if elseval:
                 return elseval
             else:
                 return str("")
 
+    @functionBase.pure
+    def segment(self, body, priority=0):
+        """
+        Return ``body``. At the top level of a prompt, segments are
+        rendered before the rest of the prompt, highest ``priority``
+        first. Once the render budget (``render`` in the ``[timeouts]``
+        section of the config) is nearly spent, the remaining segments
+        are skipped, and their last output in the same directory (if
+        any) is shown instead. Anything outside of a segment is always
+        rendered.
+
+        Example:
+
+        .. highlight:: python
+        .. code-block:: latex
+
+            \\segment[1]{\\repobranch}\\segment[-1]{\\hostname}\\workingdir\\dollar
+
+        :param priority: A number, defaults to 0
+        """
+        # Reported by the compiler if it is not a number
+        float(priority)
+        return body
+
+    @functionBase.pure
+    @functionBase.lazy()
+    def and_(self, *args):
+        """
+        Return ``True`` if all of the arguments are equivalent to ``True``.
+        Arguments are evaluated in order, stopping at the first one that
+        is equivalent to ``False``.
+
+        Example:
+
+        .. highlight:: python
+        .. code-block:: latex
+
+            \\ifexpr{\\and{\\isrepo}{\\isrepodirty}}{dirty}
+
+        :rtype: bool
+        """
+        for arg in args:
+            if not _tobool(functionBase.force(arg)):
+                return False
+        return True
+
+    @functionBase.pure
+    @functionBase.lazy()
+    def or_(self, *args):
+        """
+        Return ``True`` if any of the arguments are equivalent to ``True``.
+        Arguments are evaluated in order, stopping at the first one that
+        is equivalent to ``True``.
+
+        :rtype: bool
+        """
+        for arg in args:
+            if _tobool(functionBase.force(arg)):
+                return True
+        return False
+
     # ----- String Functions --------
+    @functionBase.pure
     def lower(self, literal):
         """
         Return a lowercase representation of ``literal``.
         """
         return str(literal).lower()
 
+    @functionBase.pure
     def upper(self, literal):
         """
         Return an uppercase representation of ``literal``.
         """
         return str(literal).upper()
 
+    @functionBase.pure
     def join(self, *args):
         """
         Join multiple strings together. The first argument is the delimiter, all subsequent
@@ -465,6 +553,7 @@ class MiscFunctions(functionBase.PrmptFunctions):
         args = args[1:]
         return str(delim).join(args)
 
+    @functionBase.stable
     def justify(self, left, centre, right, lpad=u" ", rpad=u" "):
         """
         Justify text in 3 columns to fill the terminal. Text in ``left`` will be
@@ -503,12 +592,14 @@ class MiscFunctions(functionBase.PrmptFunctions):
 
         return left + lpad*lpadsize + centre + rpad*rpadsize + right
 
+    @functionBase.stable
     def right(self, literal):
         """
         Justify string ``literal`` right.
         """
         return self.justify("", "", literal)
 
+    @functionBase.stable
     def smiley(self):
         """
         Generate a smiley that has the following properties:
@@ -529,12 +620,14 @@ class MiscFunctions(functionBase.PrmptFunctions):
         out += self.call("stopColour")
         return out
 
+    @functionBase.volatile
     def randomcolour(self, literal, seed=None):
         """
         Decorate ``literal`` with a random colour.
 
         :param seed: The random hash seed, to enable consistency between calls.
         """
+        import random
         if seed:
             random.seed(seed)
         colour = str(random.randrange(1, 255))
@@ -543,6 +636,7 @@ class MiscFunctions(functionBase.PrmptFunctions):
         out += self.call("stopColour")
         return out
 
+    @functionBase.stable
     def hashedcolour(self, literal):
         """
         Decorate ``literal`` with a colour based on its hash.
@@ -555,10 +649,23 @@ class MiscFunctions(functionBase.PrmptFunctions):
 # ============================================
 # Internal Functions
 # ============================================
+def _uncap(expr):
+    # A count over its limit is shown as e.g. "999+" (see
+    # prmpt.vcs.Count), but is still a number
+    expr = str(expr)
+    if expr.endswith("+"):
+        return expr[:-1]
+    return expr
+
+
+def _tofloat(expr):
+    return float(_uncap(expr))
+
+
 def _tobool(expr):
     # First try integer cast
     try:
-        return bool(int(expr))
+        return bool(int(_uncap(expr)))
     except ValueError:
         pass
 
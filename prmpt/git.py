@@ -9,22 +9,467 @@ import os
 import time
 
 from prmpt import vcs
+from prmpt import gitdir
 
 GIT_COMMAND = "git"
 
 
+class StatusParser(object):
+    """
+    A parser for the output of ``git status --porcelain=v2 --branch -z``.
+
+    The output is passed to :meth:`feed` in chunks as it is read, and
+    only the counts are kept, so memory use does not grow with the
+    number of paths. Call :meth:`close` once all of it has been fed.
+
+    See https://git-scm.com/docs/git-status#_porcelain_format_version_2
+    """
+    # Entries with no changes on one side have '.' in place of a status
+    STAGED = frozenset("MTADRC")
+    CHANGED = frozenset("MTD")
+
+    def __init__(self):
+        self.oid = ""
+        self.branch = ""
+        self.remoteBranch = ""
+        self.ahead = 0
+        self.behind = 0
+        self.staged = 0
+        self.changed = 0
+        self.untracked = 0
+        self.unmerged = 0
+        self._buffer = b""
+        # Renamed entries are followed by the original path
+        self._skipPath = False
+
+    def feed(self, chunk):
+        records = (self._buffer + chunk).split(b"\0")
+        # The last record is incomplete
+        self._buffer = records.pop()
+        for record in records:
+            self._parseRecord(record)
+
+    def close(self):
+        if self._buffer:
+            self._parseRecord(self._buffer)
+            self._buffer = b""
+
+    def _parseRecord(self, record):
+        if self._skipPath:
+            self._skipPath = False
+            return
+        kind = record[:1]
+        if kind == b"1" or kind == b"2":
+            # 1 XY sub mH mI mW hH hI path
+            # 2 XY sub mH mI mW hH hI Xscore path
+            xy = record[2:4].decode("ascii")
+            if xy[0] in self.STAGED:
+                self.staged += 1
+            if xy[1] in self.CHANGED:
+                self.changed += 1
+            self._skipPath = (kind == b"2")
+        elif kind == b"?":
+            self.untracked += 1
+        elif kind == b"u":
+            self.unmerged += 1
+        elif kind == b"#":
+            self._parseHeader(record[2:].decode("utf-8"))
+
+    def _parseHeader(self, header):
+        key, _, value = header.partition(" ")
+        if key == "branch.oid":
+            self.oid = "" if value == "(initial)" else value
+        elif key == "branch.head":
+            self.branch = "" if value == "(detached)" else value
+        elif key == "branch.upstream":
+            self.remoteBranch = value
+        elif key == "branch.ab":
+            ahead, behind = value.split()
+            self.ahead = int(ahead)
+            self.behind = -int(behind)
+
+    @property
+    def detached(self):
+        return not self.branch and bool(self.oid)
+
+
 class Git(vcs.VCSBase):
+    """
+    When the git directory can be read directly, only HEAD is read up
+    front. The attributes below are filled in when they are first used:
+    the ``INDEX_ATTRIBUTES`` from the index, and the
+    ``STATUS_ATTRIBUTES`` (or the index attributes, if the index cannot
+    be read) by running ``git status``.
+
+    Large repositories (by the number of files in the index, or the time
+    their status took last time, see :class:`prmpt.config.Config`) are
+    read with a single ``git status --untracked-files=no`` instead, as
+    looking for untracked files is often the slowest part. The
+    untracked files are counted by a full ``git status`` in the
+    background, at most every ``untrackedInterval`` seconds, and the
+    last count is shown in the meantime.
+
+    If ``git status`` is killed for taking too long, the status stored
+    last for the repository is shown. The time it took is recorded, so
+    the repository is treated as large the next time.
+    """
+    # .git is a directory, or a file pointing to one (worktrees and
+    # submodules)
+    MARKERS = (".git",)
+    ENVIRONMENT = ("GIT_DIR",)
+    # Never take locks that are not needed to read the status (git
+    # status would otherwise write back a refreshed index, and could
+    # make the user's own git commands fail with "index.lock exists")
+    COMMAND_ENVIRONMENT = {"GIT_OPTIONAL_LOCKS": "0"}
+
+    UNTRIGGERED = vcs.VCSBase.UNTRIGGERED + ("_openGitDir", "_startGitStatus")
+
+    INDEX_ATTRIBUTES = ("staged", "changed", "unmerged")
+    STATUS_ATTRIBUTES = ("remoteBranch", "untracked", "ahead", "behind", "installed")
+    GROUPS = (("index", INDEX_ATTRIBUTES), ("status", STATUS_ATTRIBUTES))
+    # The groups kept in the on-disk cache. The index is read without
+    # running git, and editing any tracked file changes its status
+    # without changing the fingerprint.
+    CACHED_GROUPS = ("status",)
+
     def __init__(self, status, cmd=GIT_COMMAND):
         super(Git, self).__init__(status, cmd)
+        self.gitDir = None
+        # The groups of attributes ("index", "status") not yet loaded
+        self.pending = set()
+        # Whether the repository is large, once it has been checked
+        self.large = None
+        # Seconds spent reading the status
+        self.statusTime = 0
+        # Raised for the attributes that could not be loaded because
+        # git status timed out
+        self.pendingTimeout = None
+        # From the watcher, when the status was first read
+        self.watchToken = None
+
+    def __getattribute__(self, name):
+        if name in Git.INDEX_ATTRIBUTES or name in Git.STATUS_ATTRIBUTES:
+            vcs.VCSBase.__getattribute__(self, "_loadPending")(name)
+        return vcs.VCSBase.__getattribute__(self, name)
+
+    def _loadPending(self, name):
+        index = "index" in self.pending and name in self.INDEX_ATTRIBUTES
+        if not index and not ("status" in self.pending and name in self.STATUS_ATTRIBUTES):
+            return
+        if self.pendingTimeout is not None:
+            raise self.pendingTimeout
+        if self.status.vcsWatcher is not None and self.watchToken is None:
+            # Anything that changes from now on may not be in the status
+            self.watchToken = self.status.vcsWatcher.startRead(
+                self.gitDir.workTree, self._gitDirs()
+            )
+        start = time.time()
+        pending = set(self.pending)
+        try:
+            if self._isLarge():
+                self.pending.clear()
+                self._runGitStatus(untracked=False)
+                self.untracked = self._countUntracked()
+                self._storeCache()
+                return
+            if index:
+                self.pending.discard("index")
+                try:
+                    self.staged, self.changed, self.unmerged = self.gitDir.indexStatus()
+                    self._storeCache()
+                    self._storeTime(start)
+                    return
+                except (gitdir.GitDirError, OSError, ValueError):
+                    pass
+            # Fall back to git status
+            self.pending.clear()
+            self._runGitStatus()
+            self._storeCache()
+            self._storeTime(start)
+        except vcs.CommandTimeout as e:
+            self._loadAfterTimeout(e, start, pending)
+            vcs.VCSBase.__getattribute__(self, "_loadPending")(name)
+
+    def _loadAfterTimeout(self, timeout, start, pending):
+        """
+        Fill in the ``pending`` groups of attributes from the status
+        stored last (or the index), after ``timeout`` was raised while
+        reading them. Any that cannot be filled in raise ``timeout``
+        when they are used.
+        """
+        self.pendingTimeout = timeout
+        self.pending = pending
+        self._loadCache("git status timed out")
+        if "index" in self.pending:
+            try:
+                self.staged, self.changed, self.unmerged = self.gitDir.indexStatus()
+                self.pending.discard("index")
+            except (gitdir.GitDirError, OSError, ValueError):
+                pass
+        self._storeTime(start)
+
+    def _isLarge(self):
+        if self.large is None:
+            config = self.status.config
+            stats = self._getStats()
+            self.large = bool(
+                (config.largeRepoFiles > 0 and
+                 self.gitDir.indexEntryCount() >= config.largeRepoFiles) or
+                (config.largeRepoTime > 0 and
+                 stats.get("statusTime", 0) >= config.largeRepoTime)
+            )
+        return self.large
+
+    def _getStats(self):
+        if self.status.repoStats is None:
+            return {}
+        return self.status.repoStats.get(self.gitDir.workTree)
+
+    def _storeTime(self, start):
+        """
+        Record the time spent reading the status since ``start``, which
+        is used to decide whether the repository is large next time.
+        """
+        self.statusTime += time.time() - start
+        if self.status.repoStats is not None and \
+                (not self.pending or self.pendingTimeout is not None):
+            stats = self._getStats()
+            stats["statusTime"] = self.statusTime
+            self.status.repoStats.set(self.gitDir.workTree, stats)
+
+    def _countUntracked(self):
+        """
+        Get the number of untracked files from the last background
+        ``git status`` (0 until the first has finished), and start
+        another if that was ``untrackedInterval`` seconds ago.
+        """
+        repoStats = self.status.repoStats
+        if repoStats is None:
+            return 0
+        root = self.gitDir.workTree
+        stats = repoStats.get(root)
+        outputFile = repoStats.filename(root) + ".untracked"
+        modified = False
 
-    def _runStatus(self):
         try:
-            (stdout, stderr, returncode) = self.runCommand(
-                [self.command, "status", "--porcelain", "-b"]
+            finished = os.path.getmtime(outputFile)
+            parser = StatusParser()
+            with open(outputFile, "rb") as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    parser.feed(chunk)
+            parser.close()
+            os.remove(outputFile)
+        except (IOError, OSError):
+            pass
+        else:
+            stats["untracked"] = parser.untracked
+            stats["untrackedTime"] = finished
+            started = stats.pop("untrackedStarted", None)
+            if started is not None:
+                # A full status, so it shows whether the repository is
+                # still large
+                stats["statusTime"] = finished - started
+            modified = True
+
+        now = time.time()
+        interval = self.status.config.untrackedInterval
+        started = stats.get("untrackedStarted")
+        if now - stats.get("untrackedTime", 0) >= interval and \
+                (started is None or not 0 <= now - started < interval):
+            command = [self.command, "status", "--porcelain=v2", "-z"]
+            self.startBackground(command, outputFile, root)
+            stats["untrackedStarted"] = now
+            modified = True
+
+        if modified:
+            repoStats.set(root, stats)
+        return stats.get("untracked", 0)
+
+    def fingerprint(self):
+        """
+        The size and modification time of the index, HEAD, the current
+        branch, FETCH_HEAD and the top of the work tree.
+        """
+        if self.gitDir is None:
+            return None
+        gitDir = self.gitDir
+        files = [
+            os.path.join(gitDir.gitDir, "index"),
+            os.path.join(gitDir.gitDir, "HEAD"),
+            os.path.join(gitDir.gitDir, "FETCH_HEAD"),
+            os.path.join(gitDir.commonDir, "packed-refs"),
+            gitDir.workTree,
+        ]
+        try:
+            ref = gitDir.readHead()[0]
+        except gitdir.GitDirError:
+            return None
+        if ref is not None:
+            files.append(os.path.join(gitDir.gitDir, ref))
+            files.append(os.path.join(gitDir.commonDir, ref))
+        fingerprint = []
+        for filename in files:
+            try:
+                st = os.stat(filename)
+                fingerprint.append((st.st_mtime, st.st_size))
+            except OSError:
+                fingerprint.append(None)
+        return tuple(fingerprint)
+
+    def _cacheKey(self):
+        if self.status.vcsCache is None:
+            return None
+        fingerprint = self.fingerprint()
+        if fingerprint is None:
+            return None
+        return self.status.vcsCache.makeKey(self.gitDir.workTree, fingerprint)
+
+    def _gitDirs(self):
+        return sorted(set([self.gitDir.gitDir, self.gitDir.commonDir]))
+
+    def _isLocked(self):
+        """
+        Whether a git command is changing the index right now.
+        """
+        return os.path.exists(os.path.join(self.gitDir.gitDir, "index.lock"))
+
+    def _loadCache(self, staleReason=None):
+        """
+        Fill in any groups of attributes that a previous prompt stored
+        for the repository as it is now. If there is a ``staleReason``
+        (e.g. the index is locked, so the repository is part way through
+        changing), whatever was stored last is used instead.
+
+        Only the ``CACHED_GROUPS`` are taken from the on-disk cache; the
+        watcher sees every change to the work tree, so it keeps them all.
+        """
+        stale = staleReason is not None
+        data = None
+        groups = [group for group, names in self.GROUPS]
+        if self.status.vcsWatcher is not None:
+            data = self.status.vcsWatcher.lookup(self.gitDir.workTree, stale)
+        if data is None:
+            key = self._cacheKey()
+            if key is None:
+                return
+            with self.status.timer.phase("vcs cache"):
+                data = self.status.vcsCache.load(key, stale)
+            if data is None:
+                return
+            groups = self.CACHED_GROUPS
+        if stale:
+            self.status.timer.info["vcs"] = "stale (%s)" % staleReason
+        for group, names in self.GROUPS:
+            if group in self.pending and group in groups and \
+                    all(name in data for name in names):
+                for name in names:
+                    setattr(self, name, data[name])
+                self.pending.discard(group)
+
+    def _storeCache(self):
+        data = {}
+        for group, names in self.GROUPS:
+            if group not in self.pending:
+                for name in names:
+                    data[name] = object.__getattribute__(self, name)
+        if self.status.vcsWatcher is not None:
+            self.status.vcsWatcher.store(
+                self.gitDir.workTree, self._gitDirs(), data, self.watchToken
             )
-            (rstdout, rstderr, rreturncode) = self.runCommand(
+        key = self._cacheKey()
+        if key is not None:
+            cached = {}
+            for group, names in self.GROUPS:
+                if group in self.CACHED_GROUPS and group not in self.pending:
+                    for name in names:
+                        cached[name] = data[name]
+            if cached:
+                self.status.vcsCache.store(key, cached)
+
+    def _openGitDir(self):
+        """
+        Get a :class:`gitdir.GitDir` reader for the working directory,
+        or ``None`` if the repository has to be queried by running git.
+        """
+        if os.environ.get("GIT_DIR"):
+            # The repository could be anywhere
+            return None
+        try:
+            reader = gitdir.GitDir.find(self.status.getWorkingDir())
+            if reader is not None:
+                # Fail now, rather than half way through parsing
+                reader.readHead()
+            return reader
+        except (gitdir.GitDirError, OSError, ValueError):
+            return None
+
+    def _runStatus(self):
+        self.gitDir = self._openGitDir()
+        self.pending = set()
+        self.watchToken = None
+        if self.gitDir is not None and self._readHead():
+            self.isRepo = True
+            self.pending = set(["index", "status"])
+            self._loadCache("index.lock exists" if self._isLocked() else None)
+        else:
+            self._runGitStatus()
+
+    def _readHead(self):
+        """
+        Set the branch and commit from HEAD, and the details that would
+        otherwise need ``git rev-parse``. Returns ``False`` if git has
+        to be run instead.
+        """
+        try:
+            ref, oid = self.gitDir.readHead()
+            self.commit = self.gitDir.abbrev(oid)
+            if ref is None:
+                self.branch = self._git_tags(oid) or '#' + self.commit
+            elif ref.startswith("refs/heads/"):
+                self.branch = ref[len("refs/heads/"):]
+            else:
+                self.branch = ref
+        except (gitdir.GitDirError, OSError, ValueError):
+            return False
+        self._read_git_dir()
+        return self.gitDir is not None
+
+    def prefetch(self):
+        """
+        Start ``git status`` (and ``git rev-parse``, if needed) unless
+        the git directory can be read without them.
+        """
+        if self._openGitDir() is None:
+            self.started = (self.status.getWorkingDir(), self._startGitStatus(True))
+
+    def _startGitStatus(self, revParse, untracked=True):
+        """
+        Start the commands that _runGitStatus() needs, all at once.
+        """
+        parser = StatusParser()
+        command = [self.command, "status", "--porcelain=v2", "--branch", "-z"]
+        if not untracked:
+            command.append("--untracked-files=no")
+        statusCommand = self.startCommand(command, parser.feed)
+        revParseCommand = None
+        if revParse:
+            # Only needed for the relative root
+            revParseCommand = self.startCommand(
                 [self.command, "rev-parse", "--show-cdup", "--verify", "--short", "HEAD"]
             )
+        return parser, statusCommand, revParseCommand
+
+    def _runGitStatus(self, untracked=True):
+        started = self.takeStarted()
+        if started is None or (started[2] is None) != (self.gitDir is not None) or not untracked:
+            started = self._startGitStatus(self.gitDir is None, untracked)
+        parser, statusCommand, revParseCommand = started
+        rreturncode = None
+        try:
+            (stderr, returncode) = statusCommand.result()
+            parser.close()
+            if revParseCommand is not None:
+                (rstdout, rstderr, rreturncode) = revParseCommand.result()
         except OSError:
             # Git command not found
             self.installed = False
@@ -35,16 +480,16 @@ class Git(vcs.VCSBase):
             # Successful git status call
             self.installed = True
             self.isRepo = True
-            (self.branch,
-             self.remoteBranch,
-             self.staged,
-             self.changed,
-             self.untracked,
-             self.unmerged,
-             self.ahead,
-             self.behind) = self._git_status(stdout)
+            self.branch = parser.branch
+            self.remoteBranch = parser.remoteBranch
+            self.staged = parser.staged
+            self.changed = parser.changed
+            self.untracked = parser.untracked
+            self.unmerged = parser.unmerged
+            self.ahead = parser.ahead
+            self.behind = parser.behind
         else:
-            if "Not a git repository" in stderr:
+            if "Not a git repository" in stderr or "not a git repository" in stderr:
                 # The directory is not a git repo
                 self.installed = True
                 self.isRepo = False
@@ -53,105 +498,65 @@ class Git(vcs.VCSBase):
                 self.installed = False
                 self.isRepo = False
 
-        if rreturncode == 0:
+        if self.gitDir is not None:
+            self._read_git_dir()
+        if self.gitDir is None and rreturncode == 0:
             # Successful git status call
             self.relative_root, self.commit = rstdout.split('\n')[:-1]
 
             if self.installed and self.isRepo:
                 self._run_get_last_fetch()
 
-    def _run_get_last_fetch(self):
-        fetch_file = os.path.join(self.relative_root, '.git/FETCH_HEAD')
-        if not os.path.exists(fetch_file):
-            fetch_file = os.path.join(self.relative_root, '.git/HEAD')
-        if not os.path.exists(fetch_file):
-            self.last_fetched = 0
-        else:
-            self.last_fetched = int(time.time() - os.path.getmtime(fetch_file))
-
-    def _git_status(self, result):
-        """
-        Originally taken from https://github.com/dreadatour/dotfiles
+        if self.isRepo and parser.oid:
+            self.commit = self._abbrev(parser.oid)
+            if parser.detached:
+                self.branch = self._git_tags(parser.oid) or '#' + self.commit
 
-        Get git status.
-        """
-        branch = remote_branch = ''
-        staged = changed = untracked = unmerged = ahead = behind = 0
-        for line in result.splitlines():
-            line = line
-            prefix = line[0:2]
-            line = line[3:]
+    def _abbrev(self, oid):
+        if self.gitDir is not None:
+            try:
+                return self.gitDir.abbrev(oid)
+            except (gitdir.GitDirError, OSError, ValueError):
+                pass
+        if self.commit and oid.startswith(self.commit):
+            # From rev-parse, which knows how long it should be
+            return self.commit
+        return oid[:gitdir.MIN_ABBREV]
 
-            if prefix == '##':  # branch name + ahead & behind info
-                branch, remote_branch, ahead, behind = self._parse_git_branch(line)
-            elif prefix == '??':  # untracked file
-                untracked += 1
-            elif prefix in ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU'):  # unmerged
-                unmerged += 1
-            else:
-                if prefix[0] in ('M', 'A', 'D', 'R', 'C'):  # changes in index
-                    staged += 1
-                if prefix[1] in ('M', 'D'):  # changes in work tree
-                    changed += 1
-
-        return (branch, remote_branch, staged, changed, untracked, unmerged,
-                ahead, behind)
-
-    def _parse_git_branch(self, line):
+    def _read_git_dir(self):
         """
-        Originally taken from https://github.com/dreadatour/dotfiles
-
-        Parse 'git status -b --porcelain' command branch info output.
-
-        Possible strings:
-        - simple: "## dev"
-        - detached: "## HEAD (no branch)"
-        - ahead/behind: "## master...origin/master [ahead 1, behind 2]"
-
-        Ahead/behind format:
-        - [ahead 1]
-        - [behind 1]
-        - [ahead 1, behind 1]
+        Set the relative root and last fetch time from the files in the
+        git directory.
         """
-        branch = remote_branch = ''
-        ahead = behind = 0
+        try:
+            self.relative_root = self.gitDir.relativeRoot(self.status.getWorkingDir())
+            fetched = self.gitDir.lastFetchedTime()
+        except (gitdir.GitDirError, OSError, ValueError):
+            self.gitDir = None
+            return
+        if fetched is not None:
+            self.last_fetched = int(time.time() - fetched)
 
-        if line == 'HEAD (no branch)':  # detached state
-            # Get tag
-            branch = self._git_tags()
-            if not branch:
-                branch = '#' + self._git_commit()
-        elif '...' in line:  # ahead of or behind remote branch
-            if ' ' in line:
-                branches, ahead_behind = line.split(' ', 1)
-            else:
-                branches, ahead_behind = line, None
-            branch, remote_branch = branches.split('...')
-
-            if ahead_behind and ahead_behind[0] == '[' and ahead_behind[-1] == ']':
-                ahead_behind = ahead_behind[1:-1]
-                for state in ahead_behind.split(', '):
-                    if state.startswith('ahead '):
-                        ahead = int(state[6:])
-                    elif state.startswith('behind '):
-                        behind = int(state[7:])
+    def _run_get_last_fetch(self):
+        gitPath = os.path.join(self.status.getWorkingDir(), self.relative_root, '.git')
+        fetch_file = os.path.join(gitPath, 'FETCH_HEAD')
+        if not os.path.exists(fetch_file):
+            fetch_file = os.path.join(gitPath, 'HEAD')
+        if not os.path.exists(fetch_file):
+            self.last_fetched = 0
         else:
-            branch = line
-
-        return branch, remote_branch, ahead, behind
-
-    def _git_commit(self):
-        """
-        Originally taken from https://github.com/dreadatour/dotfiles
-
-        Get git HEAD commit hash.
-        """
-        git_cmd = [self.command, 'rev-parse', '--short', 'HEAD']
-        return self.runCommand(git_cmd)[0].strip()
+            self.last_fetched = int(time.time() - os.path.getmtime(fetch_file))
 
-    def _git_tags(self):
+    def _git_tags(self, oid=None):
         """
-        Gets any tags associated with the current HEAD
+        Gets any tags associated with the current HEAD (or commit
+        ``oid``)
         """
-        git_cmd = [self.command, 'tag', '--points-at', 'HEAD']
+        if self.gitDir is not None:
+            try:
+                commit = oid or self.gitDir.readHead()[1]
+                return ", ".join(self.gitDir.tagsAt(commit)) if commit else ""
+            except (gitdir.GitDirError, OSError, ValueError):
+                pass
+        git_cmd = [self.command, 'tag', '--points-at', oid or 'HEAD']
         return ", ".join(line.strip() for line in self.runCommand(git_cmd)[0].strip().splitlines())
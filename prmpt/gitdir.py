@@ -0,0 +1,965 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+"""
+Read git repository metadata (branch, commit, tags) directly from the
+files in ``.git``, so that no git process needs to be started.
+
+Only the common on-disk layouts are understood. Anything else (for
+example the reftable ref storage) raises :class:`GitDirError`, and the
+caller should fall back to running git.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import io
+import stat
+import time
+import zlib
+import mmap
+import struct
+import hashlib
+import binascii
+import threading
+from collections import OrderedDict
+
+# Length of a full SHA-1 object name in hex
+SHA_LENGTH = 40
+
+# Shortest abbreviated object name that git will use
+MIN_ABBREV = 7
+
+_HEX = frozenset("0123456789abcdef")
+
+# Most files, and bytes, hashed to check for changes in one read of the
+# index. The index is never refreshed (git runs without optional locks),
+# so files whose stat data is out of date would otherwise be hashed on
+# every prompt, and beyond this git status is quicker.
+MAX_HASHED_FILES = 256
+MAX_HASHED_BYTES = 16*1024*1024
+
+# Most hashes remembered, by the path and stat data of the file
+HASH_CACHE_SIZE = 4096
+
+_hashCache = OrderedDict()
+_hashCacheLock = threading.Lock()
+
+
+class GitDirError(Exception):
+    """
+    The repository cannot be read without running git.
+    """
+    pass
+
+
+def _isSha(value):
+    return len(value) == SHA_LENGTH and _HEX.issuperset(value)
+
+
+def _readFile(filename):
+    """
+    Get the stripped contents of a small text file, or ``None`` if it
+    does not exist.
+    """
+    try:
+        with io.open(filename, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def findWorkTree(path):
+    """
+    Get the (work tree, .git path) of the repository containing
+    ``path``, or ``None``.
+    """
+    path = os.path.realpath(path)
+    while True:
+        dotGit = os.path.join(path, ".git")
+        if os.path.exists(dotGit):
+            return path, dotGit
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+class GitDir(object):
+    """
+    A git repository on disk.
+
+    :param workTree: The top level directory of the working tree.
+    :param dotGit: The ``.git`` directory, or a gitfile pointing to the
+                   real git directory (as used by worktrees and
+                   submodules).
+    """
+    def __init__(self, workTree, dotGit):
+        self.workTree = workTree
+        self.gitDir = self._resolveGitFile(dotGit)
+        # Linked worktrees share refs with the main repository
+        commonDir = _readFile(os.path.join(self.gitDir, "commondir"))
+        if commonDir:
+            self.commonDir = os.path.normpath(os.path.join(self.gitDir, commonDir))
+        else:
+            self.commonDir = self.gitDir
+        self.config = self._readConfig(os.path.join(self.commonDir, "config"))
+        if self.config.get(("extensions", "refstorage"), "files") != "files":
+            raise GitDirError("unsupported ref storage")
+        self._packedRefs = None
+        self._fullyPeeled = False
+        self._packs = None
+
+    @classmethod
+    def find(cls, path):
+        """
+        Get the repository containing ``path``, or ``None``.
+        """
+        found = findWorkTree(path)
+        if found is None:
+            return None
+        return cls(*found)
+
+    @staticmethod
+    def _resolveGitFile(dotGit):
+        if os.path.isdir(dotGit):
+            return dotGit
+        contents = _readFile(dotGit)
+        if not contents or not contents.startswith("gitdir:"):
+            raise GitDirError("invalid gitfile %s" % dotGit)
+        gitDir = contents[len("gitdir:"):].strip()
+        gitDir = os.path.normpath(os.path.join(os.path.dirname(dotGit), gitDir))
+        if not os.path.isdir(gitDir):
+            raise GitDirError("missing git directory %s" % gitDir)
+        return gitDir
+
+    @staticmethod
+    def _readConfig(filename):
+        """
+        Read the simple ``key = value`` entries of a git config file
+        into a dictionary keyed on (section, key), both in lower case.
+        Subsections are ignored.
+        """
+        config = {}
+        section = None
+        try:
+            with io.open(filename, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return config
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in "#;":
+                continue
+            if line[0] == "[":
+                name = line[1:line.find("]")].strip()
+                section = None if '"' in name else name.lower()
+            elif section is not None and "=" in line:
+                key, value = line.split("=", 1)
+                config[(section, key.strip().lower())] = value.strip().strip('"').lower()
+        return config
+
+    # ------------------------
+    # Refs
+    # ------------------------
+    def readHead(self):
+        """
+        Get the ref that HEAD points to (e.g. ``refs/heads/master``)
+        and the commit it resolves to. The ref is ``None`` if HEAD is
+        detached, and the commit is ``None`` on an unborn branch.
+        """
+        head = _readFile(os.path.join(self.gitDir, "HEAD"))
+        if head is None:
+            raise GitDirError("missing HEAD")
+        if head.startswith("ref:"):
+            ref = head[4:].strip()
+            return ref, self.resolveRef(ref)
+        if _isSha(head):
+            return None, head
+        raise GitDirError("invalid HEAD")
+
+    def resolveRef(self, ref, depth=0):
+        """
+        Get the object name that ``ref`` points to, or ``None``.
+        """
+        if depth > 5:
+            raise GitDirError("symbolic ref loop")
+        for directory in (self.gitDir, self.commonDir):
+            value = _readFile(os.path.join(directory, ref))
+            if value is None:
+                continue
+            if value.startswith("ref:"):
+                return self.resolveRef(value[4:].strip(), depth+1)
+            if _isSha(value):
+                return value
+            raise GitDirError("invalid ref %s" % ref)
+        return self.getPackedRefs()[0].get(ref)
+
+    def getPackedRefs(self):
+        """
+        Get two dictionaries from ``packed-refs``: ref name to object
+        name, and ref name to peeled object name (the commit an
+        annotated tag points to).
+
+        Unless the file is ``fully-peeled``, a packed tag without a
+        peeled line may still be an annotated tag.
+        """
+        if self._packedRefs is None:
+            refs = {}
+            peeled = {}
+            self._fullyPeeled = False
+            try:
+                with io.open(os.path.join(self.commonDir, "packed-refs"), "r", encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+            except (IOError, OSError):
+                lines = []
+            ref = None
+            for line in lines:
+                if not line:
+                    continue
+                if line[0] == "#":
+                    if line.startswith("# pack-refs with:") and "fully-peeled" in line.split():
+                        self._fullyPeeled = True
+                    continue
+                if line[0] == "^":
+                    if ref is not None:
+                        peeled[ref] = line[1:]
+                    continue
+                sha, _, ref = line.partition(" ")
+                if not _isSha(sha):
+                    raise GitDirError("invalid packed-refs")
+                refs[ref] = sha
+            self._packedRefs = (refs, peeled)
+        return self._packedRefs
+
+    def getTags(self):
+        """
+        Get a dictionary of tag name to (object name, peeled object
+        name). The peeled name is ``None`` if it is not yet known.
+        """
+        prefix = "refs/tags/"
+        refs, peeled = self.getPackedRefs()
+        tags = {}
+        for ref, sha in refs.items():
+            if ref.startswith(prefix):
+                if ref in peeled:
+                    tags[ref[len(prefix):]] = (sha, peeled[ref])
+                elif self._fullyPeeled:
+                    tags[ref[len(prefix):]] = (sha, sha)
+                else:
+                    tags[ref[len(prefix):]] = (sha, None)
+        # Loose refs take precedence
+        tagDir = os.path.join(self.commonDir, "refs", "tags")
+        for root, _, files in os.walk(tagDir):
+            for name in files:
+                sha = _readFile(os.path.join(root, name))
+                if sha and _isSha(sha):
+                    tag = os.path.relpath(os.path.join(root, name), tagDir)
+                    tags[tag.replace(os.sep, "/")] = (sha, None)
+        return tags
+
+    def tagsAt(self, commit):
+        """
+        Get the sorted names of the tags that point at ``commit``.
+        """
+        found = []
+        for tag, (sha, peeled) in self.getTags().items():
+            if sha == commit:
+                found.append(tag)
+            elif peeled is None and self._peelTag(sha) == commit:
+                found.append(tag)
+            elif peeled == commit:
+                found.append(tag)
+        return sorted(found)
+
+    def _peelTag(self, sha):
+        """
+        Get the object an annotated tag points to, or ``None`` if
+        ``sha`` is not an annotated tag.
+        """
+        kind, data = self.readObject(sha)
+        if kind != "tag" or not data.startswith(b"object "):
+            return None
+        return data[7:7+SHA_LENGTH].decode("ascii")
+
+    # ------------------------
+    # Objects
+    # ------------------------
+    def readObject(self, sha):
+        """
+        Get the type (e.g. ``"tree"``) and contents of an object,
+        whether it is loose or in a pack.
+        """
+        objectFile = os.path.join(self.commonDir, "objects", sha[:2], sha[2:])
+        try:
+            with open(objectFile, "rb") as f:
+                data = zlib.decompress(f.read())
+        except (IOError, OSError):
+            pass
+        except zlib.error:
+            raise GitDirError("corrupt object %s" % sha)
+        else:
+            header, _, body = data.partition(b"\0")
+            return header.split(b" ")[0].decode("ascii"), body
+
+        binSha = binascii.unhexlify(sha)
+        for pack in self.getPacks():
+            offset = pack.find(binSha)
+            if offset is not None:
+                return pack.readObject(offset, self.readObject)
+        raise GitDirError("missing object %s" % sha)
+
+    def getPacks(self):
+        if self._packs is None:
+            packDir = os.path.join(self.commonDir, "objects", "pack")
+            try:
+                names = sorted(os.listdir(packDir))
+            except OSError:
+                names = []
+            self._packs = [Pack(os.path.join(packDir, name[:-4]))
+                           for name in names if name.endswith(".idx")]
+        return self._packs
+
+    def readTree(self, sha, prefix=b""):
+        """
+        Get a list of the (path, mode, binary object name) of each entry
+        in a tree. Paths are bytes, with ``prefix`` added to each.
+        """
+        kind, data = self.readObject(sha)
+        if kind != "tree":
+            raise GitDirError("%s is not a tree" % sha)
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            mode = int(data[pos:space], 8)
+            entries.append((prefix + data[space+1:nul], mode, data[nul+1:nul+21]))
+            pos = nul + 21
+        return entries
+
+    def commitTree(self, commit):
+        """
+        Get the tree of a commit.
+        """
+        kind, data = self.readObject(commit)
+        if kind != "commit" or not data.startswith(b"tree "):
+            raise GitDirError("%s is not a commit" % commit)
+        return data[5:5+SHA_LENGTH].decode("ascii")
+
+    # ------------------------
+    # Index
+    # ------------------------
+    def readIndex(self):
+        """
+        Get the :class:`GitIndex` of the repository. Raises
+        :class:`GitDirError` if its layout is not supported, or if git
+        would run files through filters (e.g. line ending conversion)
+        before comparing them, as the counts could then be wrong.
+        """
+        if self.config.get(("core", "sparsecheckout")) == "true":
+            raise GitDirError("sparse checkout")
+        config = dict(self._readGlobalConfig())
+        config.update(self.config)
+        if config.get(("core", "autocrlf"), "false") != "false" or ("core", "eol") in config:
+            raise GitDirError("line ending conversion")
+        if ("core", "attributesfile") in config or \
+                os.path.exists(os.path.join(self.commonDir, "info", "attributes")):
+            raise GitDirError("attributes")
+        self.fileMode = config.get(("core", "filemode"), "true") == "true"
+        index = GitIndex(os.path.join(self.gitDir, "index"))
+        if index.hasAttributes:
+            raise GitDirError("attributes")
+        return index
+
+    @classmethod
+    def _readGlobalConfig(cls):
+        config = {}
+        home = os.path.expanduser("~")
+        xdg = os.environ.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")
+        if os.path.exists(os.path.join(xdg, "git", "attributes")):
+            config[("core", "attributesfile")] = os.path.join(xdg, "git", "attributes")
+        for filename in (os.path.join(xdg, "git", "config"), os.path.join(home, ".gitconfig")):
+            config.update(cls._readConfig(filename))
+        return config
+
+    def indexStatus(self):
+        """
+        Get the number of staged, changed and unmerged files, as
+        ``git status`` would count them, from the index, the HEAD tree
+        and the stat data of the files in the work tree.
+        """
+        index = self.readIndex()
+        staged = self._countStaged(index)
+        changed = self._countChanged(index)
+        return staged, changed, len(index.unmerged)
+
+    def _countStaged(self, index):
+        head = {}
+        # Directories where the index matches HEAD
+        clean = set()
+
+        def walk(binTree, directory):
+            if index.cacheTree.get(directory) == binTree:
+                clean.add(directory)
+                return
+            sha = binascii.hexlify(binTree).decode("ascii")
+            prefix = directory + b"/" if directory else b""
+            for path, mode, binSha in self.readTree(sha, prefix):
+                if mode == 0o40000:
+                    walk(binSha, path)
+                else:
+                    head[path] = (mode, binSha)
+
+        commit = self.readHead()[1]
+        if commit is not None:
+            walk(binascii.unhexlify(self.commitTree(commit)), b"")
+        if b"" in clean:
+            return 0
+
+        staged = 0
+        added = {}
+        for path, mode, binSha in index.iterMerged():
+            if clean and self._inClean(path, clean):
+                continue
+            try:
+                if head.pop(path) != (mode, binSha):
+                    staged += 1
+            except KeyError:
+                added[binSha] = added.get(binSha, 0) + 1
+        deleted = {}
+        for path, (mode, binSha) in head.items():
+            if path not in index.unmerged:
+                deleted[binSha] = deleted.get(binSha, 0) + 1
+
+        # git status pairs up renamed files, and counts each pair once
+        for binSha, count in list(added.items()):
+            renamed = min(count, deleted.get(binSha, 0))
+            if renamed:
+                staged += renamed
+                added[binSha] -= renamed
+                deleted[binSha] -= renamed
+        addedCount = sum(added.values())
+        deletedCount = sum(deleted.values())
+        if addedCount and deletedCount:
+            # These could be renames with changes, which git would
+            # detect by comparing the contents
+            raise GitDirError("possible renames")
+        return staged + addedCount + deletedCount
+
+    @staticmethod
+    def _inClean(path, clean):
+        while True:
+            path = path.rpartition(b"/")[0]
+            if path in clean:
+                return True
+            if not path:
+                return False
+
+    def _countChanged(self, index):
+        workTree = self.workTree
+        if not isinstance(workTree, bytes):
+            workTree = workTree.encode("utf-8")
+        self._hashBudget = [MAX_HASHED_FILES, MAX_HASHED_BYTES]
+        changed = 0
+        for entry in index.iterStats():
+            path = os.path.join(workTree, entry[0])
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # Deleted
+                changed += 1
+                continue
+            if self._isChanged(index, entry, path, st):
+                changed += 1
+        return changed
+
+    def _isChanged(self, index, entry, path, st):
+        (_, ctime, ctimeNs, mtime, mtimeNs, _, ino, mode, uid, gid, size, binSha) = entry
+        if mode == 0o160000:
+            # Submodules need their own status
+            raise GitDirError("submodule")
+        if stat.S_ISLNK(st.st_mode) != (mode == 0o120000):
+            return True
+        if self.fileMode and not stat.S_ISLNK(st.st_mode) and \
+                bool(st.st_mode & stat.S_IXUSR) != bool(mode & stat.S_IXUSR):
+            return True
+        if size != st.st_size & 0xffffffff:
+            return True
+        mtimeNow = int(st.st_mtime)
+        if (mtime == mtimeNow and
+                ctime == int(st.st_ctime) and
+                (not mtimeNs or mtimeNs == _nanoseconds(st, "st_mtime")) and
+                (not ctimeNs or ctimeNs == _nanoseconds(st, "st_ctime")) and
+                ino == st.st_ino & 0xffffffff and
+                uid == st.st_uid and gid == st.st_gid and
+                mtime < int(index.mtime)):
+            # Unchanged (and not modified in the same second that the
+            # index was written, which git calls "racily clean")
+            return False
+        # The stat data is out of date, so compare the contents
+        return self._hashFile(path, st) != binSha
+
+    def _hashFile(self, path, st):
+        """
+        Get the object name of the file at ``path`` with the stat data
+        ``st``, remembered from a previous read if it has not changed
+        since. Raises :class:`GitDirError` once too many files have been
+        hashed.
+        """
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime,
+               _nanoseconds(st, "st_mtime"), _nanoseconds(st, "st_ctime"))
+        with _hashCacheLock:
+            binSha = _hashCache.get(key)
+        if binSha is not None:
+            return binSha
+
+        self._hashBudget[0] -= 1
+        self._hashBudget[1] -= st.st_size
+        if self._hashBudget[0] < 0 or self._hashBudget[1] < 0:
+            raise GitDirError("too many files to hash")
+        binSha = _hashFile(path, st)
+        # Unless it could be changed again in the same second, without
+        # changing its stat data (git's "racily clean" entries)
+        if int(st.st_mtime) < int(time.time()):
+            with _hashCacheLock:
+                _hashCache[key] = binSha
+                while len(_hashCache) > HASH_CACHE_SIZE:
+                    _hashCache.popitem(False)
+        return binSha
+
+    # ------------------------
+    # Other details
+    # ------------------------
+    def abbrevLength(self):
+        """
+        The length git uses for abbreviated object names. As with git's
+        default (``core.abbrev=auto``) this grows with the number of
+        objects in the repository's packs.
+        """
+        abbrev = self.config.get(("core", "abbrev"), "auto")
+        if abbrev == "no":
+            return SHA_LENGTH
+        try:
+            return max(MIN_ABBREV, min(SHA_LENGTH, int(abbrev)))
+        except ValueError:
+            pass
+
+        count = 0
+        packDir = os.path.join(self.commonDir, "objects", "pack")
+        try:
+            names = os.listdir(packDir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith(".idx"):
+                continue
+            try:
+                with open(os.path.join(packDir, name), "rb") as f:
+                    header = f.read(8 + 256*4)
+            except (IOError, OSError):
+                continue
+            if len(header) == 8 + 256*4 and header[:4] == b"\377tOc":
+                # The last fan-out entry is the number of objects
+                count += struct.unpack(">I", header[-4:])[0]
+        if count == 0:
+            return MIN_ABBREV
+        # Enough hex digits for half the bits in the count, rounded up
+        bits = count.bit_length()
+        return max(MIN_ABBREV, (bits + 1) // 2)
+
+    def indexEntryCount(self):
+        """
+        The number of entries in the index, read from its header alone,
+        or 0 if there is no index.
+        """
+        try:
+            with open(os.path.join(self.gitDir, "index"), "rb") as f:
+                header = f.read(12)
+        except (IOError, OSError):
+            return 0
+        if len(header) < 12 or header[:4] != b"DIRC":
+            return 0
+        return struct.unpack(">I", header[8:])[0]
+
+    def abbrev(self, sha):
+        if sha is None:
+            return ""
+        return sha[:self.abbrevLength()]
+
+    def relativeRoot(self, path):
+        """
+        The path from ``path`` to the top of the work tree, in the form
+        given by ``git rev-parse --show-cdup`` (e.g. ``../../``).
+        """
+        rel = os.path.relpath(self.workTree, os.path.realpath(path))
+        if rel == os.curdir:
+            return ""
+        return rel + "/"
+
+    def lastFetchedTime(self):
+        """
+        The modification time of ``FETCH_HEAD`` (or ``HEAD`` if the
+        repository has never been fetched), or ``None``.
+        """
+        for name in ("FETCH_HEAD", "HEAD"):
+            for directory in (self.gitDir, self.commonDir):
+                try:
+                    return os.path.getmtime(os.path.join(directory, name))
+                except OSError:
+                    pass
+        return None
+
+
+def _nanoseconds(st, name):
+    nanoseconds = getattr(st, name + "_ns", None)
+    if nanoseconds is None:
+        return int(getattr(st, name) * 1e9) % 1000000000
+    return nanoseconds % 1000000000
+
+
+def _hashFile(path, st):
+    """
+    Get the binary object name that the file at ``path`` would have if
+    it was added to the index.
+    """
+    if stat.S_ISLNK(st.st_mode):
+        data = os.readlink(path)
+        sha = hashlib.sha1(("blob %d\0" % len(data)).encode("ascii"))
+        sha.update(data)
+        return sha.digest()
+    sha = hashlib.sha1(("blob %d\0" % st.st_size).encode("ascii"))
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                sha.update(chunk)
+    except (IOError, OSError):
+        raise GitDirError("unreadable file")
+    return sha.digest()
+
+
+def _readOffset(data, pos):
+    """
+    Read the variable length integer used for delta base offsets and
+    index v4 path prefixes. Returns the value and the next position.
+    """
+    byte = bytearray(data[pos:pos+1])[0]
+    value = byte & 0x7f
+    while byte & 0x80:
+        pos += 1
+        byte = bytearray(data[pos:pos+1])[0]
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, pos + 1
+
+
+def _readSize(data, pos):
+    """
+    Read a little endian variable length integer, as used in deltas.
+    """
+    value = shift = 0
+    while True:
+        byte = bytearray(data[pos:pos+1])[0]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def applyDelta(base, delta):
+    """
+    Build an object from its delta against ``base``.
+    """
+    baseSize, pos = _readSize(delta, 0)
+    size, pos = _readSize(delta, pos)
+    if baseSize != len(base):
+        raise GitDirError("delta does not match base")
+    delta = bytearray(delta)
+    result = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from the base
+            offset = length = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8*i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    length |= delta[pos] << (8*i)
+                    pos += 1
+            result += base[offset:offset + (length or 0x10000)]
+        elif op:
+            # Insert new data
+            result += delta[pos:pos+op]
+            pos += op
+        else:
+            raise GitDirError("invalid delta")
+    if len(result) != size:
+        raise GitDirError("delta size mismatch")
+    return bytes(result)
+
+
+class Pack(object):
+    """
+    A pack file and its (version 2) index.
+
+    :param basename: The path of the pack without the ``.idx`` or
+                     ``.pack`` extension.
+    """
+    TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+    OFS_DELTA = 6
+    REF_DELTA = 7
+
+    # Number of delta bases to keep, as trees share long chains
+    CACHE_SIZE = 256
+
+    def __init__(self, basename):
+        self.basename = basename
+        self._idx = None
+        self._pack = None
+        self._cache = {}
+
+    @staticmethod
+    def _map(filename):
+        try:
+            with open(filename, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            raise GitDirError("cannot read %s" % filename)
+
+    def _loadIndex(self):
+        idx = self._map(self.basename + ".idx")
+        if idx[:8] != b"\377tOc\0\0\0\2":
+            raise GitDirError("unsupported pack index")
+        self.fanout = struct.unpack_from(">256I", idx, 8)
+        self.count = self.fanout[255]
+        self.namesOffset = 8 + 256*4
+        self.offsetsOffset = self.namesOffset + 24*self.count
+        self.largeOffset = self.offsetsOffset + 4*self.count
+        self._idx = idx
+
+    def find(self, binSha):
+        """
+        Get the offset of an object in the pack, or ``None``.
+        """
+        if self._idx is None:
+            self._loadIndex()
+        idx = self._idx
+        first = bytearray(binSha[:1])[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.namesOffset + 20*mid
+            name = idx[pos:pos+20]
+            if name < binSha:
+                lo = mid + 1
+            elif name > binSha:
+                hi = mid
+            else:
+                offset = struct.unpack_from(">I", idx, self.offsetsOffset + 4*mid)[0]
+                if offset & 0x80000000:
+                    offset = struct.unpack_from(
+                        ">Q", idx, self.largeOffset + 8*(offset & 0x7fffffff))[0]
+                return offset
+        return None
+
+    def readObject(self, offset, resolve):
+        """
+        Get the type and contents of the object at ``offset``. Deltas
+        against objects in other packs are found with ``resolve``.
+        """
+        try:
+            return self._cache[offset]
+        except KeyError:
+            pass
+        if self._pack is None:
+            self._pack = self._map(self.basename + ".pack")
+        pack = self._pack
+
+        byte = bytearray(pack[offset:offset+1])[0]
+        kind = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        pos = offset + 1
+        while byte & 0x80:
+            byte = bytearray(pack[pos:pos+1])[0]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            pos += 1
+
+        if kind == self.OFS_DELTA:
+            distance, pos = _readOffset(pack, pos)
+            baseKind, base = self.readObject(offset - distance, resolve)
+        elif kind == self.REF_DELTA:
+            baseSha = binascii.hexlify(pack[pos:pos+20]).decode("ascii")
+            pos += 20
+            baseKind, base = resolve(baseSha)
+        elif kind in self.TYPES:
+            baseKind, base = self.TYPES[kind], None
+        else:
+            raise GitDirError("unknown object type %d" % kind)
+
+        data = self._inflate(pos, size)
+        if base is not None:
+            data = applyDelta(base, data)
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[offset] = (baseKind, data)
+        return baseKind, data
+
+    def _inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        chunks = []
+        length = 0
+        while length < size or not getattr(decompressor, "eof", True):
+            chunk = self._pack[pos:pos+65536]
+            if not chunk:
+                raise GitDirError("truncated pack")
+            pos += len(chunk)
+            try:
+                data = decompressor.decompress(chunk)
+            except zlib.error:
+                raise GitDirError("corrupt pack")
+            chunks.append(data)
+            length += len(data)
+        data = b"".join(chunks)
+        if len(data) != size:
+            raise GitDirError("corrupt pack")
+        return data
+
+
+class GitIndex(object):
+    """
+    The index (staging area) of a repository. Versions 2 to 4 are
+    supported, but not split indexes or sparse indexes.
+
+    :param filename: The path of the index file.
+    """
+    ENTRY = struct.Struct(">10I20sH")
+
+    # Flags
+    ASSUME_VALID = 0x8000
+    EXTENDED = 0x4000
+    SKIP_WORKTREE = 0x4000
+    INTENT_TO_ADD = 0x2000
+
+    def __init__(self, filename):
+        try:
+            with open(filename, "rb") as f:
+                self.mtime = os.fstat(f.fileno()).st_mtime
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            raise GitDirError("cannot read index")
+        try:
+            self._parse(data)
+        except (struct.error, IndexError, ValueError):
+            raise GitDirError("corrupt index")
+        finally:
+            data.close()
+
+    def _parse(self, data):
+        signature, version, count = struct.unpack_from(">4sII", data, 0)
+        if signature != b"DIRC" or version not in (2, 3, 4):
+            raise GitDirError("unsupported index version")
+        # (path, ctime, ctime ns, mtime, mtime ns, dev, ino, mode, uid,
+        #  gid, size, binary object name) of each stage 0 entry
+        self.entries = []
+        # Paths with conflicts
+        self.unmerged = set()
+        # Paths marked with git update-index --assume-unchanged
+        self.assumeValid = set()
+        self.hasAttributes = False
+
+        pos = 12
+        path = b""
+        for _ in range(count):
+            fields = self.ENTRY.unpack_from(data, pos)
+            flags = fields[11]
+            start = pos
+            pos += self.ENTRY.size
+            if flags & self.EXTENDED:
+                extended = struct.unpack_from(">H", data, pos)[0]
+                pos += 2
+                if extended & (self.SKIP_WORKTREE | self.INTENT_TO_ADD):
+                    raise GitDirError("sparse or intent-to-add entry")
+            if version == 4:
+                strip, pos = _readOffset(data, pos)
+                end = data.find(b"\0", pos)
+                path = path[:len(path)-strip] + data[pos:end]
+                pos = end + 1
+            else:
+                end = data.find(b"\0", pos)
+                path = data[pos:end]
+                # Entries are padded with NULs to a multiple of 8 bytes
+                pos = start + ((end - start + 8) & ~7)
+
+            if (flags >> 12) & 3:
+                self.unmerged.add(path)
+            else:
+                self.entries.append((path,) + fields[:11])
+                if flags & self.ASSUME_VALID:
+                    self.assumeValid.add(path)
+            if path == b".gitattributes" or path.endswith(b"/.gitattributes"):
+                self.hasAttributes = True
+
+        # Directory to binary tree name, for directories whose tree is
+        # known to match the index
+        self.cacheTree = {}
+        end = len(data) - 20
+        while pos < end:
+            signature, size = struct.unpack_from(">4sI", data, pos)
+            pos += 8
+            if signature == b"TREE":
+                self._parseCacheTree(data[pos:pos+size])
+            elif not signature[:1].isupper():
+                # Extensions that must be understood, e.g. split index
+                # ("link") or sparse index ("sdir")
+                raise GitDirError("unsupported index extension")
+            pos += size
+
+    def _parseCacheTree(self, data):
+        stack = []
+        pos = 0
+        while pos < len(data):
+            end = data.index(b"\0", pos)
+            name = data[pos:end]
+            pos = data.index(b"\n", end)
+            entries, subtrees = data[end+1:pos].split(b" ")
+            pos += 1
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+            if stack:
+                parent = stack[-1]
+                parent[1] -= 1
+                path = parent[0] + b"/" + name if parent[0] else name
+            else:
+                path = name
+            if int(entries) >= 0:
+                self.cacheTree[path] = data[pos:pos+20]
+                pos += 20
+            stack.append([path, int(subtrees)])
+
+    def iterMerged(self):
+        """
+        Yield the (path, mode, binary object name) of each entry that
+        is not in conflict.
+        """
+        for entry in self.entries:
+            yield entry[0], entry[7], entry[11]
+
+    def iterStats(self):
+        """
+        Yield the entries whose stat data is checked against the work
+        tree, leaving out those that git assumes are unchanged.
+        """
+        for entry in self.entries:
+            if entry[0] not in self.assumeValid:
+                yield entry
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+"""
+Watch repositories for changes with Linux inotify, so that a long-lived
+prmpt process (see :mod:`prmpt.daemon`) can reuse VCS status until
+something in the repository actually changes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Import external modules
+import os
+import time
+import errno
+import struct
+from collections import OrderedDict
+
+# Event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# Anything that changes the contents of a directory or its files
+CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+           IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT = struct.Struct(str("iIII"))
+
+# Default limits on what a RepoWatcher watches
+MAX_REPOS = 16
+MAX_WATCHES = 8192
+# Seconds for which a status is reused, even if no event was seen
+MAX_AGE = 30
+
+
+class Inotify(object):
+    """
+    A thin wrapper around an inotify instance, using ctypes.
+
+    Raises ``OSError`` if inotify is not available.
+    """
+    _libc = None
+
+    def __init__(self):
+        libc = self._getLibc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    @classmethod
+    def _getLibc(cls):
+        if cls._libc is None:
+            import ctypes
+            import ctypes.util
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                libc.inotify_rm_watch
+            except (OSError, AttributeError):
+                raise OSError(errno.ENOSYS, "inotify is not available")
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
+
+    @staticmethod
+    def _raise():
+        import ctypes
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    def addWatch(self, path, mask):
+        """
+        Watch ``path``, returning the watch descriptor.
+        """
+        if not isinstance(path, bytes):
+            path = path.encode("utf-8")
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise()
+        return wd
+
+    def removeWatch(self, wd):
+        # Fails harmlessly if the watch has already gone
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def readEvents(self):
+        """
+        Get a list of the (watch descriptor, mask, name) of each event
+        that has happened, without blocking.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                name = data[pos:pos+length].rstrip(b"\0")
+                pos += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class WatchedRepo(object):
+    """
+    The watches on a repository and the status stored for it.
+    """
+    def __init__(self, root, gitDirs):
+        self.root = root
+        self.gitDirs = gitDirs
+        # Watch descriptor to directory
+        self.watches = {}
+        # False if there were too many directories to watch them all
+        self.complete = True
+        self.data = None
+        self.dirty = True
+        # When the data was stored
+        self.stored = 0
+        # The number of events seen, which shows whether any arrived
+        # while the status was being read
+        self.changes = 0
+
+    def changed(self):
+        self.dirty = True
+        self.changes += 1
+
+
+class RepoWatcher(object):
+    """
+    Watches the git directories and work trees of the repositories
+    visited most recently, and keeps the status stored for each until
+    an event shows that it may have changed.
+
+    At most ``maxRepos`` repositories and ``maxWatches`` directories
+    are watched. The least recently visited repositories are dropped to
+    make room for new ones, and a repository that cannot be watched
+    completely is never trusted. In case an event is missed, a status
+    is not reused once it is ``maxAge`` seconds old.
+
+    Call :meth:`startRead` before reading the status of a repository,
+    and pass what it returns to :meth:`store`, so that a status that
+    changed while it was being read is not trusted.
+    """
+    # Files in the git directory that do not affect the status
+    IGNORED_SUFFIXES = (b".lock",)
+    # Directories in the git directory that are watched with everything
+    # below them (e.g. refs/remotes/origin/)
+    TREES = (b"refs", b"logs")
+
+    def __init__(self, maxRepos=MAX_REPOS, maxWatches=MAX_WATCHES, inotify=None,
+                 maxAge=MAX_AGE):
+        self.inotify = inotify or Inotify()
+        self.maxRepos = maxRepos
+        self.maxWatches = min(maxWatches, self.getWatchLimit() // 2)
+        self.maxAge = maxAge
+        # Root to WatchedRepo, in order of use
+        self.repos = OrderedDict()
+        # Watch descriptor to {repo: is in the git directory}. A
+        # directory can be watched for more than one repository (e.g. a
+        # nested one), but inotify gives it one descriptor.
+        self.watches = {}
+
+    @staticmethod
+    def getWatchLimit():
+        try:
+            with open("/proc/sys/fs/inotify/max_user_watches") as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return MAX_WATCHES * 2
+
+    def processEvents(self):
+        """
+        Mark the repositories that have changed as dirty.
+        """
+        for wd, mask, name in self.inotify.readEvents():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost
+                for repo in self.repos.values():
+                    repo.changed()
+                continue
+            try:
+                owners = self.watches[wd]
+            except KeyError:
+                # Already removed
+                continue
+            if mask & IN_IGNORED:
+                # The directory has gone
+                del self.watches[wd]
+                for repo in owners:
+                    repo.watches.pop(wd, None)
+                    repo.changed()
+                continue
+            for repo, inGitDir in list(owners.items()):
+                # (Unless making room for new watches dropped it)
+                if wd in repo.watches:
+                    self._processEvent(repo, inGitDir, repo.watches[wd], mask, name)
+
+    def _processEvent(self, repo, inGitDir, directory, mask, name):
+        if inGitDir and name.endswith(self.IGNORED_SUFFIXES):
+            return
+        if not inGitDir and name == b".git":
+            return
+        repo.changed()
+        if mask & IN_CREATE and mask & IN_ISDIR and repo.complete:
+            if inGitDir and directory in repo.gitDirs and name not in self.TREES:
+                # Not one of the trees (e.g. objects/)
+                return
+            self._watchTree(repo, os.path.join(directory, name), inGitDir)
+
+    def lookup(self, root, stale=False):
+        """
+        Get the status stored for ``root``, or ``None`` if it may have
+        changed since it was stored (unless ``stale`` is ``True``).
+        """
+        self.processEvents()
+        try:
+            repo = self.repos[root]
+        except KeyError:
+            return None
+        self._touch(root)
+        if stale:
+            return repo.data
+        if repo.dirty or not repo.complete or \
+                not 0 <= time.time() - repo.stored < self.maxAge:
+            return None
+        return repo.data
+
+    def startRead(self, root, gitDirs):
+        """
+        Start watching the repository at ``root``, whose git directories
+        (e.g. ``.git`` and the common directory of a worktree) are
+        ``gitDirs``, before its status is read. Returns the token to
+        pass to :meth:`store`.
+        """
+        self.processEvents()
+        repo = self.repos.get(root)
+        if repo is None:
+            repo = self._watch(root, gitDirs)
+        else:
+            self._touch(root)
+        return repo.changes
+
+    def store(self, root, gitDirs, data, token=None):
+        """
+        Store the status of the repository at ``root``, read since
+        :meth:`startRead` returned ``token``. It is only trusted if
+        nothing changed in the meantime. Without a ``token``, anything
+        seen so far is taken to have happened before it was read.
+        """
+        self.processEvents()
+        repo = self.repos.get(root)
+        if repo is None:
+            # Not watched while it was read, if it was dropped since
+            unwatched = token is not None
+            repo = self._watch(root, gitDirs)
+        else:
+            unwatched = False
+            self._touch(root)
+        repo.data = data
+        repo.dirty = unwatched or (token is not None and token != repo.changes)
+        repo.stored = time.time()
+
+    def _touch(self, root):
+        repo = self.repos.pop(root)
+        self.repos[root] = repo
+
+    def _watch(self, root, gitDirs):
+        while len(self.repos) >= self.maxRepos:
+            self.forget(next(iter(self.repos)))
+        gitDirs = [d if isinstance(d, bytes) else d.encode("utf-8") for d in gitDirs]
+        repo = WatchedRepo(root, gitDirs)
+        self.repos[root] = repo
+        # The git directory itself (HEAD, the index, packed-refs...),
+        # and every branch, remote branch, tag and reflog below it
+        for gitDir in gitDirs:
+            if not self._addWatch(repo, gitDir, True):
+                repo.complete = False
+                self._unwatch(repo)
+                return repo
+            for sub in self.TREES:
+                directory = os.path.join(gitDir, sub)
+                if os.path.isdir(directory) and repo.complete:
+                    self._watchTree(repo, directory, True)
+        if repo.complete:
+            self._watchTree(repo, root)
+        return repo
+
+    def _watchTree(self, repo, top, inGitDir=False):
+        if not isinstance(top, bytes):
+            top = top.encode("utf-8")
+        for directory, dirs, _ in os.walk(top):
+            if not inGitDir:
+                dirs[:] = [d for d in dirs if d != b".git"]
+            if not self._addWatch(repo, directory, inGitDir):
+                # Partial watches are no use, so free them for others
+                repo.complete = False
+                self._unwatch(repo)
+                return
+
+    def _addWatch(self, repo, directory, inGitDir):
+        # Make room by dropping the least recently used repositories
+        while len(self.watches) >= self.maxWatches:
+            oldest = next(iter(self.repos))
+            if oldest == repo.root:
+                return False
+            self.forget(oldest)
+        try:
+            wd = self.inotify.addWatch(
+                directory, CHANGES | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+            )
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # Out of watches
+                return False
+            # Removed already
+            return True
+        if not isinstance(directory, bytes):
+            directory = directory.encode("utf-8")
+        repo.watches[wd] = directory
+        self.watches.setdefault(wd, {})[repo] = inGitDir
+        return True
+
+    def forget(self, root):
+        """
+        Stop watching the repository at ``root``.
+        """
+        self._unwatch(self.repos.pop(root))
+
+    def _unwatch(self, repo):
+        for wd in repo.watches:
+            owners = self.watches.get(wd, {})
+            if owners.pop(repo, None) is not None and not owners:
+                # The last repository watching the directory
+                del self.watches[wd]
+                self.inotify.removeWatch(wd)
+        repo.watches = {}
+
+    def close(self):
+        self.inotify.close()
@@ -4,55 +4,77 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
-from builtins import chr
 
 # Import external modules
-import shlex
 import re
 
 
-class Lexer(shlex.shlex):
+class Lexer(object):
     """ A lexer to split tokens in a prmpt script.
 
     Usage: l = Lexer("\\my\\amazing{}function")
     renders an iterable object, l, which will generate:
     ['\\my' , '\\amazing', '{', '}', 'function']
 
-    Inherits usage from shlex
-    https://docs.python.org/2/library/shlex.html
+    Tokens are read with ``get_token()``, which returns an empty string
+    at the end of the input. After each call ``lineno`` holds the line
+    number of the token.
+
+    The input is tokenized in a single pass of a compiled regular
+    expression. Whitespace separates tokens and is discarded, ``%``
+    starts a comment that runs to the end of the line, and each of the
+    characters ``\\{}[]`` is a token on its own. Anything else (including
+    non-ASCII text) is a literal word.
     """
     SPECIAL_CHARS = "%\\{}[] \t\n\r"
     COMMENT_CHAR = "%"
 
+    TOKEN_RE = re.compile(
+        r"[ \t\r\n]+"             # whitespace
+        r"|%[^\n]*\n?"            # comment
+        r"|[\\{}\[\]]"            # special characters
+        r"|[^%\\{}\[\] \t\r\n]+"  # literal word
+    )
+
     def __init__(self, instream):
-        instream = self.fixComments(instream)
-        instream = self.fixLineNumbers(instream)
-
-        shlex.shlex.__init__(self, instream=instream)
-        asciiCharSet = set([chr(i) for i in range(128)])
-        # Discard special chars
-        for char in self.SPECIAL_CHARS:
-            asciiCharSet.discard(char)
-        self.wordchars = ''.join(asciiCharSet)
-        self.commenters = self.COMMENT_CHAR
-
-    @staticmethod
-    def fixComments(instream):
-        """Fix for bug where newline at end of comment gets treated
-        as part of the comment (causing 'A\n#comment\nB' to be rendered
-        as 'AB' instead of the intended 'A,B').
-             http://bugs.python.org/issue7089
-
-        This works by ensuring there is always whitespace between the
-        last 'real' character and the comment character.
-        """
-        return re.sub(Lexer.COMMENT_CHAR,
-                      " " + Lexer.COMMENT_CHAR,
-                      instream)
-
-    @staticmethod
-    def fixLineNumbers(instream):
-        """Fix broken line number reporting by ensuring that every line
-        has a trailing whitespace character
+        self.lineno = 1
+        self.tokens = self.tokenize(instream)
+        self.index = 0
+
+    def tokenize(self, instream):
+        """ Split the input into a list of (token, lineno) tuples.
         """
-        return re.sub(r"([\r]?)\n", r" \1\n", instream)
+        tokens = []
+        lineno = 1
+        for match in self.TOKEN_RE.finditer(instream):
+            token = match.group()
+            char = token[0]
+            if char in " \t\r\n":
+                lineno += token.count("\n")
+            elif char == self.COMMENT_CHAR:
+                # A comment always ends the line, even at end of input
+                lineno += 1
+            else:
+                tokens.append((token, lineno))
+        self.endLineno = lineno
+        return tokens
+
+    def get_token(self):
+        if self.index >= len(self.tokens):
+            self.lineno = self.endLineno
+            return ""
+        token, self.lineno = self.tokens[self.index]
+        self.index += 1
+        return token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = self.get_token()
+        if not token:
+            raise StopIteration
+        return token
+
+    next = __next__
+
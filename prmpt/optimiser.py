@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import str
+
+from prmpt import parser
+from prmpt import status
+
+
+class Optimiser(object):
+    """ Simplifies the list of nodes output from the Parser before it
+    is executed:
+
+    - Calls to pure functions (see :func:`prmpt.functionBase.pure`)
+      whose arguments are all constant are evaluated, and replaced
+      with their output.
+    - Adjacent literals are merged.
+    - The cursor movement of each top level literal is precomputed.
+
+    The input nodes are not modified.
+    """
+    def __init__(self, functionContainer):
+        self.funcs = functionContainer
+
+    def optimise(self, nodes):
+        out = []
+        for node in self._fold(nodes):
+            if type(node) is parser.Literal:
+                # A copy, as the literal may be one of the input nodes
+                node = parser.Literal(
+                    node.value, node.lineno, status.Coords.measure(node.value)
+                )
+            out.append(node)
+        return out
+
+    def _fold(self, nodes):
+        out = []
+        for node in nodes:
+            if type(node) is parser.Call:
+                node = self._foldCall(node)
+            if type(node) is parser.Literal and out and type(out[-1]) is parser.Literal:
+                out[-1] = parser.Literal(out[-1].value + node.value, out[-1].lineno)
+            else:
+                out.append(node)
+        return out
+
+    def _foldCall(self, node):
+        args = [self._fold(arg) for arg in node.args]
+        optargs = [self._fold(arg) for arg in node.optargs]
+        allArgs = args + optargs
+        if self.funcs.isPure(node.name) and all(self._isConstant(arg) for arg in allArgs):
+            try:
+                value = self.funcs._call(node.name, *[self._value(arg) for arg in allArgs])
+            except Exception:
+                # Leave the call for the compiler to report in context
+                pass
+            else:
+                return parser.Literal(str(value), node.lineno)
+        return parser.Call(node.name, node.lineno, args, optargs)
+
+    @staticmethod
+    def _isConstant(nodes):
+        return all(type(node) is parser.Literal for node in nodes)
+
+    @staticmethod
+    def _value(nodes):
+        return "".join(node.value for node in nodes)
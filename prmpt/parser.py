@@ -8,13 +8,136 @@ from __future__ import unicode_literals
 from prmpt import lexer
 
 
+class Node(object):
+    """ Base class of the nodes in a parsed prompt.
+    """
+    __slots__ = ()
+    # The attributes that define the node
+    _fields = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self._fields
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join(repr(getattr(self, name)) for name in self._fields)
+        )
+
+
+class Literal(Node):
+    """ A literal string, output verbatim. ``movement`` may be set to
+    the precomputed cursor movement of the string (see
+    :meth:`prmpt.status.Coords.measure`).
+    """
+    __slots__ = ("value", "lineno", "movement")
+    _fields = ("value", "lineno")
+
+    def __init__(self, value, lineno, movement=None):
+        self.value = value
+        self.lineno = lineno
+        self.movement = movement
+
+    def toDict(self):
+        return {'type': 'literal',
+                'value': self.value,
+                'lineno': self.lineno
+                }
+
+    def toTuple(self):
+        return (self.value, self.lineno)
+
+
+class Call(Node):
+    """ A function call. ``args`` and ``optargs`` are lists of
+    arguments, each of which is itself a list of nodes.
+    """
+    __slots__ = ("name", "args", "optargs", "lineno")
+    _fields = __slots__
+
+    def __init__(self, name, lineno, args=None, optargs=None):
+        self.name = name
+        self.lineno = lineno
+        self.args = args or []
+        self.optargs = optargs or []
+
+    def toDict(self):
+        out = {'type': 'function',
+               'name': self.name,
+               'lineno': self.lineno
+               }
+        if self.args:
+            out['args'] = [toDicts(arg) for arg in self.args]
+        if self.optargs:
+            out['optargs'] = [toDicts(arg) for arg in self.optargs]
+        return out
+
+    def toTuple(self):
+        return (self.name,
+                self.lineno,
+                [dump(arg) for arg in self.args],
+                [dump(arg) for arg in self.optargs])
+
+
+def toDicts(nodes):
+    """ Convert a list of nodes to the dictionary form returned by
+    :meth:`Parser.parse`.
+    """
+    return [node.toDict() for node in nodes]
+
+
+def fromDicts(structs):
+    """ The inverse of :func:`toDicts`.
+    """
+    nodes = []
+    for struct in structs:
+        if struct['type'] == 'literal':
+            nodes.append(Literal(struct['value'], struct['lineno']))
+        else:
+            nodes.append(Call(struct['name'],
+                              struct['lineno'],
+                              [fromDicts(arg) for arg in struct.get('args', [])],
+                              [fromDicts(arg) for arg in struct.get('optargs', [])]))
+    return nodes
+
+
+def dump(nodes):
+    """ Convert a list of nodes to nested lists and tuples that can be
+    marshalled. Literals become 2-tuples and calls 4-tuples.
+    """
+    return [node.toTuple() for node in nodes]
+
+
+def load(data):
+    """ The inverse of :func:`dump`.
+    """
+    nodes = []
+    for item in data:
+        if len(item) == 2:
+            nodes.append(Literal(*item))
+        else:
+            name, lineno, args, optargs = item
+            nodes.append(Call(name,
+                              lineno,
+                              [load(arg) for arg in args],
+                              [load(arg) for arg in optargs]))
+    return nodes
+
+
 class Parser(object):
     """ Parse an input stream by first passing it through the
     Lexer class. The lexer will yield a set of discrete tokens
     that can be iterated upon. Special tokens (like \\) need to
     be parsed allong with the tokens directly following them.
 
-    The returned output is a list of dictionary items with a 'type'
+    :meth:`parseNodes` returns a list of :class:`Literal` and
+    :class:`Call` nodes. :meth:`parse` returns the same structure
+    as a list of dictionary items with a 'type'
     key set to one of:
         'function' : with the additional keys:
                 'name' : the function name
@@ -30,6 +153,12 @@ class Parser(object):
         """ Run the input stream recursively through the atom
         and build a list of nested dictionary objects
         """
+        return toDicts(self.parseNodes(instream))
+
+    def parseNodes(self, instream):
+        """ Run the input stream recursively through the atom
+        and build a list of nodes
+        """
         lex = lexer.Lexer(instream)
         return self._atom(lex, lex.get_token())
 
@@ -45,12 +174,9 @@ class Parser(object):
             if token == '\\':
                 # Function
                 name = lex.get_token()
-                func = {'type': 'function',
-                        'name': name,
-                        'lineno': lex.lineno
-                        }
-                args = []
-                optargs = []
+                func = Call(name, lex.lineno)
+                args = func.args
+                optargs = func.optargs
                 token = lex.get_token()
                 while token in ['{', '[']:
                     # Arguments
@@ -61,10 +187,6 @@ class Parser(object):
                     elif token == '[':
                         optargs.append(arg)
                     token = lex.get_token()
-                if args:
-                    func['args'] = args
-                if optargs:
-                    func['optargs'] = optargs
                 out.append(func)
                 if not token:
                     break
@@ -73,12 +195,7 @@ class Parser(object):
                 break
             else:
                 # String literal
-                out.append(
-                    {'type': 'literal',
-                     'value': token,
-                     'lineno': lex.lineno
-                     }
-                )
+                out.append(Literal(token, lex.lineno))
                 token = lex.get_token()
 
         return out
@@ -12,6 +12,7 @@ from __future__ import unicode_literals
 from prmpt import functionContainer
 from prmpt import compiler
 from prmpt import config
+from prmpt import cache
 from prmpt import functions
 from prmpt import colours
 from prmpt import vcs
@@ -21,19 +22,45 @@ class Prompt(object):
 
     def __init__(self, status):
         self.status = status
-        self.funcs = functionContainer.FunctionContainer(
-            self.status
-        )
-        self.funcs.addFunctionsFromModule(functions)
-        self.funcs.addFunctionsFromModule(colours)
-        self.funcs.addFunctionsFromModule(vcs)
-        self.funcs.addFunctionsFromDir(self.status.userDir.promtyUserFunctionsDir)
+        timer = self.status.timer
+        with timer.phase("functions"):
+            self.funcs = functionContainer.FunctionContainer(
+                self.status
+            )
+            self.funcs.addFunctionsFromModule(functions)
+            self.funcs.addFunctionsFromModule(colours)
+            self.funcs.addFunctionsFromModule(vcs)
+        with timer.phase("user functions"):
+            self.funcs.addFunctionsFromDir(self.status.userDir.promtyUserFunctionsDir)
 
-        self.compiler = compiler.Compiler(self.funcs)
-        self.config = config.Config()
-        self.config.load(self.status.userDir.getConfigFile())
+        self.compiler = None
+        self.compiledKey = None
+        self.parseCache = cache.ParseCache(self.status.userDir.getCacheDir())
+        with timer.phase("config"):
+            self.config = config.Config()
+            self.config.load(self.status.userDir.getConfigFile())
+        self.status.config = self.config
+        self.status.repoStats = cache.RepoStats(
+            self.status.userDir.getCacheDir(),
+            self.config.vcsCacheSize
+        )
+        if self.config.vcsCacheMaxAge > 0:
+            self.status.vcsCache = cache.VCSCache(
+                self.status.userDir.getCacheDir(),
+                self.config.vcsCacheMaxAge,
+                self.config.vcsCacheSize
+            )
 
     def getPrompt(self):
-        self.compiler.compile(self.config.promptString)
-        output = self.compiler.execute()
+        # Only compile when the prompt string (or the shell dialect,
+        # which is folded into constant colour codes) changes, so that
+        # the same Prompt can be rendered many times
+        compiledKey = (self.config.promptString, colours.Colours.NOCOUNT_START)
+        if self.compiler is None or self.compiledKey != compiledKey:
+            with self.status.timer.phase("parse"):
+                self.compiler = compiler.Compiler(self.funcs, self.parseCache)
+                self.compiler.compile(self.config.promptString, self.config.getPromptFileKey())
+                self.compiledKey = compiledKey
+        with self.status.timer.phase("execute"):
+            output = self.compiler.execute()
         return output
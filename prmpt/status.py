@@ -6,11 +6,13 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
-import subprocess
+import time
 
 from prmpt import userdir
+from prmpt import config
 from prmpt import vcs
 from prmpt import colours
+from prmpt import timing
 
 
 class Coords(object):
@@ -51,42 +53,208 @@ class Coords(object):
         characters (these are encapsulated by the NOCOUNT_*
         characters from the Colour class)
         """
-        non_print = False
-        for char in unicodeString:
-            if char == colours.Colours.NOCOUNT_START:
-                non_print = True
-                continue
-            if char == colours.Colours.NOCOUNT_END:
-                non_print = False
-                continue
-            if not non_print:
-                if char == "\n":
-                    self.incRow()
-                    self.resetColumn()
-                elif char == "\r":
-                    self.resetColumn()
-                else:
-                    self.incColumn()
+        self.move(self.measure(unicodeString))
+
+    def move(self, movement):
+        """ Apply a movement returned by :meth:`measure`.
+        """
+        rows, columns, restart = movement
+        if rows:
+            self.incRow(rows)
+        if restart:
+            self.column = columns
+        else:
+            self.incColumn(columns)
+
+    @staticmethod
+    def measure(unicodeString):
+        """ Get the cursor movement caused by the input string, as a
+        (rows, columns, restart) tuple. If ``restart`` is ``True`` the
+        string ends on a new line (or after a carriage return) and
+        ``columns`` is the resulting column, otherwise it is the number
+        of columns to advance by.
+        """
+        start = colours.Colours.NOCOUNT_START
+        end = colours.Colours.NOCOUNT_END
+        if start in unicodeString or end in unicodeString:
+            unicodeString = Coords.printable(unicodeString, start, end)
+
+        rows = unicodeString.count("\n")
+        lastBreak = max(unicodeString.rfind("\n"), unicodeString.rfind("\r"))
+        if lastBreak < 0:
+            return (rows, len(unicodeString), False)
+        # The column restarts after the last line feed or carriage return
+        return (rows, len(unicodeString) - lastBreak - 1, True)
+
+    @staticmethod
+    def printable(unicodeString, start, end):
+        """ Remove the non-printing sections (from ``start`` up to and
+        including the next ``end``) from the input string. An unterminated
+        section runs to the end of the string.
+        """
+        sections = unicodeString.split(start)
+        out = [sections[0]]
+        for section in sections[1:]:
+            idx = section.find(end)
+            if idx >= 0:
+                out.append(section[idx+len(end):])
+        return "".join(out).replace(end, "")
+
+
+# Where timeouts are logged, in the cache directory, and the size at
+# which the log is moved aside to start a new one
+TIMEOUT_LOG = "timeouts.log"
+TIMEOUT_LOG_SIZE = 64*1024
 
 
 class Status(object):
-    def __init__(self, exitCode=0, workingDir=None):
+    def __init__(self, exitCode=0, workingDir=None, timer=None):
         self.exitCode = int(exitCode)
         self.workingDir = workingDir
-        self.userDir = userdir.UserDir()
+        # Records the time spent in each phase of rendering, if enabled
+        if timer is None:
+            timer = timing.Timer(enabled=False)
+        self.timer = timer
+        with self.timer.phase("userdir"):
+            self.userDir = userdir.UserDir()
         self.euid = os.geteuid()
+        # Shares VCS status between prompts, if set (see cache.VCSCache)
+        self.vcsCache = None
+        # Keeps VCS status in memory until the repository changes, in a
+        # long-lived process (see inotify.RepoWatcher)
+        self.vcsWatcher = None
+        # Keeps details of each repository that outlive its status (see
+        # cache.RepoStats), if set
+        self.repoStats = None
+        # The settings used by the VCS backends, replaced by the loaded
+        # config (see prompt.Prompt)
+        self.config = config.Config()
         self.vcs = vcs.VCS(self)
+        self._window = None
+        self.windowSource = None
+        self.pos = Coords()
+        # Descriptions of what timed out while rendering
+        self.timeouts = []
+
+    # Values of windowSource
+    WINDOW_ENV = "env"
+    WINDOW_TTY = "tty"
+    WINDOW_SET = "set"
+    WINDOW_UNKNOWN = "unknown"
+
+    @property
+    def window(self):
+        """ The terminal size. This is only looked up when it is first
+        needed, and ``windowSource`` records where it came from.
+        """
+        if self._window is None:
+            self._window, self.windowSource = self.getWindowSize()
+            self.timer.info["window"] = "%dx%d (%s)" % (
+                self._window.column, self._window.row, self.windowSource
+            )
+        return self._window
+
+    @window.setter
+    def window(self, coords):
+        self._window = coords
+        self.windowSource = self.WINDOW_SET
 
-        proc = subprocess.Popen(['stty', 'size'],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        stdout, _ = proc.communicate()
-        if proc.returncode == 0:
-            dims = stdout.split()
-            self.window = Coords(int(dims[1]), int(dims[0]))
+    def getWindowSize(self):
+        """ Get the terminal size and its source, trying ``$COLUMNS``
+        and ``$LINES`` (which the shell must pass in, as they are not
+        normally exported), then the controlling terminal.
+        """
+        try:
+            return (Coords(int(os.environ["COLUMNS"]), int(os.environ.get("LINES", 0))),
+                    self.WINDOW_ENV)
+        except (KeyError, ValueError):
+            pass
+
+        size = self._getTtySize()
+        if size is not None:
+            return (Coords(size[1], size[0]), self.WINDOW_TTY)
+        return (Coords(), self.WINDOW_UNKNOWN)
+
+    @staticmethod
+    def _getTtySize():
+        """ Get the (rows, columns) of the controlling terminal with the
+        ``TIOCGWINSZ`` ioctl, or ``None``.
+        """
+        try:
+            import fcntl
+            import struct
+            import termios
+        except ImportError:
+            # Not a unix
+            return None
+
+        def ioctl(fd):
+            try:
+                rows, columns = struct.unpack(
+                    "hh", fcntl.ioctl(fd, termios.TIOCGWINSZ, b"\0" * 4)
+                )
+            except (IOError, OSError):
+                return None
+            if columns <= 0:
+                return None
+            return rows, columns
+
+        try:
+            fd = os.open("/dev/tty", os.O_RDONLY)
+        except OSError:
+            pass
         else:
-            self.window = Coords()
+            try:
+                size = ioctl(fd)
+            finally:
+                os.close(fd)
+            if size is not None:
+                return size
+
+        # No controlling terminal, so try the standard streams
+        for fd in (0, 1, 2):
+            size = ioctl(fd)
+            if size is not None:
+                return size
+        return None
+
+    def reset(self, exitCode=0, workingDir=None):
+        """
+        Prepare for another render, as a long-lived process will reuse
+        the same status object (it is referenced by every registered
+        function) for many prompts.
+        """
+        self.exitCode = int(exitCode)
+        self.workingDir = workingDir
+        self.vcs = vcs.VCS(self)
+        self._window = None
+        self.windowSource = None
         self.pos = Coords()
+        self.timeouts = []
+
+    def recordTimeout(self, description):
+        """ Record that something timed out, in the timer's info and in
+        the timeout log (see ``TIMEOUT_LOG``), so that slow functions
+        and commands can be found later.
+        """
+        self.timeouts.append(description)
+        self.timer.info["timeouts"] = "; ".join(self.timeouts)
+        logFile = os.path.join(self.userDir.getCacheDir(), TIMEOUT_LOG)
+        line = "%s %s: %s\n" % (
+            time.strftime("%Y-%m-%d %H:%M:%S"), self.getWorkingDir(), description
+        )
+        try:
+            if os.path.getsize(logFile) >= TIMEOUT_LOG_SIZE:
+                os.rename(logFile, logFile + ".old")
+        except OSError:
+            # No log yet
+            pass
+        try:
+            with open(logFile, "ab") as f:
+                f.write(line.encode("utf-8"))
+        except (IOError, OSError):
+            # The log is only for diagnosis
+            pass
 
     def getWorkingDir(self):
         if self.workingDir:
@@ -6,37 +6,177 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import re
-import xml.dom.minidom
-from xml.parsers.expat import ExpatError
 
 from prmpt import vcs
 
 SVN_COMMAND = "svn"
 
 
+class InfoParser(object):
+    """
+    A streaming parser for the output of ``svn info --xml``, such as::
+
+        <?xml version="1.0" encoding="UTF-8"?>
+        <info>
+        <entry
+           path="." revision="5228" kind="dir">
+        <url>https://localhost/repos/myrepo/branches/feature-awesomeFeature</url>
+        <relative-url>^/branches/feature-awesomeFeature</relative-url>
+        <repository>
+        ...
+        </entry>
+        </info>
+
+    The output is passed to :meth:`feed` in chunks as it is read. Only
+    the ``relative-url`` of the first entry is needed, so anything after
+    it is not parsed at all.
+    """
+    def __init__(self):
+        # Only import the XML parser when inside a svn working copy
+        from xml.parsers import expat
+        self.ExpatError = expat.ExpatError
+        self.parser = expat.ParserCreate("UTF-8")
+        self.parser.StartElementHandler = self._startElement
+        self.parser.EndElementHandler = self._endElement
+        self.parser.CharacterDataHandler = self._characterData
+        self.hasEntry = False
+        self.relativeUrl = None
+        # Whether parsing has finished (successfully or not)
+        self.done = False
+        self._text = None
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        try:
+            self.parser.Parse(chunk, False)
+        except self.ExpatError:
+            # Error parsing xml
+            self.done = True
+
+    def close(self):
+        self.feed(b"")
+        if not self.done:
+            try:
+                self.parser.Parse(b"", True)
+            except self.ExpatError:
+                pass
+            self.done = True
+
+    def _startElement(self, name, attributes):
+        if name == "entry":
+            self.hasEntry = True
+        elif name == "relative-url" and self.hasEntry:
+            self._text = []
+
+    def _endElement(self, name):
+        if name == "relative-url" and self._text is not None:
+            self.relativeUrl = "".join(self._text)
+            self._text = None
+            self.done = True
+        elif name == "entry":
+            # No relative URL (svn < 1.8)
+            self.done = True
+
+    def _characterData(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+
+class StatusParser(object):
+    """
+    A streaming parser for the output of ``svn status``, which counts
+    the changed and untracked files. The output is passed to
+    :meth:`feed` in chunks as it is read.
+    """
+    # From the svn help page, the first column is:
+    #   ' ' no modifications
+    #   'A' Added
+    #   'C' Conflicted
+    #   'D' Deleted
+    #   'I' Ignored
+    #   'M' Modified
+    #   'R' Replaced
+    #   'X' an unversioned directory created by an externals definition
+    #   '?' item is not under version control
+    #   '!' item is missing (removed by non-svn command) or incomplete
+    #   '~' versioned item obstructed by some item of a different kind
+    CHANGED = frozenset(b"MADRC!~")
+    UNTRACKED = frozenset(b"?I")
+
+    def __init__(self):
+        self.changed = 0
+        self.untracked = 0
+        self._buffer = b""
+
+    def feed(self, chunk):
+        lines = (self._buffer + chunk).split(b"\n")
+        # The last line is incomplete
+        self._buffer = lines.pop()
+        for line in lines:
+            self._parseLine(line)
+
+    def close(self):
+        if self._buffer:
+            self._parseLine(self._buffer)
+            self._buffer = b""
+
+    def _parseLine(self, line):
+        # The first 7 columns in the status lines denote the status
+        if len(line.rstrip(b"\r")) < 7:
+            return
+        column = bytearray(line[:1])[0]
+        if column in self.CHANGED:  # changes in work tree
+            self.changed += 1
+        elif column in self.UNTRACKED:  # untracked files
+            self.untracked += 1
+
+
 class Subversion(vcs.VCSBase):
+    MARKERS = (".svn",)
+    UNTRIGGERED = vcs.VCSBase.UNTRIGGERED + ("_startSvnStatus",)
 
     def __init__(self, status, cmd=SVN_COMMAND):
         super(Subversion, self).__init__(status, cmd)
 
+    def prefetch(self):
+        self.started = (self.status.getWorkingDir(), self._startSvnStatus())
+
+    def _startSvnStatus(self):
+        """
+        Start ``svn info`` and ``svn status`` at once, each passing its
+        output to a parser as it is read.
+        """
+        infoParser = InfoParser()
+        statusParser = StatusParser()
+        return (infoParser, statusParser,
+                self.startCommand([self.command, "info", "--xml"], infoParser.feed),
+                self.startCommand([self.command, "status"], statusParser.feed))
+
     def _runStatus(self):
+        infoParser, statusParser, infoCommand, statusCommand = \
+            self.takeStarted() or self._startSvnStatus()
         try:
-            (istdout, istderr, _) = self.runCommand(
-                [self.command, "info", "--xml"]
-            )
-            (sstdout, sstderr, _) = self.runCommand(
-                [self.command, "status"]
-            )
+            (istderr, _) = infoCommand.result()
+            (sstderr, _) = statusCommand.result()
         except OSError:
             # SVN command not found
             self.installed = False
             self.isRepo = False
             return
+        except vcs.CommandTimeout:
+            # svn info was killed, so make sure svn status is too
+            try:
+                statusCommand.result()
+            except (OSError, vcs.CommandTimeout):
+                pass
+            raise
 
         if not istderr:
             # Successful svn info call
             self.installed = True
-            self._parse_info_xml(istdout)
+            infoParser.close()
+            self._readInfo(infoParser)
         else:
             if "is not a working copy" in istderr:
                 # The directory is not a svn repo
@@ -49,78 +189,22 @@ class Subversion(vcs.VCSBase):
 
         if not sstderr:
             # Successful svn status call
-            self._parse_status(sstdout)
-
-    def _parse_info_xml(self, xml_string):
-        """Parse the return string from a 'svn info --xml' command
-        Example string
+            statusParser.close()
+            self.changed = statusParser.changed
+            self.untracked = statusParser.untracked
 
-        <?xml version="1.0" encoding="UTF-8"?>
-        <info>
-            <entry
-               path="/home/my/sandbox" revision="5228" kind="dir">
-                <url>https://localhost/repos/myrepo/branches/feature-awesomeFeature</url>
-                <relative-url>^/branches/feature-awesomeFeature</relative-url>
-                <repository>
-                    <root>https://localhost/repos/myrepo</root>
-                    <uuid>1cf8279b-9667-814b-b667-e110318c33db</uuid>
-                </repository>
-                <wc-info>
-                    <wcroot-abspath>/home/my/sandbox</wcroot-abspath>
-                    <schedule>normal</schedule>
-                    <depth>infinity</depth>
-                </wc-info>
-                <commit revision="5228">
-                    <author>me</author>
-                    <date>2014-05-01T21:29:01.683640Z</date>
-                </commit>
-            </entry>
-        </info>
-        """
-        try:
-            info = xml.dom.minidom.parseString(xml_string.strip())
-        except ExpatError:
-            # Error parsing xml
+    def _readInfo(self, infoParser):
+        if not infoParser.hasEntry:
             return
 
         self.isRepo = True
 
-        entry = info.documentElement.getElementsByTagName("entry")[0]
-
-        branch = entry.getElementsByTagName("relative-url")[0].childNodes[0].data
-        b = re.search(r'[\^]?/([^/]*)/?([^/]*)', branch)
+        if infoParser.relativeUrl is None:
+            return
+        b = re.search(r'[\^]?/([^/]*)/?([^/]*)', infoParser.relativeUrl)
         if b:
             self.branch = b.group(1)
             if self.branch in ["branches", "tags"]:
                 self.branch += "/" + b.group(2)
 
         self.remotebranch = self.branch
-
-    def _parse_status(self, status_string):
-        """Parse the return string from a 'svn status' command
-        """
-        for line in status_string.splitlines():
-            # First 7 columns in the status lines
-            # denote the status
-            if len(line) >= 7:
-                self._parse_status_line(line[:7])
-
-    def _parse_status_line(self, line):
-        """From svn help page:
-          ' ' no modifications
-          'A' Added
-          'C' Conflicted
-          'D' Deleted
-          'I' Ignored
-          'M' Modified
-          'R' Replaced
-          'X' an unversioned directory created by an externals definition
-          '?' item is not under version control
-          '!' item is missing (removed by non-svn command) or incomplete
-          '~' versioned item obstructed by some item of a different kind
-        """
-        if line[0] in ('M', 'A', 'D', 'R', 'C', '!', '~'):  # changes in work tree
-            self.changed += 1
-
-        if line[0] in ('?', 'I'):  # untracked files
-            self.untracked += 1
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Import external modules
+import os
+import time
+from contextlib import contextmanager
+
+# Import prmpt modules
+import prmpt
+
+
+def getProcessStartTime():
+    """
+    Get the time (in seconds since the epoch) at which this process
+    started, or ``None`` if it is not known. Only Linux is supported.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, so skip past it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        ticks = os.sysconf(str("SC_CLK_TCK"))
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    # Field 22 of stat is the start time in clock ticks after boot
+    bootTime = time.time() - uptime
+    return bootTime + int(fields[19]) / ticks
+
+
+class Timer(object):
+    """
+    Records how long each phase of rendering a prompt takes. Phases are
+    timed relative to ``origin`` (the time prmpt started), and may
+    overlap (e.g. a subprocess is run during execution).
+
+    A timer that is not ``enabled`` records nothing, so phases can be
+    timed unconditionally.
+
+    ``info`` holds any other details worth reporting alongside the
+    timings, e.g. where the window size came from.
+    """
+    def __init__(self, origin=None, enabled=True):
+        self.origin = time.time() if origin is None else origin
+        self.enabled = enabled
+        self.phases = []
+        self.info = {}
+
+    def add(self, name, start, end):
+        """
+        Record a phase that ran from ``start`` to ``end``.
+        """
+        if self.enabled:
+            self.phases.append((name, start - self.origin, end - start))
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as phase ``name``.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time())
+
+    def merge(self, phases, info):
+        """
+        Add the ``phases`` and ``info`` recorded by another timer with
+        the same origin (e.g. in the daemon that rendered the prompt).
+        """
+        if self.enabled:
+            self.phases.extend(tuple(phase) for phase in phases)
+            self.info.update(info)
+
+    def getPhases(self):
+        """
+        Get the (name, start, duration) of each phase, in the order they
+        started.
+        """
+        return sorted(self.phases, key=lambda phase: phase[1])
+
+    def total(self):
+        return time.time() - self.origin
+
+    def asDict(self):
+        return {
+            "version": prmpt.__version__,
+            "pid": os.getpid(),
+            "total_ms": self.total()*1000,
+            "info": self.info,
+            "phases": [
+                {"name": name, "start_ms": start*1000, "duration_ms": duration*1000}
+                for name, start, duration in self.getPhases()
+            ],
+        }
+
+    def toJson(self):
+        """
+        Get the timings as a single line of JSON.
+        """
+        import json
+        return json.dumps(self.asDict(), sort_keys=True)
+
+    def toTable(self):
+        """
+        Get the timings as a table with one row per phase.
+        """
+        rows = ["%10s %10s  %s" % ("start ms", "ms", "phase")]
+        for name, start, duration in self.getPhases():
+            rows.append("%10.1f %10.1f  %s" % (start*1000, duration*1000, name))
+        rows.append("%10s %10.1f  %s" % ("", self.total()*1000, "total"))
+        for key in sorted(self.info):
+            rows.append("%s: %s" % (key, self.info[key]))
+        return "\n".join(rows) + "\n"
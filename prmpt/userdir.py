@@ -7,15 +7,14 @@ from __future__ import unicode_literals
 
 import os
 import sys
-import shutil
 import errno
-import distutils.dir_util
 
 
 PROMPTY_USER_DIR = os.path.join(".local", "share", "prmpt")
 PROMPTY_CONFIG_FILE = "prmpt.cfg"
 SKEL_DIR = "skel"
 FUNCTIONS_DIR = "functions"
+CACHE_DIR = "cache"
 
 
 def getPrmptBaseDir():
@@ -77,6 +76,10 @@ class UserDir(object):
 
     @staticmethod
     def copy(src, dest):
+        # Only needed the first time prmpt runs, and slow to import
+        import shutil
+        import distutils.dir_util
+
         try:
             if os.path.isdir(src):
                 distutils.dir_util.copy_tree(src, dest)
@@ -95,3 +98,6 @@ class UserDir(object):
 
     def getConfigFile(self):
         return os.path.join(self.promtyUserDir, PROMPTY_CONFIG_FILE)
+
+    def getCacheDir(self):
+        return os.path.join(self.promtyUserDir, CACHE_DIR)
@@ -9,6 +9,9 @@ import abc
 ABC = abc.ABCMeta(str('ABC'), (object,), {'__slots__': ()})  # noqa, compatible with Python 2 *and* 3
 
 from builtins import str
+import os
+import time
+import threading
 import subprocess
 
 from prmpt import functionBase
@@ -18,14 +21,24 @@ class VCS(object):
     """
     A container class for Version Control System
     sub classes.
+
+    Before any VCS command is run, the working directory and its parents
+    are searched for the ``MARKERS`` of each backend (e.g. a ``.git``
+    directory). Only backends with a marker are asked for their status,
+    so outside of a repository no commands are run at all.
     """
     def __init__(self, status):
         self.status = status
         self.vcsObjs = []
         self.ranStatus = False
         self.cwd = None
-        self.populateVCS()
-        self.currentVcsObj = self.vcsObjs[0]
+        self.currentVcsObj = None
+        self.noVcsObj = NoVCS(status)
+        # Maps a directory to the markers found in or above it
+        self.markerCache = {}
+        # Held while the status is read, as functions can be called
+        # from several threads at once
+        self.lock = threading.RLock()
 
     def populateVCS(self):
         # The order here defines the order in which repository
@@ -37,30 +50,221 @@ class VCS(object):
         from . import svn
         self.vcsObjs.append(svn.Subversion(self.status))
 
+    def findMarkers(self, path):
+        """
+        Get a dictionary mapping each marker found in ``path`` or any
+        of its parents to the nearest directory that contains it.
+        """
+        try:
+            return self.markerCache[path]
+        except KeyError:
+            pass
+
+        found = {}
+        for vcs in self.vcsObjs:
+            for marker in vcs.MARKERS:
+                if os.path.lexists(os.path.join(path, marker)):
+                    found[marker] = path
+        parent = os.path.dirname(path)
+        if parent != path:
+            for marker, root in self.findMarkers(parent).items():
+                found.setdefault(marker, root)
+        self.markerCache[path] = found
+        return found
+
+    def discover(self, path):
+        """
+        Get the backend for the repository at ``path``.
+        """
+        markers = self.findMarkers(os.path.realpath(path))
+        candidates = [vcs for vcs in self.vcsObjs if vcs.isPresent(markers)]
+        if len(candidates) > 1:
+            # Start all of their commands at once, so that finding the
+            # repository takes as long as the slowest backend rather
+            # than the sum of them
+            for vcs in candidates:
+                vcs.prefetch()
+        for vcs in candidates:
+            try:
+                if vcs.isRepo:
+                    return vcs
+            except functionBase.Timeout:
+                # It has a marker, so is probably the one. Its functions
+                # will show that it timed out.
+                return vcs
+        return self.noVcsObj
+
     def __getattribute__(self, name):
         """
         If we have not yet run a status call then run one before
         attempting to get the attribute. _runStatus() is also called
         again if the working directory has changed.
         """
-        if name in ["populateVCS", "vcsObjs", "ranStatus", "cwd", "currentVcsObj", "status"]:
+        if name in ["populateVCS", "vcsObjs", "ranStatus", "cwd", "currentVcsObj", "status",
+                    "noVcsObj", "markerCache", "findMarkers", "discover", "lock"]:
             return object.__getattribute__(self, name)
 
-        if not self.ranStatus or self.cwd != self.status.getWorkingDir():
-            self.cwd = self.status.getWorkingDir()
-            self.ranStatus = True
-            for vcs in self.vcsObjs:
-                if vcs.isRepo:
-                    self.currentVcsObj = vcs
-                    break
+        with self.lock:
+            if not self.ranStatus or self.cwd != self.status.getWorkingDir():
+                if not self.vcsObjs:
+                    # The VCS modules are only loaded when first needed
+                    self.populateVCS()
+                self.cwd = self.status.getWorkingDir()
+                self.ranStatus = True
+                self.currentVcsObj = self.discover(self.cwd)
+
+            return getattr(object.__getattribute__(self, "currentVcsObj"), name)
+
 
-        return getattr(object.__getattribute__(self, "currentVcsObj"), name)
+# Seconds to wait for the output of a killed command to be collected
+KILL_WAIT = 0.1
+
+
+class CommandTimeout(functionBase.Timeout):
+    """
+    Raised when a command has been killed for running for longer than
+    the command timeout (see :class:`prmpt.config.Config`).
+    """
+    pass
+
+
+class Command(object):
+    """
+    A command started in the background. Its output is collected by a
+    thread, so that several commands can run at once. Call
+    :meth:`result` to wait for it.
+
+    If ``consumer`` is given, the output is passed to it in chunks as
+    it is read (see :meth:`VCSBase.streamCommand`), rather than being
+    buffered.
+
+    If ``timeout`` is not 0, a command that is still running that many
+    seconds after it started is killed when its result is waited for.
+    """
+    def __init__(self, status, cmdList, consumer=None, chunkSize=65536, env=None, timeout=0):
+        self.status = status
+        self.cmdList = cmdList
+        self.consumer = consumer
+        self.chunkSize = chunkSize
+        self.timeout = timeout
+        self.killed = False
+        self.cwd = status.getWorkingDir()
+        self.output = None
+        self.exception = None
+        self.thread = None
+        self.timed = False
+        self.start = self.end = time.time()
+        try:
+            self.proc = subprocess.Popen(cmdList,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         cwd=self.cwd,
+                                         env=env)
+        except OSError as e:
+            # The command doesn't exist
+            self.exception = e
+            return
+        self.thread = threading.Thread(target=self._collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _collect(self):
+        proc = self.proc
+        try:
+            if self.consumer is None:
+                stdout, stderr = proc.communicate()
+                self.output = (stdout.decode('utf-8'), stderr.decode('utf-8'), proc.returncode)
+            else:
+                while True:
+                    chunk = proc.stdout.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    self.consumer(chunk)
+                # Only a short error message is expected, so this
+                # cannot fill the pipe while stdout is being read
+                stderr = proc.stderr.read()
+                proc.stdout.close()
+                proc.stderr.close()
+                proc.wait()
+                self.output = (stderr.decode('utf-8'), proc.returncode)
+        except Exception as e:
+            # Raised from result(), in the caller's thread
+            self.exception = e
+        finally:
+            self.end = time.time()
+
+    def result(self):
+        """
+        Wait for the command to finish. Returns (stdout, stderr, return
+        code), or (stderr, return code) if the output was streamed to a
+        consumer. Raises ``OSError`` if the command doesn't exist, and
+        :class:`CommandTimeout` if it had to be killed.
+        """
+        if self.thread is not None:
+            if not self.timeout:
+                self.thread.join()
+            elif not self.killed:
+                self.thread.join(max(0, self.start + self.timeout - time.time()))
+                if self.thread.is_alive():
+                    self._kill()
+        if not self.timed:
+            self.timed = True
+            self.status.timer.add("subprocess: " + " ".join(self.cmdList), self.start, self.end)
+        if self.killed:
+            raise CommandTimeout("%s killed after %gs" % (" ".join(self.cmdList), self.timeout))
+        if self.exception is not None:
+            raise self.exception
+        return self.output
+
+    def _kill(self):
+        self.killed = True
+        self.status.recordTimeout("%s killed after %gs" % (" ".join(self.cmdList), self.timeout))
+        try:
+            self.proc.kill()
+        except OSError:
+            # It has just finished
+            pass
+        # Anything it started could still hold the pipes open, so the
+        # output is not waited for any longer than this
+        self.thread.join(KILL_WAIT)
+        self.end = time.time()
+
+
+class Count(int):
+    """
+    A count of files that has been capped at a limit. It is shown as
+    e.g. ``999+``, but is still a number in comparisons, and to the
+    prmpt functions that take numbers (e.g. ``\\gt{\\changed}{0}``).
+    """
+    def __str__(self):
+        return "%d+" % self
+
+
+def capCount(count, limit):
+    """
+    Cap ``count`` at ``limit`` (if it is not 0), returning a
+    :class:`Count` if it is over.
+    """
+    if limit and count > limit:
+        return Count(limit)
+    return count
 
 
 class VCSBase(ABC):
     """
     An abstract base class for VCS sub classes
     """
+    # Files or directories, in the root of a working copy, that show
+    # that it may be a repository of this type
+    MARKERS = ()
+    # Environment variables that can point at a repository anywhere
+    ENVIRONMENT = ()
+    # Environment variables set for every command that is run
+    COMMAND_ENVIRONMENT = {}
+    # Attributes that can be used without running _runStatus()
+    UNTRIGGERED = ("ranStatus", "cwd", "status", "command", "started", "timedOut", "MARKERS",
+                   "ENVIRONMENT", "COMMAND_ENVIRONMENT", "UNTRIGGERED", "isPresent",
+                   "prefetch", "startCommand", "getEnvironment")
 
     @abc.abstractmethod
     def __init__(self, status, cmd):
@@ -81,6 +285,10 @@ class VCSBase(ABC):
         self.commit = ""
         self.last_fetched = 0
         self.relative_root = ""
+        # The working directory and commands started by prefetch()
+        self.started = None
+        # The timeout raised by _runStatus(), if it was
+        self.timedOut = None
 
     @abc.abstractmethod
     def _runStatus(self):
@@ -96,30 +304,133 @@ class VCSBase(ABC):
         If we have not yet run a status call then run one before
         attempting to get the attribute. _runStatus() is also called
         again if the working directory has changed.
+
+        If _runStatus() timed out, the timeout is raised for every
+        attribute, so that none of them are shown as if they were known.
         """
-        if name in ["ranStatus", "cwd", "status"]:
+        if name in object.__getattribute__(self, "UNTRIGGERED"):
             return object.__getattribute__(self, name)
 
         if not self.ranStatus or self.cwd != self.status.getWorkingDir():
             self.cwd = self.status.getWorkingDir()
             self.ranStatus = True
-            self._runStatus()
+            self.timedOut = None
+            try:
+                self._runStatus()
+            except functionBase.Timeout as e:
+                self.timedOut = e
+        if self.timedOut is not None:
+            raise self.timedOut
         return object.__getattribute__(self, name)
 
+    def isPresent(self, markers):
+        """
+        Return ``True`` if ``markers`` (see :meth:`VCS.findMarkers`)
+        show that the working directory could be in a repository of
+        this type.
+        """
+        if any(os.environ.get(name) for name in self.ENVIRONMENT):
+            return True
+        return any(marker in markers for marker in self.MARKERS)
+
+    def fingerprint(self):
+        """
+        Get a value that changes whenever the repository's status is
+        likely to have changed, cheaply (i.e. without running the VCS),
+        or ``None`` if results cannot be cached.
+        """
+        return None
+
+    def prefetch(self):
+        """
+        Start any commands that _runStatus() will need, without waiting
+        for them, and record them in ``started``. Backends that
+        support this override it.
+        """
+        pass
+
+    def takeStarted(self):
+        """
+        Get the commands started by :meth:`prefetch` for the current
+        working directory, or ``None``.
+        """
+        started, self.started = self.started, None
+        if started is None or started[0] != self.status.getWorkingDir():
+            return None
+        return started[1]
+
+    def getEnvironment(self):
+        """
+        The environment to run commands in, or ``None`` to inherit
+        prmpt's own.
+        """
+        if not self.COMMAND_ENVIRONMENT:
+            return None
+        env = dict(os.environ)
+        env.update(self.COMMAND_ENVIRONMENT)
+        return env
+
+    def startCommand(self, cmdList, consumer=None):
+        """
+        Start a command in the background, returning a :class:`Command`.
+        """
+        return Command(self.status, cmdList, consumer, env=self.getEnvironment(),
+                       timeout=self.status.config.commandTimeout)
+
+    def startBackground(self, cmdList, outputFile, cwd=None):
+        """
+        Start a command that carries on after the prompt has been
+        rendered, and is not waited for. Its output is written to
+        ``outputFile`` once it has finished successfully (and not at
+        all otherwise).
+        """
+        script = '"$@" > "$0.tmp" && mv "$0.tmp" "$0"'
+        with open(os.devnull, "r+b") as devnull:
+            try:
+                subprocess.Popen(["sh", "-c", script, outputFile] + cmdList,
+                                 stdin=devnull,
+                                 stdout=devnull,
+                                 stderr=devnull,
+                                 cwd=cwd or self.status.getWorkingDir(),
+                                 env=self.getEnvironment(),
+                                 close_fds=True,
+                                 preexec_fn=os.setsid)
+            except OSError:
+                # It will be tried again later
+                pass
+
     def runCommand(self, cmdList):
-        # Raises OSError if command doesn't exist
-        proc = subprocess.Popen(cmdList,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                cwd=self.status.getWorkingDir())
-        stdout, stderr = proc.communicate()
-        return stdout.decode('utf-8'), stderr.decode('utf-8'), proc.returncode
+        # Raises OSError if command doesn't exist, or CommandTimeout
+        return self.startCommand(cmdList).result()
+
+    def streamCommand(self, cmdList, consumer):
+        """
+        Run a command, passing its output to ``consumer`` one chunk of
+        bytes at a time as it is read from the pipe, rather than
+        buffering all of it. Returns the stderr and return code.
+        """
+        # Raises OSError if command doesn't exist, or CommandTimeout
+        return self.startCommand(cmdList, consumer).result()
+
+
+class NoVCS(VCSBase):
+    """
+    The backend used when the working directory is not in a repository.
+    """
+    def __init__(self, status):
+        super(NoVCS, self).__init__(status, None)
+
+    def _runStatus(self):
+        self.isRepo = False
 
 
 # --------------------------
 # Prmpt functions
 # --------------------------
 class VCSFunctions(functionBase.PrmptFunctions):
+    # The status is read once per render, possibly by running commands
+    STABLE = True
+    BLOCKING = True
 
     def isrepo(self):
         """
@@ -165,19 +476,19 @@ class VCSFunctions(functionBase.PrmptFunctions):
         """
         Get the number of files that are currently staged.
         """
-        return self.status.vcs.staged
+        return capCount(self.status.vcs.staged, self.status.config.countLimit)
 
     def changed(self):
         """
         Get the number of files that are modified and not staged.
         """
-        return self.status.vcs.changed
+        return capCount(self.status.vcs.changed, self.status.config.countLimit)
 
     def untracked(self):
         """
         Get the number of untracked files that are in the repository (excluding those ignored).
         """
-        return self.status.vcs.untracked
+        return capCount(self.status.vcs.untracked, self.status.config.countLimit)
 
     def last_fetched(self):
         """
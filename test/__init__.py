@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+import io
 import os
 import sys
 import imp
@@ -183,10 +184,28 @@ if True or "assertSequenceEqual" not in dir(UnitTestWrapper):
     setattr(UnitTestWrapper, "assertSequenceEqual", _assertSequenceEqual)
 
 
+class MockPipe(io.BytesIO):
+    """
+    A pipe that raises ``exception`` (if set) when it is read.
+    """
+    def __init__(self, data, exception=None):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        io.BytesIO.__init__(self, data)
+        self.exception = exception
+
+    def read(self, *args):
+        if self.exception:
+            raise self.exception
+        return io.BytesIO.read(self, *args)
+
+
 class MockProc(object):
 
     def __init__(self, output):
-        (self.stdout, self.stderr, self.returncode, self.exception) = output
+        (stdout, stderr, self.returncode, self.exception) = output
+        self.stdout = MockPipe(stdout, self.exception)
+        self.stderr = MockPipe(stderr)
 
     def __getattr__(self, key):
         if key == 'returncode':
@@ -198,4 +217,7 @@ class MockProc(object):
         if self.exception:
             raise self.exception
         else:
-            return (self.stdout, self.stderr)
+            return (self.stdout.getvalue(), self.stderr.getvalue())
+
+    def wait(self):
+        return self.returncode
@@ -15,6 +15,9 @@ from test.test_functionContainer import *
 from test.test_functions import *
 from test.test_vcs import *
 from test.test_skel import *
+from test.test_daemon import *
+from test.test_cache import *
+from test.test_inotify import *
 
 
 if __name__ == "__main__":
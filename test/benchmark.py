@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+"""
+Benchmarks for prmpt. These are not part of the unit tests, run them
+from the source directory with:
+
+    python -m test.benchmark [benchmark ...]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import timeit
+
+from test import prmpt
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def _bestOf(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def _nestedTemplate(depth):
+    """
+    A template with ``depth`` levels of nested functions, each of which
+    adds some literal text and coloured output.
+    """
+    return (r"\lower{\green{literal text}" * depth) + ("}" * depth)
+
+
+def _wideTemplate(width):
+    r"""
+    A template of ``width`` sibling \green{...} calls.
+    """
+    return r"\green{literal text}\space" * width
+
+
+@benchmark
+def render():
+    """
+    Render time against template size. The time per node should stay
+    roughly constant as templates grow (i.e. linear scaling).
+    """
+    funcs = prmpt.functionContainer.FunctionContainer()
+    funcs.addFunctionsFromModule(prmpt.functions)
+    funcs.addFunctionsFromModule(prmpt.colours)
+
+    for name, template in [("nested", _nestedTemplate), ("wide", _wideTemplate)]:
+        print("%-8s %8s %12s %12s" % (name, "nodes", "render (ms)", "us/node"))
+        for size in [25, 50, 100, 200, 400]:
+            c = prmpt.compiler.Compiler(funcs)
+            c.compile(template(size))
+            # Each level has three function calls and a literal
+            nodes = size * 4
+            t = _bestOf(c.execute)
+            print("%-8s %8d %12.3f %12.3f" % ("", nodes, t*1000, t*1e6/nodes))
+        print()
+
+
+def _makeRepo(directory, files):
+    """
+    Create a git repository in ``directory`` with ``files`` committed
+    files (spread over directories of 100), a tenth of them modified
+    and as many untracked files again.
+    """
+    import os
+    import subprocess
+
+    def git(*args):
+        # No automatic gc, which could still be running at clean up
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(("git", "-C", directory, "-c", "gc.auto=0") + args,
+                                  stdout=devnull)
+
+    git("init", "-q")
+    for i in range(files):
+        subdir = os.path.join(directory, "d%d" % (i // 100))
+        if not os.path.isdir(subdir):
+            os.mkdir(subdir)
+        with open(os.path.join(subdir, "f%d" % i), "w") as f:
+            f.write("%d\n" % i)
+    git("add", ".")
+    git("-c", "user.name=prmpt", "-c", "user.email=prmpt@localhost", "commit", "-q", "-m", "files")
+    for i in range(0, files, 10):
+        with open(os.path.join(directory, "d%d" % (i // 100), "f%d" % i), "a") as f:
+            f.write("changed\n")
+        with open(os.path.join(directory, "d%d" % (i // 100), "u%d" % i), "w") as f:
+            f.write("untracked\n")
+
+
+@benchmark
+def largeRepo():
+    """
+    Time to read the status of synthetic repositories, in the normal
+    way and in large repository mode (where untracked files are counted
+    in the background, so not timed here).
+    """
+    import time
+    import shutil
+    import tempfile
+
+    print("%8s %12s %12s" % ("files", "normal (ms)", "large (ms)"))
+    for files in [1000, 10000, 50000]:
+        directory = tempfile.mkdtemp()
+        cacheDir = tempfile.mkdtemp()
+        try:
+            _makeRepo(directory, files)
+            times = []
+            for large in (False, True):
+                def read():
+                    status = prmpt.status.Status(0, directory)
+                    status.config.largeRepoFiles = 1 if large else 0
+                    status.config.largeRepoTime = 0
+                    status.repoStats = prmpt.cache.RepoStats(cacheDir)
+                    # Pretend the untracked files were counted just now
+                    status.repoStats.set(directory, {"untrackedTime": time.time()})
+                    g = prmpt.git.Git(status)
+                    return g.staged, g.changed, g.untracked
+                times.append(_bestOf(read))
+            print("%8d %12.1f %12.1f" % (files, times[0]*1000, times[1]*1000))
+        finally:
+            shutil.rmtree(directory)
+            shutil.rmtree(cacheDir)
+    print()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    names = argv[1:]
+    for func in BENCHMARKS:
+        if not names or func.__name__ in names:
+            print("== %s ==" % func.__name__)
+            print(func.__doc__.strip())
+            print()
+            func()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+"""
+Prmpt functions defined with ``async def``, which is not valid syntax
+in Python 2.
+"""
+import asyncio
+
+from test import prmpt
+
+
+class AsyncFunctions(prmpt.functionBase.PrmptFunctions):
+    async def asyncSlow(self, name, seconds="0.2"):
+        await asyncio.sleep(float(seconds))
+        return name
+
+    async def asyncBroken(self):
+        await asyncio.sleep(0.1)
+        raise ValueError("async broken")
+
+    async def asyncEcho(self, text):
+        proc = await asyncio.create_subprocess_exec(
+            "echo", text, stdout=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await proc.communicate()
+        return stdout.decode("utf-8").strip()
+
+    @prmpt.functionBase.volatile
+    async def asyncVolatile(self):
+        return "volatile"
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import mock
+
+from test import prmpt
+from test import UnitTestWrapper
+
+
+class ParseCacheTests(UnitTestWrapper):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = prmpt.cache.ParseCache(os.path.join(self.tmpDir, "cache"))
+        self.promptFile = os.path.join(self.tmpDir, "test.prmpt")
+        with open(self.promptFile, "w") as f:
+            f.write("\\green{\\user}")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def loadConfig(self):
+        c = prmpt.config.Config()
+        c.promptFile = self.promptFile
+        c.loadPromptFile()
+        return c
+
+    def test_storeAndLoad(self):
+        key = self.cache.makeKey(self.promptFile, 1.0, 10)
+        parsed = prmpt.parser.Parser().parseNodes("\\green{\\user}")
+        self.assertIs(None, self.cache.load(key))
+        self.cache.store(key, parsed)
+        self.assertEqual(parsed, self.cache.load(key))
+
+    def test_stale(self):
+        key = self.cache.makeKey(self.promptFile, 1.0, 10)
+        self.cache.store(key, [])
+        self.assertIs(None, self.cache.load(self.cache.makeKey(self.promptFile, 2.0, 10)))
+        self.assertIs(None, self.cache.load(self.cache.makeKey(self.promptFile, 1.0, 11)))
+
+    def test_corrupt(self):
+        key = self.cache.makeKey(self.promptFile, 1.0, 10)
+        self.cache.store(key, [])
+        with open(self.cache._filename(key), "wb") as f:
+            f.write(b"\x00garbage")
+        self.assertIs(None, self.cache.load(key))
+
+    def test_compileWarm(self):
+        c = self.loadConfig()
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.addFunctionsFromModule(prmpt.colours)
+
+        cold = prmpt.compiler.Compiler(funcs, self.cache)
+        cold.compile(c.promptString, c.getPromptFileKey())
+        expected = cold.execute()
+
+        warm = prmpt.compiler.Compiler(funcs, self.cache)
+        with mock.patch.object(warm.parser, "parseNodes", side_effect=AssertionError("parsed")):
+            warm.compile(c.promptString, c.getPromptFileKey())
+        self.assertEqual(expected, warm.execute())
+
+    def test_compileRebuildsCorrupt(self):
+        c = self.loadConfig()
+        funcs = prmpt.functionContainer.FunctionContainer()
+        key = self.cache.makeKey(*c.getPromptFileKey())
+        self.cache.store(key, [])
+        with open(self.cache._filename(key), "wb") as f:
+            f.write(b"\x00garbage")
+
+        comp = prmpt.compiler.Compiler(funcs, self.cache)
+        comp.compile(c.promptString, c.getPromptFileKey())
+        self.assertEqual(comp.parsedStruct, self.cache.load(key))
+
+    def test_modifiedPromptString(self):
+        c = self.loadConfig()
+        self.assertEqual(self.promptFile, c.getPromptFileKey()[0])
+        c.promptString = "\\red{\\user}"
+        self.assertIs(None, c.getPromptFileKey())
+
+
+class VCSCacheTests(UnitTestWrapper):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = prmpt.cache.VCSCache(os.path.join(self.tmpDir, "cache"), maxAge=30, maxEntries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_storeAndLoad(self):
+        key = self.cache.makeKey("/repo", ((1.0, 10), None))
+        self.assertIs(None, self.cache.load(key))
+        self.cache.store(key, {"untracked": 3, "remoteBranch": "origin/master"})
+        self.assertEqual({"untracked": 3, "remoteBranch": "origin/master"}, self.cache.load(key))
+
+    def test_stale(self):
+        self.cache.store(self.cache.makeKey("/repo", ((1.0, 10),)), {})
+        self.assertIs(None, self.cache.load(self.cache.makeKey("/repo", ((2.0, 10),))))
+
+    def test_loadStale(self):
+        self.cache.store(self.cache.makeKey("/repo", ((1.0, 10),)), {"untracked": 1})
+        key = self.cache.makeKey("/repo", ((2.0, 10),))
+        with mock.patch("prmpt.cache.time.time", return_value=1e10):
+            self.assertEqual({"untracked": 1}, self.cache.load(key, stale=True))
+        self.assertIs(None, self.cache.load(self.cache.makeKey("/other", ()), stale=True))
+
+    def test_expired(self):
+        key = self.cache.makeKey("/repo", ())
+        with mock.patch("prmpt.cache.time.time", return_value=1000.0):
+            self.cache.store(key, {})
+        with mock.patch("prmpt.cache.time.time", return_value=1029.0):
+            self.assertEqual({}, self.cache.load(key))
+        with mock.patch("prmpt.cache.time.time", return_value=1031.0):
+            self.assertIs(None, self.cache.load(key))
+
+    def test_bounded(self):
+        for i, root in enumerate(["/a", "/b", "/c"]):
+            self.cache.store(self.cache.makeKey(root, ()), {})
+            os.utime(self.cache._filename(self.cache.makeKey(root, ())), (i, i))
+        self.cache._prune()
+        self.assertIs(None, self.cache.load(self.cache.makeKey("/a", ())))
+        self.assertEqual({}, self.cache.load(self.cache.makeKey("/c", ())))
+        self.assertEqual(2, len(os.listdir(self.cache.cacheDir)))
+
+    def test_repoStats(self):
+        stats = prmpt.cache.RepoStats(self.cache.cacheDir)
+        self.assertEqual({}, stats.get("/repo"))
+        with mock.patch("prmpt.cache.time.time", return_value=0.0):
+            stats.set("/repo", {"statusTime": 2.5})
+        # Kept however old, and separately from the status
+        self.assertEqual({"statusTime": 2.5}, stats.get("/repo"))
+        self.assertIs(None, self.cache.load(self.cache.makeKey("/repo", None)))
@@ -108,6 +108,22 @@ class ColourFunctionTests(UnitTestWrapper):
         self.assertEqual("\001\033[32m\002I'm green\001\033[0m\002",  c._call("green", "I'm green"))
         self.assertEqual("\001\033[31m\002I'm red\001\033[0m\002",    c._call("red", "I'm red"))
 
+    def test_shell(self):
+        c = prmpt.functionContainer.FunctionContainer()
+        c.addFunctionsFromModule(prmpt.colours)
+        # Chosen by the daemon for each request, not by prompts
+        self.assertNotIn("setShell", c.functions)
+        self.assertNotIn("_setShell", c.functions)
+        colours = prmpt.colours.Colours
+        default = (colours.NOCOUNT_START, colours.NOCOUNT_END)
+        try:
+            colours._setShell("zsh")
+            self.assertEqual("%{\033[32m%}", c._call("startColour", "green"))
+            colours._setShell("bash")
+            self.assertEqual("\001\033[32m\002", c._call("startColour", "green"))
+        finally:
+            colours.NOCOUNT_START, colours.NOCOUNT_END = default
+
 
 class PaletteTests(UnitTestWrapper):
     def test_defaultPalette(self):
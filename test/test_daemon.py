@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import mock
+
+from test import prmpt
+from test import UnitTestWrapper
+
+
+class DaemonTests(UnitTestWrapper):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.socketPath = os.path.join(self.tmpDir, prmpt.daemon.SOCKET_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def startDaemon(self):
+        d = prmpt.daemon.Daemon(self.socketPath, idleTimeout=5)
+        t = threading.Thread(target=d.serve)
+        t.daemon = True
+        t.start()
+        # Wait for the socket to appear
+        for _ in range(100):
+            if os.path.exists(self.socketPath):
+                break
+            time.sleep(0.01)
+        return d, t
+
+    def test_noDaemon(self):
+        c = prmpt.daemon.Client(self.socketPath)
+        self.assertIs(None, c.render(0))
+
+    def test_render(self):
+        d, t = self.startDaemon()
+        c = prmpt.daemon.Client(self.socketPath)
+        prompt = c.render(1, os.getcwd(), columns="80", lines="24", shell="bash")
+        self.assertIsInstance(prompt, type(""))
+        self.assertGreater(len(prompt), 0)
+        self.assertEqual(1, d.prompt.status.exitCode)
+        self.assertEqual(80, d.prompt.status.window.column)
+
+        # A second render must not repeat the first
+        self.assertEqual(len(prompt), len(c.render(1, os.getcwd(), columns="80", shell="bash")))
+
+        d.running = False
+        c.render(0)
+        t.join(5)
+
+    def test_environment(self):
+        d = prmpt.daemon.Daemon(self.socketPath)
+        seen = []
+        d._render = lambda request, timer: seen.append(os.environ.get("GIT_DIR"))
+        os.environ.pop("GIT_DIR", None)
+        os.environ["PRMPT_DAEMON"] = "1"
+        try:
+            # Rendered in the client's environment...
+            d.render({"environ": {"GIT_DIR": "/repo.git"}})
+            self.assertEqual(["/repo.git"], seen)
+            # ...and then the daemon's own again
+            self.assertNotIn("GIT_DIR", os.environ)
+            self.assertEqual("1", os.environ.get("PRMPT_DAEMON"))
+        finally:
+            del os.environ["PRMPT_DAEMON"]
+
+    @mock.patch('prmpt.daemon._receive')
+    @mock.patch('prmpt.daemon._send')
+    @mock.patch('prmpt.daemon.socket')
+    def test_clientEnvironment(self, mock_socket, mock_send, mock_receive):
+        mock_receive.return_value = {"prompt": "$ "}
+        with mock.patch.dict(os.environ, {"GIT_DIR": "/repo.git"}):
+            self.assertEqual("$ ", prmpt.daemon.Client(self.socketPath).render(0))
+        self.assertEqual("/repo.git", mock_send.call_args[0][1]["environ"]["GIT_DIR"])
+
+    def test_timer(self):
+        d, t = self.startDaemon()
+        c = prmpt.daemon.Client(self.socketPath)
+        timer = prmpt.timing.Timer()
+        self.assertIsNotNone(c.render(0, os.getcwd(), columns="80", shell="bash", timer=timer))
+        # The phases timed by the daemon are shown by the client
+        names = [phase[0] for phase in timer.getPhases()]
+        self.assertIn("parse", names)
+        self.assertIn("execute", names)
+        self.assertIn("memo", timer.info)
+        for name, start, duration in timer.getPhases():
+            self.assertGreaterEqual(start, 0)
+            self.assertLess(start, timer.total())
+        # The daemon only times renders that ask for it
+        self.assertFalse(d.prompt.status.timer.enabled)
+
+        d.running = False
+        c.render(0)
+        t.join(5)
+
+    def test_versionMismatch(self):
+        d, t = self.startDaemon()
+        c = prmpt.daemon.Client(self.socketPath, version="0.0.0")
+        self.assertIs(None, c.render(0))
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertFalse(os.path.exists(self.socketPath))
+
+    def test_singleDaemon(self):
+        d, t = self.startDaemon()
+        prmpt.daemon.LOCK_TIMEOUT, timeout = 0, prmpt.daemon.LOCK_TIMEOUT
+        try:
+            self.assertFalse(prmpt.daemon.Daemon(self.socketPath).serve())
+        finally:
+            prmpt.daemon.LOCK_TIMEOUT = timeout
+        prmpt.daemon.Client(self.socketPath, version="0.0.0").render(0)
+        t.join(5)
@@ -7,10 +7,17 @@ from __future__ import unicode_literals
 
 import sys
 import os
+import time
+import unittest
 
 from test import prmpt
 from test import UnitTestWrapper
 
+if sys.version_info >= (3, 5):
+    from test.py3 import asyncFunctions
+else:
+    asyncFunctions = None
+
 
 class MyFunctions(prmpt.functionBase.PrmptFunctions):
     def testFunc(self):
@@ -20,6 +27,44 @@ class MyFunctions(prmpt.functionBase.PrmptFunctions):
         return "This is secret"
 
 
+class CountingFunctions(prmpt.functionBase.PrmptFunctions):
+    calls = []
+
+    @prmpt.functionBase.stable
+    def stableFunc(self, arg="", style=None):
+        self.calls.append("stable")
+        return arg.upper()
+
+    def volatileFunc(self):
+        self.calls.append("volatile")
+        return "v"
+
+
+class SlowFunctions(prmpt.functionBase.PrmptFunctions):
+    @prmpt.functionBase.blocking
+    def slow(self, name, seconds="0.2"):
+        time.sleep(float(seconds))
+        return name
+
+    @prmpt.functionBase.blocking
+    def broken(self):
+        time.sleep(0.1)
+        raise ValueError("broken")
+
+    # Set by the tests
+    value = ""
+    delay = 0
+
+    @prmpt.functionBase.blocking
+    def sleepy(self):
+        time.sleep(SlowFunctions.delay)
+        return SlowFunctions.value
+
+    @prmpt.functionBase.blocking
+    def killed(self):
+        raise prmpt.functionBase.Timeout("killed")
+
+
 class FunctionContainerTests(UnitTestWrapper):
     def test_noname(self):
         c = prmpt.functionContainer.FunctionContainer()
@@ -37,3 +82,167 @@ class FunctionContainerTests(UnitTestWrapper):
         # Import this directory
         c.addFunctionsFromDir(os.path.dirname(sys.modules[__name__].__file__))
         self.assertEqual(r"This Is A Test", c._call("testFunc"))
+
+    def countingContainer(self):
+        CountingFunctions.calls = []
+        c = prmpt.functionContainer.FunctionContainer(prmpt.status.Status(0))
+        c.addFunctionsFromModule(sys.modules[__name__])
+        return c
+
+    def test_memoised(self):
+        c = self.countingContainer()
+        comp = prmpt.compiler.Compiler(c)
+        comp.compile(r"\stableFunc{a}\stableFunc{a}\stableFunc{b}\volatileFunc\volatileFunc")
+        self.assertEqual("AABvv", comp.execute())
+        self.assertEqual(["stable", "stable", "volatile", "volatile"], CountingFunctions.calls)
+        self.assertEqual("1 hits, 2 misses", c.status.timer.info["memo"])
+
+        # Every render starts afresh
+        comp.execute()
+        self.assertEqual(4, CountingFunctions.calls.count("stable"))
+
+    def test_memoKeywords(self):
+        c = self.countingContainer()
+        c.startRender()
+        c._call("stableFunc", "a", style="bold")
+        c._call("stableFunc", "a", style="bold")
+        c._call("stableFunc", "a")
+        # Unhashable arguments are not memoised
+        c._call("stableFunc", "a", style=["bold"])
+        c._call("stableFunc", "a", style=["bold"])
+        c.endRender()
+        self.assertEqual(4, len(CountingFunctions.calls))
+
+        # Not memoised outside a render
+        c._call("stableFunc", "a")
+        c._call("stableFunc", "a")
+        self.assertEqual(6, len(CountingFunctions.calls))
+
+    def test_isStable(self):
+        funcs = prmpt.functionBase
+        self.assertTrue(funcs.isStable(CountingFunctions().stableFunc))
+        self.assertFalse(funcs.isStable(CountingFunctions().volatileFunc))
+        self.assertTrue(funcs.isStable(prmpt.vcs.VCSFunctions().staged))
+        self.assertTrue(funcs.isStable(prmpt.functions.MiscFunctions().lower))
+        self.assertFalse(funcs.isStable(prmpt.functions.MiscFunctions().randomcolour))
+
+    def test_prefetch(self):
+        c = self.countingContainer()
+        c.addFunctionsFromModule(prmpt.functions)
+        comp = prmpt.compiler.Compiler(c)
+        comp.compile(r"\slow{a}\ifexpr{\stableFunc}{\slow{b}}{\slow{c}}\slow{d}\slow{a}")
+        start = time.time()
+        self.assertEqual("acda", comp.execute())
+        # The calls wait at the same time
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual([("slow", "a"), ("slow", "b"), ("slow", "c"), ("slow", "d")],
+                         comp.blockingCalls)
+
+    def test_prefetchError(self):
+        c = self.countingContainer()
+        comp = prmpt.compiler.Compiler(c)
+        comp.compile("\n" + r"\slow{a}\broken")
+        self.assertEqual("Prmpt error on line 2: broken\n$ ", comp.execute())
+
+    def test_prefetchClaimed(self):
+        c = self.countingContainer()
+        c.startRender()
+        prmpt.functionContainer.MAX_THREADS, maxThreads = 1, prmpt.functionContainer.MAX_THREADS
+        try:
+            c.prefetch([("slow", "a", "0.3"), ("slow", "b", "0.3")])
+        finally:
+            prmpt.functionContainer.MAX_THREADS = maxThreads
+        # The second call is made here rather than waiting for a thread
+        start = time.time()
+        self.assertEqual("b", c._call("slow", "b", "0.3"))
+        self.assertLess(time.time() - start, 0.45)
+        c.endRender()
+
+    def test_getTimeout(self):
+        c = self.countingContainer()
+        c.status.config.functionTimeout = 3.0
+        c.status.config.functionTimeouts = {"stablefunc": 0.5}
+        self.assertEqual(3.0, c.getTimeout("slow"))
+        self.assertEqual(0.5, c.getTimeout("stableFunc"))
+        self.assertEqual(0, c.getTimeout("volatileFunc"))
+
+    def test_timeout(self):
+        c = self.countingContainer()
+        c.status.config.functionTimeouts = {"sleepy": 0.2}
+        SlowFunctions.value, SlowFunctions.delay = "a", 0
+        self.assertEqual("a", c._call("sleepy"))
+
+        # The last value is used while the call is too slow
+        SlowFunctions.value, SlowFunctions.delay = "b", 0.5
+        start = time.time()
+        self.assertEqual("a", c._call("sleepy"))
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(["\\sleepy timed out after 0.2s"], c.status.timeouts)
+
+        # And is replaced once the call finishes
+        time.sleep(0.4)
+        SlowFunctions.value, SlowFunctions.delay = "c", 0.5
+        self.assertEqual("b", c._call("sleepy"))
+
+        # Elsewhere there is no last value
+        c.status.workingDir = "/"
+        c.status.config.timeoutPlaceholder = "?"
+        self.assertEqual("?", c._call("sleepy"))
+
+    def test_timeoutPrefetched(self):
+        c = self.countingContainer()
+        c.status.config.functionTimeouts = {"slow": 0.3}
+        c.status.config.timeoutPlaceholder = "?"
+        comp = prmpt.compiler.Compiler(c)
+        comp.compile(r"\slow{a}\slow{b}{1}\slow{c}{0.1}")
+        start = time.time()
+        self.assertEqual("a?c", comp.execute())
+        # Timed from the start of the render
+        self.assertLess(time.time() - start, 0.45)
+
+    def test_timeoutRaised(self):
+        c = self.countingContainer()
+        c.status.config.timeoutPlaceholder = "?"
+        self.assertEqual("?", c._call("killed"))
+        c.status.config.functionTimeout = 0
+        self.assertEqual("?", c._call("killed"))
+
+
+@unittest.skipIf(asyncFunctions is None, "async def needs Python 3.5")
+class AsyncFunctionTests(UnitTestWrapper):
+    def asyncContainer(self):
+        c = prmpt.functionContainer.FunctionContainer(prmpt.status.Status(0))
+        c.addFunctionsFromModule(asyncFunctions)
+        return c
+
+    def test_isAsync(self):
+        functions = asyncFunctions.AsyncFunctions(None)
+        self.assertTrue(prmpt.functionBase.isAsync(functions.asyncSlow))
+        self.assertTrue(prmpt.functionBase.isStable(functions.asyncSlow))
+        self.assertTrue(prmpt.functionBase.isBlocking(functions.asyncSlow))
+        self.assertFalse(prmpt.functionBase.isStable(functions.asyncVolatile))
+        self.assertFalse(prmpt.functionBase.isAsync(MyFunctions(None).testFunc))
+
+    def test_call(self):
+        c = self.asyncContainer()
+        # Outside of a render
+        self.assertEqual("a", c._call("asyncSlow", "a", "0"))
+        self.assertEqual("volatile", c._call("asyncVolatile"))
+        self.assertEqual("hello", c._call("asyncEcho", "hello"))
+
+    def test_concurrent(self):
+        c = self.asyncContainer()
+        c.addFunctionsFromModule(sys.modules[__name__])
+        comp = prmpt.compiler.Compiler(c)
+        comp.compile(r"\asyncSlow{a}\asyncSlow{b}\slow{c}\asyncSlow{d}\asyncEcho{e}")
+        start = time.time()
+        self.assertEqual("abcde", comp.execute())
+        # The coroutines and the blocking call wait at the same time
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_error(self):
+        c = self.asyncContainer()
+        comp = prmpt.compiler.Compiler(c)
+        comp.compile("\n" + r"\asyncSlow{a}\asyncBroken")
+        self.assertEqual("Prmpt error on line 2: async broken\n$ ", comp.execute())
+
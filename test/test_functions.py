@@ -16,7 +16,6 @@ import getpass
 import mock
 
 from test import prmpt
-from test import MockProc
 from test import UnitTestWrapper
 
 
@@ -115,17 +114,8 @@ class StandardFunctionTests(UnitTestWrapper):
         self.assertEqual('', c._call("join", "/"))
         self.assertRaises(TypeError, c._call, "join")
 
-    @mock.patch('prmpt.status.subprocess')
-    def test_justify(self, mock_sp):
-        # Set up mock
-        output = (
-            "54 13",
-            "",
-            0,
-            None
-        )
-        mock_sp.Popen.return_value = MockProc(output)
-
+    @mock.patch.dict(os.environ, {"COLUMNS": "13", "LINES": "54"})
+    def test_justify(self):
         c = prmpt.functionContainer.FunctionContainer()
         c.addFunctionsFromModule(prmpt.functions)
         self.assertEqual('|     |     |', c._call("justify", "|", "|", "|"))
@@ -200,6 +190,32 @@ class ExpressionFunctionTests(UnitTestWrapper):
         self.assertEqual("", c._call("ifexpr", "0", "1"))
         self.assertEqual("1", c._call("ifexpr", "1", "1"))
 
+    def test_ifLazy(self):
+        c = prmpt.functionContainer.FunctionContainer()
+        c.addFunctionsFromModule(prmpt.functions)
+        then = prmpt.functionBase.Thunk(lambda: "1")
+        other = prmpt.functionBase.Thunk(mock.Mock(side_effect=AssertionError))
+        self.assertEqual("1", c._call("ifexpr", "True", then, other))
+        self.assertEqual(set([1, 2]), c.getLazyArgs("ifexpr"))
+
+    def test_and(self):
+        c = prmpt.functionContainer.FunctionContainer()
+        c.addFunctionsFromModule(prmpt.functions)
+        self.assertEqual(True, c._call("and", "True", "1"))
+        self.assertEqual(False, c._call("and", "True", "0"))
+        self.assertEqual(True, c._call("and"))
+        unused = prmpt.functionBase.Thunk(mock.Mock(side_effect=AssertionError))
+        self.assertEqual(False, c._call("and", "False", unused))
+
+    def test_or(self):
+        c = prmpt.functionContainer.FunctionContainer()
+        c.addFunctionsFromModule(prmpt.functions)
+        self.assertEqual(True, c._call("or", "False", "1"))
+        self.assertEqual(False, c._call("or", "False", "0"))
+        self.assertEqual(False, c._call("or"))
+        unused = prmpt.functionBase.Thunk(mock.Mock(side_effect=AssertionError))
+        self.assertEqual(True, c._call("or", "True", unused))
+
     def test_exitSuccess(self):
         c = prmpt.functionContainer.FunctionContainer(prmpt.status.Status(0))
         c.addFunctionsFromModule(prmpt.functions)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from test import prmpt
+from test import MockProc
+from test import UnitTestWrapper
+
+try:
+    prmpt.inotify.Inotify().close()
+    HAVE_INOTIFY = True
+except OSError:
+    HAVE_INOTIFY = False
+
+
+@unittest.skipUnless(HAVE_INOTIFY, "inotify is not available")
+class RepoWatcherTests(UnitTestWrapper):
+    def setUp(self):
+        self.tmpDir = os.path.realpath(tempfile.mkdtemp())
+        self.watcher = prmpt.inotify.RepoWatcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpDir)
+
+    def makeRepo(self, name, dirs=()):
+        root = os.path.join(self.tmpDir, name)
+        os.makedirs(os.path.join(root, ".git", "refs", "heads"))
+        for d in dirs:
+            os.makedirs(os.path.join(root, d))
+        return root
+
+    def touch(self, *path):
+        with open(os.path.join(*path), "a") as f:
+            f.write("x")
+
+    def test_storeAndLookup(self):
+        root = self.makeRepo("a", ["src/deep"])
+        self.assertIs(None, self.watcher.lookup(root))
+        self.watcher.store(root, [os.path.join(root, ".git")], {"untracked": 1})
+        self.assertEqual({"untracked": 1}, self.watcher.lookup(root))
+
+        self.touch(root, "src", "deep", "file")
+        self.assertIs(None, self.watcher.lookup(root))
+        self.assertEqual({"untracked": 1}, self.watcher.lookup(root, stale=True))
+
+        self.watcher.store(root, [os.path.join(root, ".git")], {"untracked": 2})
+        self.assertEqual({"untracked": 2}, self.watcher.lookup(root))
+
+    def test_gitDir(self):
+        root = self.makeRepo("a")
+        gitDir = os.path.join(root, ".git")
+        self.watcher.store(root, [gitDir], {})
+
+        # Lock files come and go while git works
+        self.touch(gitDir, "index.lock")
+        os.remove(os.path.join(gitDir, "index.lock"))
+        self.assertEqual({}, self.watcher.lookup(root))
+
+        self.touch(gitDir, "refs", "heads", "master")
+        self.assertIs(None, self.watcher.lookup(root))
+
+    def test_changedWhileRead(self):
+        root = self.makeRepo("a")
+        gitDirs = [os.path.join(root, ".git")]
+        token = self.watcher.startRead(root, gitDirs)
+        self.touch(root, "file")
+        self.watcher.store(root, gitDirs, {"changed": 0}, token)
+        self.assertIs(None, self.watcher.lookup(root))
+
+        # Events from before the read started do not count
+        self.touch(root, "file")
+        token = self.watcher.startRead(root, gitDirs)
+        self.watcher.store(root, gitDirs, {"changed": 1}, token)
+        self.assertEqual({"changed": 1}, self.watcher.lookup(root))
+
+    def test_remoteRefs(self):
+        root = self.makeRepo("a")
+        gitDir = os.path.join(root, ".git")
+        os.makedirs(os.path.join(gitDir, "refs", "remotes", "origin"))
+        self.watcher.store(root, [gitDir], {"ahead": 1})
+
+        # A push updates the remote branch
+        self.touch(gitDir, "refs", "remotes", "origin", "master")
+        self.assertIs(None, self.watcher.lookup(root))
+        self.watcher.store(root, [gitDir], {"ahead": 0})
+
+        # Or packs it
+        self.touch(gitDir, "packed-refs")
+        self.assertIs(None, self.watcher.lookup(root))
+        self.watcher.store(root, [gitDir], {"ahead": 0})
+
+        # Branches can be in new directories
+        os.makedirs(os.path.join(gitDir, "refs", "heads", "feature"))
+        self.watcher.store(root, [gitDir], {"ahead": 0})
+        self.touch(gitDir, "refs", "heads", "feature", "x")
+        self.assertIs(None, self.watcher.lookup(root))
+        self.watcher.store(root, [gitDir], {"ahead": 0})
+
+        # Other directories in the git directory are not watched
+        os.makedirs(os.path.join(gitDir, "objects", "ab"))
+        self.watcher.store(root, [gitDir], {"ahead": 0})
+        self.touch(gitDir, "objects", "ab", "cdef")
+        self.assertEqual({"ahead": 0}, self.watcher.lookup(root))
+
+    def test_maxAge(self):
+        root = self.makeRepo("a")
+        self.watcher.maxAge = 10
+        with mock.patch('prmpt.inotify.time.time', return_value=1000):
+            self.watcher.store(root, [os.path.join(root, ".git")], {})
+        with mock.patch('prmpt.inotify.time.time', return_value=1009):
+            self.assertEqual({}, self.watcher.lookup(root))
+        with mock.patch('prmpt.inotify.time.time', return_value=1010):
+            self.assertIs(None, self.watcher.lookup(root))
+            self.assertEqual({}, self.watcher.lookup(root, stale=True))
+
+    def test_newDirectory(self):
+        root = self.makeRepo("a")
+        self.watcher.store(root, [os.path.join(root, ".git")], {})
+        os.mkdir(os.path.join(root, "new"))
+        self.watcher.store(root, [os.path.join(root, ".git")], {})
+
+        self.touch(root, "new", "file")
+        self.assertIs(None, self.watcher.lookup(root))
+
+    def test_nested(self):
+        outer = self.makeRepo("outer")
+        inner = self.makeRepo(os.path.join("outer", "inner"), ["src"])
+        self.watcher.store(outer, [os.path.join(outer, ".git")], {"untracked": 0})
+        self.watcher.store(inner, [os.path.join(inner, ".git")], {"untracked": 0})
+
+        # Both see changes in the directories they share
+        self.touch(inner, "src", "file")
+        self.assertIs(None, self.watcher.lookup(outer))
+        self.assertIs(None, self.watcher.lookup(inner))
+        self.watcher.store(outer, [os.path.join(outer, ".git")], {"untracked": 1})
+
+        # And the outer one still does once the inner one is forgotten
+        self.watcher.forget(inner)
+        self.assertEqual({"untracked": 1}, self.watcher.lookup(outer))
+        self.touch(inner, "src", "file")
+        self.assertIs(None, self.watcher.lookup(outer))
+
+    def test_leastRecentlyUsed(self):
+        self.watcher.maxRepos = 2
+        a, b, c = (self.makeRepo(name) for name in "abc")
+        for root in (a, b):
+            self.watcher.store(root, [os.path.join(root, ".git")], {})
+        self.watcher.lookup(a)
+        self.watcher.store(c, [os.path.join(c, ".git")], {})
+
+        self.assertEqual([a, c], list(self.watcher.repos))
+        self.assertEqual({}, self.watcher.lookup(a))
+        self.assertIs(None, self.watcher.lookup(b))
+        for owners in self.watcher.watches.values():
+            for repo in owners:
+                self.assertIn(repo.root, (a, c))
+
+    def test_watchLimit(self):
+        a = self.makeRepo("a", ["x", "y"])
+        b = self.makeRepo("b", ["x", "y", "z"])
+        # Enough for the first repository, but not both
+        self.watcher.maxWatches = 9
+        self.watcher.store(a, [os.path.join(a, ".git")], {})
+        self.watcher.store(b, [os.path.join(b, ".git")], {})
+        self.assertEqual([b], list(self.watcher.repos))
+        self.assertEqual({}, self.watcher.lookup(b))
+
+        # A repository that is too big is never trusted
+        self.watcher.maxWatches = 5
+        self.watcher.forget(b)
+        self.watcher.store(b, [os.path.join(b, ".git")], {})
+        self.assertIs(None, self.watcher.lookup(b))
+        self.assertEqual({}, self.watcher.watches)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_git(self, mock_sp):
+        root = self.makeRepo("a")
+        with open(os.path.join(root, ".git", "HEAD"), "w") as f:
+            f.write("ref: refs/heads/master\n")
+        output = (b"# branch.oid (initial)\0# branch.head master\0? x\0", b"", 0, None)
+        mock_sp.Popen.side_effect = [MockProc(output), MockProc(output)]
+
+        status = prmpt.status.Status(0, root)
+        status.vcsWatcher = self.watcher
+        self.assertEqual(1, prmpt.git.Git(status).untracked)
+        self.assertEqual(1, prmpt.git.Git(status).untracked)
+        self.assertEqual(1, mock_sp.Popen.call_count)
+
+        self.touch(root, "x")
+        self.assertEqual(1, prmpt.git.Git(status).untracked)
+        self.assertEqual(2, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_gitChangedWhileRead(self, mock_sp):
+        root = self.makeRepo("a")
+        with open(os.path.join(root, ".git", "HEAD"), "w") as f:
+            f.write("ref: refs/heads/master\n")
+        output = (b"# branch.oid (initial)\0# branch.head master\0", b"", 0, None)
+
+        def run(*args, **kwargs):
+            if mock_sp.Popen.call_count == 1:
+                # The user saves a file while git status runs
+                self.touch(root, "x")
+            return MockProc(output)
+        mock_sp.Popen.side_effect = run
+
+        status = prmpt.status.Status(0, root)
+        status.vcsWatcher = self.watcher
+        self.assertEqual(0, prmpt.git.Git(status).untracked)
+        self.assertEqual(0, prmpt.git.Git(status).untracked)
+        self.assertEqual(2, mock_sp.Popen.call_count)
@@ -4,7 +4,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+from builtins import chr
 
+import re
+import time
+import shlex
 import socket
 import getpass
 
@@ -12,6 +16,52 @@ from test import prmpt
 from test import UnitTestWrapper
 
 
+class ShlexLexer(shlex.shlex):
+    """ The original shlex based lexer, retained as a reference
+    implementation for :class:`prmpt.lexer.Lexer`. It produces the same
+    tokens, except that non-ASCII characters are split into single
+    character tokens.
+
+    Inherits usage from shlex
+    https://docs.python.org/2/library/shlex.html
+    """
+    SPECIAL_CHARS = prmpt.lexer.Lexer.SPECIAL_CHARS
+    COMMENT_CHAR = prmpt.lexer.Lexer.COMMENT_CHAR
+
+    def __init__(self, instream):
+        instream = self.fixComments(instream)
+        instream = self.fixLineNumbers(instream)
+
+        shlex.shlex.__init__(self, instream=instream)
+        asciiCharSet = set([chr(i) for i in range(128)])
+        # Discard special chars
+        for char in self.SPECIAL_CHARS:
+            asciiCharSet.discard(char)
+        self.wordchars = ''.join(asciiCharSet)
+        self.commenters = self.COMMENT_CHAR
+
+    @staticmethod
+    def fixComments(instream):
+        """Fix for bug where newline at end of comment gets treated
+        as part of the comment (causing 'A\n#comment\nB' to be rendered
+        as 'AB' instead of the intended 'A,B').
+             http://bugs.python.org/issue7089
+
+        This works by ensuring there is always whitespace between the
+        last 'real' character and the comment character.
+        """
+        return re.sub(ShlexLexer.COMMENT_CHAR,
+                      " " + ShlexLexer.COMMENT_CHAR,
+                      instream)
+
+    @staticmethod
+    def fixLineNumbers(instream):
+        """Fix broken line number reporting by ensuring that every line
+        has a trailing whitespace character
+        """
+        return re.sub(r"([\r]?)\n", r" \1\n", instream)
+
+
 class LexerTests(UnitTestWrapper):
     def test_singleStringLiteral(self):
         lex = prmpt.lexer.Lexer(r"literal")
@@ -97,33 +147,33 @@ class LexerTests(UnitTestWrapper):
     def test_fixComments(self):
         i = "% comment"
         o = " % comment"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixComments(i))
+        self.assertEqual(o, ShlexLexer.fixComments(i))
         i = "A% comment\nB"
         o = "A % comment\nB"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixComments(i))
+        self.assertEqual(o, ShlexLexer.fixComments(i))
         i = "% comment\nB %comment\n%comment"
         o = " % comment\nB  %comment\n %comment"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixComments(i))
+        self.assertEqual(o, ShlexLexer.fixComments(i))
         i = "\\myfunc{% comment\n\targ% comment\n}% comment"
         o = "\\myfunc{ % comment\n\targ % comment\n} % comment"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixComments(i))
+        self.assertEqual(o, ShlexLexer.fixComments(i))
 
     def test_fixLineNumbers(self):
         i = "% comment"
         o = i
-        self.assertEqual(o, prmpt.lexer.Lexer.fixLineNumbers(i))
+        self.assertEqual(o, ShlexLexer.fixLineNumbers(i))
         i = "% comment\n"
         o = "% comment \n"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixLineNumbers(i))
+        self.assertEqual(o, ShlexLexer.fixLineNumbers(i))
         i = "\nA\nB"
         o = " \nA \nB"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixLineNumbers(i))
+        self.assertEqual(o, ShlexLexer.fixLineNumbers(i))
         i = "\r\nA\r\nB"
         o = " \r\nA \r\nB"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixLineNumbers(i))
+        self.assertEqual(o, ShlexLexer.fixLineNumbers(i))
         i = " \nA \nB"
         o = "  \nA  \nB"
-        self.assertEqual(o, prmpt.lexer.Lexer.fixLineNumbers(i))
+        self.assertEqual(o, ShlexLexer.fixLineNumbers(i))
 
     def test_lineNumbers(self):
         s = r"""% Comment (line 1)
@@ -170,6 +220,77 @@ class LexerTests(UnitTestWrapper):
         self.assertEqual(10, lex.lineno)
         self.assertFalse(lex.get_token())
 
+    def test_unicodeLiteral(self):
+        lex = prmpt.lexer.Lexer("\\green{h\u00e9llo \u2192\u2192}")
+        self.assertEqual(
+            ["\\", "green", "{", "h\u00e9llo", "\u2192\u2192", "}"],
+            list(lex)
+        )
+
+
+class LexerEquivalenceTests(UnitTestWrapper):
+    """
+    Check the regex Lexer against the original shlex based lexer.
+    """
+    ALPHABET = (
+        ["\\", "{", "}", "[", "]", "%", " ", "\t", "\n", "\r\n", "\r",
+         "'", '"', "\x0b", "a", "green", "1", ":", "$"] * 4 +
+        ["\u00e9", "\u2192", "\u00a0"]
+    )
+
+    @staticmethod
+    def tokens(lex):
+        out = []
+        while True:
+            token = lex.get_token()
+            out.append((token, lex.lineno))
+            if not token:
+                return out
+
+    @staticmethod
+    def tokensByLine(tokens):
+        """
+        Join the tokens on each line, as the old lexer splits non-ASCII
+        text into single characters.
+        """
+        lines = []
+        for token, lineno in tokens:
+            if lines and lines[-1][0] == lineno:
+                lines[-1][1] += token
+            else:
+                lines.append([lineno, token])
+        return lines
+
+    def assertSameTokens(self, s):
+        expected = self.tokens(ShlexLexer(s))
+        actual = self.tokens(prmpt.lexer.Lexer(s))
+        if all(ord(c) < 128 for c in s):
+            self.assertEqual(expected, actual, repr(s))
+        else:
+            self.assertEqual(
+                self.tokensByLine(expected), self.tokensByLine(actual), repr(s)
+            )
+
+    def test_skel(self):
+        import glob
+        import io
+        import os
+        skelDir = os.path.join(os.path.dirname(prmpt.__file__), "..", "skel")
+        files = glob.glob(os.path.join(skelDir, "*.prmpt"))
+        self.assertTrue(files)
+        for filename in files:
+            with io.open(filename, encoding="utf-8") as f:
+                self.assertSameTokens(f.read())
+
+    def test_fuzz(self):
+        import random
+        rand = random.Random(7089)
+        for _ in range(2000):
+            s = "".join(
+                rand.choice(self.ALPHABET) for _ in range(rand.randint(0, 40))
+            )
+            self.assertSameTokens(s)
+
 
 class ParserTests(UnitTestWrapper):
     def test_stringLiteral(self):
@@ -329,6 +450,25 @@ class ParserTests(UnitTestWrapper):
                            }],
                          p.parse("\\green[bold][\\bg]{\\user}"))
 
+    def test_nodes(self):
+        p = prmpt.parser.Parser()
+        Call = prmpt.parser.Call
+        Literal = prmpt.parser.Literal
+        self.assertEqual([Call("green", 1,
+                               [[Call("user", 1)]],
+                               [[Literal("bold", 1)], [Call("bg", 1)]]),
+                          Literal("text", 2)],
+                         p.parseNodes("\\green[bold][\\bg]{\\user}\ntext"))
+        self.assertFalse(hasattr(Literal("text", 1), "__dict__"))
+
+    def test_nodeConversions(self):
+        p = prmpt.parser.Parser()
+        s = "\\green[bold][\\bg]{\\user{a}{b}}\ntext\\space"
+        nodes = p.parseNodes(s)
+        self.assertEqual(p.parse(s), prmpt.parser.toDicts(nodes))
+        self.assertEqual(nodes, prmpt.parser.fromDicts(p.parse(s)))
+        self.assertEqual(nodes, prmpt.parser.load(prmpt.parser.dump(nodes)))
+
 
 class CompilerTests(UnitTestWrapper):
     user = getpass.getuser()
@@ -449,6 +589,194 @@ class CompilerTests(UnitTestWrapper):
                                                        [{'lineno': 1, 'type': 'literal', 'value': '1'}]],
                                               'lineno': 1, 'type': 'function', 'name': 'equals'}]))
 
+    def test_lazyBranches(self):
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        calls = []
+
+        def expensive():
+            calls.append(1)
+            return "expensive"
+        funcs.addFunction("expensive", expensive)
+        c = prmpt.compiler.Compiler(funcs)
+        c.compile(r"\ifexpr{0}{\expensive}{cheap}")
+        c.compile(r"\ifexpr{\and{0}{\expensive}}{\expensive}")
+        c.compile(r"\ifexpr{\or{1}{\expensive}}{ok}")
+        self.assertEqual("cheapok", c.execute())
+        self.assertEqual(0, len(calls))
+
+        c = prmpt.compiler.Compiler(funcs)
+        c.compile(r"\ifexpr{1}{\expensive}{\expensive}")
+        self.assertEqual("expensive", c.execute())
+        self.assertEqual(1, len(calls))
+
+    def test_cursorScannedOnce(self):
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.addFunctionsFromModule(prmpt.colours)
+        c = prmpt.compiler.Compiler(funcs, optimise=False)
+        c.compile(r"\green{a\bold{b\lower{C\space d}}}\newline e")
+
+        scanned = []
+        incFromString = funcs.status.pos.incFromString
+
+        def countingIncFromString(string):
+            scanned.append(string)
+            incFromString(string)
+        funcs.status.pos.incFromString = countingIncFromString
+
+        out = c.execute()
+        # Every output character is scanned exactly once
+        self.assertEqual(out, "".join(scanned))
+        self.assertEqual(1, funcs.status.pos.row)
+        self.assertEqual(1, funcs.status.pos.column)
+
+    def test_constantFolding(self):
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.addFunctionsFromModule(prmpt.colours)
+        o = prmpt.optimiser.Optimiser(funcs)
+        Literal = prmpt.parser.Literal
+        nodes = prmpt.parser.Parser().parseNodes(
+            "\\green{a\\bold{b\\lower{C\\space d}}}\\newline e\\user"
+        )
+        folded = o.optimise(nodes)
+        self.assertEqual(2, len(folded))
+        self.assertEqual(
+            Literal("\001\033[32m\002a\001\033[1m\002bc d\001\033[0m\002\001\033[0m\002\ne", 1),
+            folded[0]
+        )
+        self.assertEqual((1, 1, True), folded[0].movement)
+        self.assertEqual(prmpt.parser.Call("user", 1), folded[1])
+        # The input is not modified
+        self.assertEqual("green", nodes[0].name)
+
+        # Not even literals that are passed through unchanged
+        nodes = prmpt.parser.Parser().parseNodes("a\\user")
+        folded = o.optimise(nodes)
+        self.assertEqual((0, 1, False), folded[0].movement)
+        self.assertIs(None, nodes[0].movement)
+
+    def test_constantFoldingImpure(self):
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.addFunctionsFromModule(prmpt.colours)
+        o = prmpt.optimiser.Optimiser(funcs)
+        Call = prmpt.parser.Call
+        Literal = prmpt.parser.Literal
+        nodes = prmpt.parser.Parser().parseNodes(
+            "\\ifexpr{\\exitsuccess}{\\upper{ok}}{\\unichar{0x2718}}\\justify{a}{b}{c}"
+        )
+        self.assertEqual(
+            [Call("ifexpr", 1, [[Call("exitsuccess", 1)], [Literal("OK", 1)], [Literal("\u2718", 1)]]),
+             Call("justify", 1, [[Literal("a", 1)], [Literal("b", 1)], [Literal("c", 1)]])],
+            o.optimise(nodes)
+        )
+        # Errors are left for the compiler to report
+        nodes = prmpt.parser.Parser().parseNodes("\\green[nostyle]{a}")
+        self.assertEqual(nodes, o.optimise(nodes))
+
+    def test_foldedCursor(self):
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.addFunctionsFromModule(prmpt.colours)
+        c = prmpt.compiler.Compiler(funcs)
+        c.compile(r"\green{a\bold{b\lower{C\space d}}}\newline e\user")
+
+        scanned = []
+        funcs.status.pos.incFromString = scanned.append
+        out = c.execute()
+        # Only the output of \user is scanned while rendering
+        self.assertEqual([CompilerTests.user], scanned)
+        self.assertTrue(out.endswith("\ne" + CompilerTests.user))
+        self.assertEqual(1, funcs.status.pos.row)
+        self.assertEqual(1, funcs.status.pos.column)
+
+    def segmentCompiler(self, budget):
+        funcs = prmpt.functionContainer.FunctionContainer()
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.status.config.renderBudget = budget
+        return prmpt.compiler.Compiler(funcs)
+
+    def test_segmentOrder(self):
+        c = self.segmentCompiler(10)
+        order = []
+
+        def mark(name):
+            order.append(name)
+            return name
+        c.funcs.addFunction("mark", mark)
+        c.funcs.addFunction("low", prmpt.functionBase.priority(-2)(lambda: mark("f")))
+        c.compile(r"\mark{a}\segment[-1]{\mark{b}}\segment[2.5]{\mark{c}}\segment{\mark{d}}"
+                  r"\mark{e}\low")
+        self.assertEqual("abcdef", c.execute())
+        # Highest priority first, and then the rest of the prompt
+        self.assertEqual(["c", "d", "b", "f", "a", "e"], order)
+        self.assertEqual(6, c.funcs.status.pos.column)
+
+        # Without a budget, everything is in order
+        del order[:]
+        c.funcs.status.config.renderBudget = 0
+        self.assertEqual("abcdef", c.execute())
+        self.assertEqual(["a", "b", "c", "d", "e", "f"], order)
+
+    def test_segmentBudget(self):
+        c = self.segmentCompiler(0.15)
+        c.funcs.status.workingDir = "/"
+
+        def slow(name):
+            time.sleep(0.1)
+            return name
+        c.funcs.addFunction("slow", slow)
+        c.compile(r"\segment[1]{\slow{a}}" + "\n" + r"\segment{\slow{b}}\workingdir")
+        self.assertEqual("ab/", c.execute())
+        self.assertNotIn("skipped segments", c.funcs.status.timer.info)
+
+        # Now that it is known how long they take, only one fits
+        start = time.time()
+        self.assertEqual("ab/", c.execute())
+        self.assertLess(time.time() - start, 0.15)
+        self.assertEqual("line 2 (priority 0, cached)",
+                         c.funcs.status.timer.info["skipped segments"])
+
+        # There is no output to reuse elsewhere
+        c.funcs.status.workingDir = "/tmp"
+        self.assertEqual("a/tmp", c.execute())
+        self.assertEqual("line 2 (priority 0)", c.funcs.status.timer.info["skipped segments"])
+
+    def test_segmentRetried(self):
+        c = self.segmentCompiler(0.15)
+        delays = [0.3]
+
+        def slow(name):
+            time.sleep(delays[0])
+            return name + str(delays[0])
+        c.funcs.addFunction("slow", slow)
+        c.compile(r"\segment{\slow{a}}b")
+        self.assertEqual("a0.3b", c.execute())
+
+        # Skipped while it is expected to be slow, but then tried again
+        delays[0] = 0
+        outputs = [c.execute() for _ in range(4)]
+        self.assertEqual(["a0.3b", "a0.3b", "a0b", "a0b"], outputs)
+
+    def test_segmentDeadline(self):
+        c = self.segmentCompiler(0.2)
+        c.funcs.status.config.timeoutPlaceholder = "?"
+        c.funcs.addFunction("hang", prmpt.functionBase.blocking(lambda: time.sleep(1)))
+        c.compile(r"\segment{\hang}b")
+        start = time.time()
+        self.assertEqual("?b", c.execute())
+        # Blocking calls in segments stop waiting at the end of the budget
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual(["\\hang ran out of render budget"], c.funcs.status.timeouts)
+
+    def test_segmentPriorityError(self):
+        c = self.segmentCompiler(0.2)
+        c.compile(r"a\segment[x]{b}")
+        self.assertEqual([], c._findSegments(c.parsedStruct))
+        self.assertTrue(c.execute().startswith("Prmpt error on line 1: "))
+
 #    def test_position
 
 
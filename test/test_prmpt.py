@@ -13,7 +13,9 @@ import re
 import socket
 import shutil
 import tempfile
+import json
 import unittest
+import subprocess
 import distutils.spawn
 from contextlib import contextmanager
 from io import StringIO
@@ -100,6 +102,55 @@ class MainTests(UnitTestWrapper):
         self.assertEqual(err.getvalue(), "")
         self.assertEqual(ret, 0)
 
+    def test_debug(self):
+        argv = ["", "-d", "0"]
+        with captured_output() as (out, err):
+            ret = prmpt_bin.main(argv)
+
+        lines = out.getvalue().splitlines()
+        self.assertIn("phase", lines[0])
+        self.assertTrue(any(line.endswith("  execute") for line in lines))
+        self.assertEqual(ret, 0)
+
+    def test_debugJson(self):
+        argv = ["", "--debug-json", "0"]
+        with captured_output() as (out, err):
+            ret = prmpt_bin.main(argv)
+
+        timings = json.loads(out.getvalue().splitlines()[0])
+        names = [phase["name"] for phase in timings["phases"]]
+        for name in ["import", "status", "functions", "config", "parse", "execute"]:
+            self.assertIn(name, names)
+        self.assertGreater(timings["total_ms"], 0)
+        self.assertEqual(ret, 0)
+
+
+class TimerTests(UnitTestWrapper):
+    def test_phases(self):
+        t = prmpt.timing.Timer(origin=100.0)
+        t.add("second", 101.0, 101.5)
+        t.add("first", 100.0, 102.0)
+        with t.phase("block"):
+            pass
+        self.assertEqual(
+            [("first", 0.0, 2.0), ("second", 1.0, 0.5)],
+            t.getPhases()[:2]
+        )
+        self.assertEqual("block", t.getPhases()[2][0])
+
+    def test_disabled(self):
+        t = prmpt.timing.Timer(enabled=False)
+        t.add("phase", 0, 1)
+        with t.phase("block"):
+            pass
+        self.assertEqual([], t.phases)
+
+    def test_subprocess(self):
+        s = prmpt.status.Status(0, timer=prmpt.timing.Timer())
+        g = prmpt.git.Git(s)
+        g.runCommand(["git", "--version"])
+        self.assertIn("subprocess: git --version", [p[0] for p in s.timer.phases])
+
 
 class CoordsTests(UnitTestWrapper):
     def test_init(self):
@@ -121,6 +172,69 @@ class CoordsTests(UnitTestWrapper):
         self.assertEqual(4, c3.column)
         self.assertEqual(6, c3.row)
 
+    def test_incFromString(self):
+        c = prmpt.status.Coords()
+        c.incFromString("four")
+        self.assertEqual(4, c.column)
+        c.incFromString("ab\ncd\nefg")
+        self.assertEqual(3, c.column)
+        self.assertEqual(2, c.row)
+        c.incFromString("abcdef\rx")
+        self.assertEqual(1, c.column)
+        self.assertEqual(2, c.row)
+
+    def test_incFromStringNonPrinting(self):
+        start = prmpt.colours.Colours.NOCOUNT_START
+        end = prmpt.colours.Colours.NOCOUNT_END
+        c = prmpt.status.Coords()
+        c.incFromString(start + "\033[31m" + end + "red4" + start + "\033[0m" + end)
+        self.assertEqual(4, c.column)
+        c.incFromString(start + "\n\n" + end + "four" + end + start + "unterminated\n")
+        self.assertEqual(8, c.column)
+        self.assertEqual(0, c.row)
+
+
+class StatusTests(UnitTestWrapper):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ.pop("COLUMNS", None)
+        os.environ.pop("LINES", None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_windowFromEnv(self):
+        os.environ["COLUMNS"] = "120"
+        os.environ["LINES"] = "40"
+        s = prmpt.status.Status()
+        self.assertIs(None, s.windowSource)
+        self.assertEqual(120, s.window.column)
+        self.assertEqual(40, s.window.row)
+        self.assertEqual(s.WINDOW_ENV, s.windowSource)
+
+    def test_windowFromTty(self):
+        os.environ["COLUMNS"] = "not a number"
+        s = prmpt.status.Status()
+        s._getTtySize = lambda: (24, 80)
+        self.assertEqual(80, s.window.column)
+        self.assertEqual(24, s.window.row)
+        self.assertEqual(s.WINDOW_TTY, s.windowSource)
+
+    def test_windowUnknown(self):
+        s = prmpt.status.Status()
+        s._getTtySize = lambda: None
+        self.assertEqual(0, s.window.column)
+        self.assertEqual(s.WINDOW_UNKNOWN, s.windowSource)
+
+    def test_windowSet(self):
+        s = prmpt.status.Status()
+        s.window = prmpt.status.Coords(10, 5)
+        self.assertEqual(10, s.window.column)
+        self.assertEqual(s.WINDOW_SET, s.windowSource)
+        s.reset()
+        self.assertIs(None, s.windowSource)
+
 
 class PromptTests(UnitTestWrapper):
     def test_create(self):
@@ -189,9 +303,69 @@ class ConfigTests(UnitTestWrapper):
             os.path.join(os.path.dirname(TEST_DIR), prmpt.userdir.SKEL_DIR, "default.prmpt"),
             c.promptFile
         )
+        self.assertEqual(3.0, c.functionTimeout)
+        self.assertEqual("\u2026", c.timeoutPlaceholder)
+
+    def test_loadTimeouts(self):
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        configFile = os.path.join(tmpDir, "prmpt.cfg")
+        with open(configFile, "w") as f:
+            f.write("[prompt]\nprompt_file = default.prmpt\n"
+                    "[timeouts]\ncommand = 0.5\nplaceholder = ?\n"
+                    "[function_timeouts]\nrepoBranch = 0.25\n")
+        open(os.path.join(tmpDir, "default.prmpt"), "w").close()
+        c = prmpt.config.Config()
+        c.load(configFile)
+        self.assertEqual(0.5, c.commandTimeout)
+        self.assertEqual(3.0, c.functionTimeout)
+        self.assertEqual("?", c.timeoutPlaceholder)
+        self.assertEqual({"repobranch": 0.25}, c.functionTimeouts)
 
     def test_loadPrompt(self):
         c = prmpt.config.Config()
         c.promptFile = os.path.join(os.path.dirname(TEST_DIR), prmpt.userdir.SKEL_DIR, "default.prmpt")
         c.loadPromptFile()
         self.assertGreater(len(c.promptString), 0)
+
+
+class ImportTests(UnitTestWrapper):
+    RENDER_SCRIPT = """
+import sys, json
+sys.path.insert(0, sys.argv[1])
+import prmpt
+p = prmpt.prompt.Prompt(prmpt.status.Status(0, sys.argv[2]))
+p.getPrompt()
+print(json.dumps(sorted(sys.modules)))
+"""
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Requires module __getattr__")
+    def test_plainRenderModules(self):
+        """
+        Rendering a prompt that uses neither VCS nor user functions
+        should not load the modules that only those need.
+        """
+        homeDir = tempfile.mkdtemp()
+        userDir = os.path.join(homeDir, prmpt.userdir.PROMPTY_USER_DIR)
+        os.makedirs(userDir)
+        with open(os.path.join(userDir, prmpt.userdir.PROMPTY_CONFIG_FILE), "w") as f:
+            f.write("[prompt]\nprompt_file = plain.prmpt\n")
+        with open(os.path.join(userDir, "plain.prmpt"), "w") as f:
+            f.write("\\green{\\user}@\\hostname\\space\\workingdir\\space\\dollar")
+
+        env = dict(os.environ)
+        env["HOME"] = homeDir
+        out = subprocess.check_output(
+            [sys.executable, "-c", self.RENDER_SCRIPT, os.path.dirname(TEST_DIR), homeDir],
+            env=env
+        )
+        modules = json.loads(out.decode("utf-8"))
+        # Cleanup
+        shutil.rmtree(homeDir)
+
+        self.assertIn("prmpt.compiler", modules)
+        self.assertIn("prmpt.functions", modules)
+        for module in ["prmpt.git", "prmpt.svn", "prmpt.daemon",
+                       "xml.dom.minidom", "xml.parsers.expat", "distutils", "shutil", "imp",
+                       "asyncio", "future", "past", "shlex"]:
+            self.assertFalse(module in modules, "%s was imported" % module)
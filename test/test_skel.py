@@ -28,3 +28,22 @@ class SkelTests(UnitTestWrapper):
             print(s.replace(prmpt.colours.Colours.NOCOUNT_START, '').replace(prmpt.colours.Colours.NOCOUNT_END, ''))
             print()
         self.assertEqual(1, 1)
+
+    def test_skelOptimised(self):
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        skel_dir = os.path.join(test_dir, "..", "skel")
+        files = [os.path.join(skel_dir, f) for f in os.listdir(skel_dir) if f.endswith(".prmpt")]
+        for file in files:
+            c = prmpt.config.Config()
+            c.promptFile = file
+            c.loadPromptFile()
+            outputs = []
+            for optimise in [False, True]:
+                funcs = prmpt.functionContainer.FunctionContainer()
+                funcs.addFunctionsFromModule(prmpt.functions)
+                funcs.addFunctionsFromModule(prmpt.colours)
+                funcs.addFunctionsFromModule(prmpt.vcs)
+                comp = prmpt.compiler.Compiler(funcs, optimise=optimise)
+                comp.compile(c.promptString)
+                outputs.append((comp.execute(), funcs.status.pos.column, funcs.status.pos.row))
+            self.assertEqual(outputs[0], outputs[1], file)
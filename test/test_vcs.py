@@ -5,9 +5,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import time
+import signal
+import threading
+import subprocess
+import unittest
 import socket
 import getpass
-import distutils
+import shutil
+import tempfile
+import struct
+import zlib
+import hashlib
+import binascii
+import distutils.spawn
 import mock
 
 from test import prmpt
@@ -16,6 +28,15 @@ from test import UnitTestWrapper
 
 
 class GitTests(UnitTestWrapper):
+    """
+    Without a readable git directory every detail comes from git itself.
+    """
+    def setUp(self):
+        self.tmpDir = os.path.realpath(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
     @mock.patch('prmpt.vcs.subprocess')
     def test_init(self, mock_sp):
         # Set up mock
@@ -33,7 +54,7 @@ class GitTests(UnitTestWrapper):
         )
         mock_sp.Popen.side_effect = [MockProc(status_output), MockProc(revparse_output)]
 
-        g = prmpt.git.Git(prmpt.status.Status(0))
+        g = prmpt.git.Git(prmpt.status.Status(0, self.tmpDir))
         self.assertIsInstance(g, prmpt.vcs.VCSBase)
         self.assertEqual(g.command, prmpt.git.GIT_COMMAND)
 
@@ -54,7 +75,7 @@ class GitTests(UnitTestWrapper):
         )
         mock_sp.Popen.side_effect = [MockProc(status_output), MockProc(revparse_output)]
 
-        g = prmpt.git.Git(prmpt.status.Status(0))
+        g = prmpt.git.Git(prmpt.status.Status(0, self.tmpDir))
         self.assertEqual(False, g.installed)
         self.assertEqual(False, g.isRepo)
         self.assertEqual("", g.branch)
@@ -67,7 +88,10 @@ class GitTests(UnitTestWrapper):
     def test_cleanRepo(self, mock_sp):
         # Set up mock
         status_output = (
-            b"## develop...origin/develop\n",
+            b"# branch.oid 1234567890abcdef1234567890abcdef12345678\0" +
+            b"# branch.head develop\0" +
+            b"# branch.upstream origin/develop\0" +
+            b"# branch.ab +0 -0\0",
             b"",
             0,
             None
@@ -80,7 +104,7 @@ class GitTests(UnitTestWrapper):
         )
         mock_sp.Popen.side_effect = [MockProc(status_output), MockProc(revparse_output)]
 
-        g = prmpt.git.Git(prmpt.status.Status(0))
+        g = prmpt.git.Git(prmpt.status.Status(0, self.tmpDir))
         self.assertEqual(True, g.installed)
         self.assertEqual(True, g.isRepo)
         self.assertEqual("develop", g.branch)
@@ -94,12 +118,16 @@ class GitTests(UnitTestWrapper):
     def test_dirtyRepo(self, mock_sp):
         # Set up mock
         status_output = (
-            b"## master...origin/master [ahead 14, behind 58]\n" +
-            b"M  bin/prmpt\n" +
-            b" M prmpt/prompt.py\n" +
-            b"A  test/test_prmpt.py\n" +
-            b"AU test.py\n" +
-            b"?? test/test_git.py",
+            b"# branch.oid 1234567890abcdef1234567890abcdef12345678\0" +
+            b"# branch.head master\0" +
+            b"# branch.upstream origin/master\0" +
+            b"# branch.ab +14 -58\0" +
+            b"1 M. N... 100644 100644 100644 " + b"a"*40 + b" " + b"b"*40 + b" bin/prmpt\0" +
+            b"1 .M N... 100644 100644 100644 " + b"a"*40 + b" " + b"a"*40 + b" prmpt/prompt.py\0" +
+            b"2 R. N... 100644 100644 100644 " + b"a"*40 + b" " + b"a"*40 + b" R100 test/test_prmpt.py\0" +
+            b"test/old_prmpt.py\0" +
+            b"u AU N... 100644 100644 100644 100644 " + b"a"*40 + b" " + b"b"*40 + b" " + b"c"*40 + b" test.py\0" +
+            b"? test/test_git.py\0",
             b"",
             0,
             None
@@ -112,7 +140,7 @@ class GitTests(UnitTestWrapper):
         )
         mock_sp.Popen.side_effect = [MockProc(status_output), MockProc(revparse_output)]
 
-        g = prmpt.git.Git(prmpt.status.Status(0))
+        g = prmpt.git.Git(prmpt.status.Status(0, self.tmpDir))
         self.assertEqual(True, g.installed)
         self.assertEqual(True, g.isRepo)
         self.assertEqual("master", g.branch)
@@ -141,7 +169,7 @@ class GitTests(UnitTestWrapper):
         )
         mock_sp.Popen.side_effect = [MockProc(status_output), MockProc(revparse_output)]
 
-        g = prmpt.git.Git(prmpt.status.Status(0))
+        g = prmpt.git.Git(prmpt.status.Status(0, self.tmpDir))
         self.assertEqual(True, g.installed)
         self.assertEqual(False, g.isRepo)
         self.assertEqual("", g.branch)
@@ -155,7 +183,7 @@ class GitTests(UnitTestWrapper):
     def test_last_fetched(self, mock_sp):
         # Set up mock
         status_output = (
-            b"## develop...origin/develop\n",
+            b"# branch.oid 1234567890abcdef1234567890abcdef12345678\0# branch.head develop\0",
             b"",
             0,
             None
@@ -167,11 +195,75 @@ class GitTests(UnitTestWrapper):
             None
         )
         mock_sp.Popen.side_effect = [MockProc(status_output), MockProc(revparse_output)]
-        g = prmpt.git.Git(prmpt.status.Status(0))
+        g = prmpt.git.Git(prmpt.status.Status(0, self.tmpDir))
         self.assertGreaterEqual(g.last_fetched, 0)
         self.assertEqual('1234567', g.commit)
 
 
+class StatusParserTests(UnitTestWrapper):
+    OUTPUT = (
+        b"# branch.oid 1234567890abcdef1234567890abcdef12345678\0" +
+        b"# branch.head feature/x\0" +
+        b"# branch.upstream origin/feature/x\0" +
+        b"# branch.ab +2 -3\0" +
+        b"1 MM N... 100644 100644 100644 " + b"a"*40 + b" " + b"b"*40 + b" a file\0" +
+        b"2 R. N... 100644 100644 100644 " + b"a"*40 + b" " + b"a"*40 + b" R100 new\0" +
+        b"? looks like a record\0" +
+        b"u UU N... 100644 100644 100644 100644 " + b"a"*40 + b" " + b"b"*40 + b" " + b"c"*40 + b" c\0" +
+        b"? d\0"
+    )
+
+    def check(self, p):
+        self.assertEqual("1234567890abcdef1234567890abcdef12345678", p.oid)
+        self.assertEqual("feature/x", p.branch)
+        self.assertEqual("origin/feature/x", p.remoteBranch)
+        self.assertEqual((2, 3), (p.ahead, p.behind))
+        self.assertEqual(2, p.staged)
+        self.assertEqual(1, p.changed)
+        self.assertEqual(1, p.unmerged)
+        self.assertEqual(1, p.untracked)
+        self.assertFalse(p.detached)
+
+    def test_parse(self):
+        # The original path of a rename is not an untracked entry
+        p = prmpt.git.StatusParser()
+        p.feed(self.OUTPUT)
+        p.close()
+        self.check(p)
+
+    def test_chunks(self):
+        # Records may be split across reads
+        p = prmpt.git.StatusParser()
+        for i in range(len(self.OUTPUT)):
+            p.feed(self.OUTPUT[i:i+1])
+        p.close()
+        self.check(p)
+
+    def test_detached(self):
+        p = prmpt.git.StatusParser()
+        p.feed(b"# branch.oid " + b"a"*40 + b"\0# branch.head (detached)\0")
+        p.close()
+        self.assertTrue(p.detached)
+        self.assertEqual("", p.branch)
+
+    def test_initial(self):
+        p = prmpt.git.StatusParser()
+        p.feed(b"# branch.oid (initial)\0# branch.head master\0")
+        p.close()
+        self.assertEqual("", p.oid)
+        self.assertEqual("master", p.branch)
+
+    def test_constantMemory(self):
+        p = prmpt.git.StatusParser()
+        chunk = b"".join(b"? file%06d\0" % i for i in range(5000))
+        for _ in range(20):
+            p.feed(chunk[:-3])
+            self.assertLess(len(p._buffer), 20)
+            p.feed(chunk[-3:])
+        p.close()
+        self.assertEqual(100000, p.untracked)
+
+
 class SvnTests(UnitTestWrapper):
     def test_init(self):
         g = prmpt.svn.Subversion(prmpt.status.Status(0))
@@ -205,7 +297,7 @@ class SvnTests(UnitTestWrapper):
             0,
             None
         )
-        mock_sp.Popen.return_value = MockProc(output)
+        mock_sp.Popen.side_effect = [MockProc(output), MockProc(output)]
 
         g = prmpt.svn.Subversion(prmpt.status.Status(0))
         self.assertEqual(True, g.installed)
@@ -248,13 +340,29 @@ class SvnTests(UnitTestWrapper):
             0,
             None
         )
-        mock_sp.Popen.return_value = MockProc(output)
+        mock_sp.Popen.side_effect = [MockProc(output), MockProc((b"", b"", 0, None))]
 
         g = prmpt.svn.Subversion(prmpt.status.Status(0))
         self.assertEqual(True, g.installed)
         self.assertEqual(True, g.isRepo)
         self.assertEqual("trunk", g.branch)
 
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_infoBranch(self, mock_sp):
+        # Nothing after the relative URL is parsed
+        output = (
+            b'<?xml version="1.0" encoding="UTF-8"?>\n<info>\n<entry path="." kind="dir">\n' +
+            b'<relative-url>^/branches/feature-x</relative-url>\n<not valid xml<<\n',
+            b"",
+            0,
+            None
+        )
+        mock_sp.Popen.side_effect = [MockProc(output), MockProc((b"", b"", 0, None))]
+
+        g = prmpt.svn.Subversion(prmpt.status.Status(0))
+        self.assertEqual(True, g.isRepo)
+        self.assertEqual("branches/feature-x", g.branch)
+
     @mock.patch('prmpt.vcs.subprocess')
     def test_status(self, mock_sp):
         # Set up mock
@@ -270,8 +378,785 @@ class SvnTests(UnitTestWrapper):
             0,
             None
         )
-        mock_sp.Popen.return_value = MockProc(output)
+        mock_sp.Popen.side_effect = [MockProc((b"", b"", 0, None)), MockProc(output)]
 
         g = prmpt.svn.Subversion(prmpt.status.Status(0))
         self.assertEqual(5, g.changed)
         self.assertEqual(2, g.untracked)
+
+    def test_statusChunks(self):
+        parser = prmpt.svn.StatusParser()
+        for chunk in (b"M       a\n?   ", b"    b\nPerforming status on external item at 'c':\n",
+                      b"A  +    d"):
+            parser.feed(chunk)
+        parser.close()
+        self.assertEqual((2, 1), (parser.changed, parser.untracked))
+
+
+class CommandTests(UnitTestWrapper):
+    def test_concurrent(self):
+        status = prmpt.status.Status(0)
+        start = time.time()
+        commands = [prmpt.vcs.Command(status, ["sleep", "0.3"]) for _ in range(3)]
+        for command in commands:
+            self.assertEqual(("", "", 0), command.result())
+        self.assertLess(time.time() - start, 0.8)
+
+    def test_stream(self):
+        chunks = []
+        command = prmpt.vcs.Command(prmpt.status.Status(0), ["printf", "abcdef"], chunks.append, 2)
+        self.assertEqual(("", 0), command.result())
+        self.assertEqual(b"abcdef", b"".join(chunks))
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_notFound(self, mock_sp):
+        mock_sp.Popen.side_effect = OSError
+        command = prmpt.vcs.Command(prmpt.status.Status(0), ["nonexistent"])
+        self.assertRaises(OSError, command.result)
+
+    def test_timeout(self):
+        status = prmpt.status.Status(0)
+        start = time.time()
+        command = prmpt.vcs.Command(status, ["sleep", "5"], timeout=0.2)
+        self.assertRaises(prmpt.vcs.CommandTimeout, command.result)
+        self.assertLess(time.time() - start, 1)
+        # It was killed, not left running
+        self.assertEqual(-signal.SIGKILL, command.proc.wait())
+        self.assertEqual(["sleep 5 killed after 0.2s"], status.timeouts)
+        self.assertRaises(prmpt.vcs.CommandTimeout, command.result)
+        self.assertEqual(1, len(status.timeouts))
+
+
+@unittest.skipUnless(distutils.spawn.find_executable("git"), "git is not installed")
+class ConcurrentGitTests(UnitTestWrapper):
+    """
+    Render prompts in a real repository while git changes it.
+    """
+    COMMITS = 40
+
+    def setUp(self):
+        self.workTree = os.path.realpath(tempfile.mkdtemp())
+        self.environ = dict(os.environ)
+        os.environ.pop("GIT_DIR", None)
+        os.environ["HOME"] = self.workTree
+        os.environ["XDG_CONFIG_HOME"] = self.workTree
+        self.git("init", "-q", "-b", "master")
+        self.writeFiles(0)
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+
+    def tearDown(self):
+        shutil.rmtree(self.workTree)
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def git(self, *args):
+        proc = subprocess.Popen(
+            ("git", "-c", "user.name=prmpt", "-c", "user.email=prmpt@localhost",
+             "-c", "gc.auto=0") + args,
+            cwd=self.workTree, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stdout, stderr = proc.communicate()
+        return proc.returncode, stderr.decode("utf-8")
+
+    def writeFiles(self, n):
+        for i in range(20):
+            with open(os.path.join(self.workTree, "f%d" % i), "w") as f:
+                f.write("%d %d\n" % (n, i))
+
+    def test_concurrentWrites(self):
+        failures = []
+
+        def writer():
+            for n in range(1, self.COMMITS + 1):
+                self.writeFiles(n)
+                for args in (("add", "."), ("commit", "-q", "-m", "change %d" % n)):
+                    returncode, stderr = self.git(*args)
+                    if returncode != 0:
+                        failures.append(stderr)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        prompts = 0
+        while thread.is_alive() or prompts == 0:
+            status = prmpt.status.Status(0, self.workTree)
+            g = prmpt.git.Git(status)
+            self.assertEqual("master", g.branch)
+            g.staged, g.changed, g.untracked
+            prompts += 1
+        thread.join()
+
+        self.assertEqual([], failures)
+        self.assertFalse(os.path.exists(os.path.join(self.workTree, ".git", "index.lock")))
+        self.assertEqual(0, self.git("diff", "--quiet", "HEAD")[0])
+
+
+class CountTests(UnitTestWrapper):
+    def test_capCount(self):
+        self.assertEqual("12", str(prmpt.vcs.capCount(12, 999)))
+        self.assertEqual("999+", str(prmpt.vcs.capCount(1000, 999)))
+        self.assertEqual("1000", str(prmpt.vcs.capCount(1000, 0)))
+        # Still usable as a number
+        self.assertTrue(prmpt.vcs.capCount(1000, 999) > 0)
+
+    def test_cappedInPrompt(self):
+        status = prmpt.status.Status(0)
+        status.vcs = mock.Mock(staged=3, changed=1000, untracked=0)
+        status.config.countLimit = 999
+        funcs = prmpt.functionContainer.FunctionContainer(status)
+        funcs.addFunctionsFromModule(prmpt.functions)
+        funcs.addFunctionsFromModule(prmpt.vcs)
+        # Functions that take numbers still read the capped count
+        for prmptString, expected in (
+            (r"\changed", "999+"),
+            (r"\gt{\changed}{0}", "True"),
+            (r"\lt{\staged}{\changed}", "True"),
+            (r"\max{\changed}{5}", "999+"),
+            (r"\ifexpr{\changed}{y}{n}", "y"),
+        ):
+            comp = prmpt.compiler.Compiler(funcs)
+            comp.compile(prmptString)
+            self.assertEqual(expected, comp.execute())
+
+
+class DiscoveryTests(UnitTestWrapper):
+    def setUp(self):
+        self.tmpDir = os.path.realpath(tempfile.mkdtemp())
+        self.subDir = os.path.join(self.tmpDir, "a", "b")
+        os.makedirs(self.subDir)
+        self.environ = dict(os.environ)
+        os.environ.pop("GIT_DIR", None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_notARepo(self, mock_sp):
+        v = prmpt.vcs.VCS(prmpt.status.Status(0, self.subDir))
+        self.assertEqual(False, v.isRepo)
+        self.assertEqual("", v.branch)
+        self.assertEqual(0, v.changed)
+        self.assertFalse(mock_sp.Popen.called)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_gitDir(self, mock_sp):
+        os.mkdir(os.path.join(self.tmpDir, ".git"))
+        os.mkdir(os.path.join(self.subDir, ".svn"))
+        status_output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0", b"", 0, None)
+        revparse_output = (b"../../\nabc1234\n", b"", 0, None)
+        svn_output = (b"", b"svn: E155007: '/x' is not a working copy\n", 1, None)
+        # Both backends start their commands before either is waited on
+        mock_sp.Popen.side_effect = [
+            MockProc(status_output), MockProc(revparse_output),
+            MockProc(svn_output), MockProc(svn_output)
+        ]
+
+        v = prmpt.vcs.VCS(prmpt.status.Status(0, self.subDir))
+        self.assertEqual(True, v.isRepo)
+        self.assertEqual("master", v.branch)
+        self.assertIsInstance(v.currentVcsObj, prmpt.git.Git)
+        self.assertEqual(4, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_gitFile(self, mock_sp):
+        with open(os.path.join(self.tmpDir, ".git"), "w") as f:
+            f.write("gitdir: /elsewhere/.git/worktrees/a\n")
+        v = prmpt.vcs.VCS(prmpt.status.Status(0, self.subDir))
+        v.populateVCS()
+        self.assertEqual({".git": self.tmpDir}, v.findMarkers(self.subDir))
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_svnOnly(self, mock_sp):
+        os.mkdir(os.path.join(self.tmpDir, ".svn"))
+        mock_sp.Popen.side_effect = [
+            MockProc((b"", b"svn: E155007: not a working copy", 1, None)) for _ in range(2)
+        ]
+
+        v = prmpt.vcs.VCS(prmpt.status.Status(0, self.subDir))
+        self.assertEqual(False, v.isRepo)
+        for call in mock_sp.Popen.call_args_list:
+            self.assertEqual(prmpt.svn.SVN_COMMAND, call[0][0][0])
+
+    def test_threads(self):
+        class SlowVCS(prmpt.vcs.VCS):
+            calls = []
+
+            def discover(self, path):
+                SlowVCS.calls.append(path)
+                time.sleep(0.1)
+                return self.noVcsObj
+
+        v = SlowVCS(prmpt.status.Status(0, self.subDir))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(v.isRepo)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Only one thread looked for the repository, and the others waited
+        self.assertEqual([False] * 4, results)
+        self.assertEqual(1, len(SlowVCS.calls))
+
+    def test_memoised(self):
+        v = prmpt.vcs.VCS(prmpt.status.Status(0, self.subDir))
+        v.populateVCS()
+        v.findMarkers(self.subDir)
+        self.assertIn(self.tmpDir, v.markerCache)
+        self.assertIn(os.path.dirname(self.subDir), v.markerCache)
+
+        # Siblings reuse the cached parents
+        sibling = os.path.join(self.tmpDir, "a", "c")
+        os.mkdir(sibling)
+        os.mkdir(os.path.join(self.tmpDir, ".git"))
+        self.assertEqual({}, v.findMarkers(sibling))
+
+
+class GitDirTests(UnitTestWrapper):
+    COMMIT = "0123456789abcdef0123456789abcdef01234567"
+    OTHER = "89abcdef0123456789abcdef0123456789abcdef"
+    TAG = "fedcba9876543210fedcba9876543210fedcba98"
+
+    def setUp(self):
+        self.tmpDir = os.path.realpath(tempfile.mkdtemp())
+        self.workTree = os.path.join(self.tmpDir, "repo")
+        self.gitDir = os.path.join(self.workTree, ".git")
+        self.subDir = os.path.join(self.workTree, "a", "b")
+        os.makedirs(self.subDir)
+        self.write(".git/HEAD", "ref: refs/heads/master\n")
+        self.write(".git/refs/heads/master", self.COMMIT + "\n")
+        self.environ = dict(os.environ)
+        os.environ.pop("GIT_DIR", None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def write(self, name, contents, root=None):
+        path = os.path.join(root or self.workTree, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(contents if isinstance(contents, bytes) else contents.encode("utf-8"))
+
+    def test_looseRef(self):
+        g = prmpt.gitdir.GitDir.find(self.subDir)
+        self.assertEqual(self.workTree, g.workTree)
+        self.assertEqual(("refs/heads/master", self.COMMIT), g.readHead())
+        self.assertEqual("0123456", g.abbrev(self.COMMIT))
+        self.assertEqual("../../", g.relativeRoot(self.subDir))
+        self.assertEqual("", g.relativeRoot(self.workTree))
+
+    def test_notARepo(self):
+        self.assertIsNone(prmpt.gitdir.GitDir.find(self.tmpDir))
+
+    def test_packedRefs(self):
+        os.remove(os.path.join(self.gitDir, "refs", "heads", "master"))
+        self.write(".git/packed-refs",
+                   "# pack-refs with: peeled fully-peeled sorted\n" +
+                   self.COMMIT + " refs/heads/master\n" +
+                   self.TAG + " refs/tags/v1.0\n" +
+                   "^" + self.COMMIT + "\n" +
+                   self.OTHER + " refs/tags/v0.9\n")
+        g = prmpt.gitdir.GitDir.find(self.workTree)
+        self.assertEqual(("refs/heads/master", self.COMMIT), g.readHead())
+        self.assertEqual(["v1.0"], g.tagsAt(self.COMMIT))
+        self.assertEqual(["v0.9"], g.tagsAt(self.OTHER))
+
+    def test_unbornBranch(self):
+        os.remove(os.path.join(self.gitDir, "refs", "heads", "master"))
+        g = prmpt.gitdir.GitDir.find(self.workTree)
+        self.assertEqual(("refs/heads/master", None), g.readHead())
+        self.assertEqual("", g.abbrev(None))
+
+    def test_looseAnnotatedTag(self):
+        tagObject = ("object %s\ntype commit\ntag v2.0\n\nRelease\n" % self.COMMIT).encode("ascii")
+        self.write(".git/objects/%s/%s" % (self.TAG[:2], self.TAG[2:]),
+                   zlib.compress(b"tag %d\0" % len(tagObject) + tagObject))
+        self.write(".git/refs/tags/v2.0", self.TAG + "\n")
+        self.write(".git/refs/tags/rc/1", self.COMMIT + "\n")
+        self.write(".git/refs/tags/other", self.OTHER + "\n")
+        self.write(".git/objects/%s/%s" % (self.OTHER[:2], self.OTHER[2:]),
+                   zlib.compress(b"commit 0\0"))
+        g = prmpt.gitdir.GitDir.find(self.workTree)
+        self.assertEqual(["rc/1", "v2.0"], g.tagsAt(self.COMMIT))
+
+    def test_worktree(self):
+        # A linked worktree has its own HEAD but shares the refs
+        linked = os.path.join(self.tmpDir, "linked")
+        self.write(".git/worktrees/linked/HEAD", self.OTHER + "\n")
+        self.write(".git/worktrees/linked/commondir", "../..\n")
+        self.write(".git", "gitdir: ../repo/.git/worktrees/linked\n", root=linked)
+        self.write(".git/refs/tags/v3", self.OTHER + "\n")
+        g = prmpt.gitdir.GitDir.find(linked)
+        self.assertEqual(linked, g.workTree)
+        self.assertEqual(self.gitDir, g.commonDir)
+        self.assertEqual((None, self.OTHER), g.readHead())
+        self.assertEqual(["v3"], g.tagsAt(self.OTHER))
+
+    def test_abbrev(self):
+        self.write(".git/config", "[core]\n\tabbrev = 12\n")
+        self.assertEqual(12, prmpt.gitdir.GitDir.find(self.workTree).abbrevLength())
+
+        # Large repositories get longer names
+        fanout = b"".join(struct.pack(">I", 100000) for _ in range(256))
+        self.write(".git/config", "")
+        self.write(".git/objects/pack/pack-1.idx", b"\377tOc\0\0\0\2" + fanout)
+        self.assertEqual(9, prmpt.gitdir.GitDir.find(self.workTree).abbrevLength())
+
+        # An even number of bits (9002 objects need 14) is not rounded
+        # up again
+        fanout = b"".join(struct.pack(">I", 9002) for _ in range(256))
+        self.write(".git/objects/pack/pack-1.idx", b"\377tOc\0\0\0\2" + fanout)
+        self.assertEqual(7, prmpt.gitdir.GitDir.find(self.workTree).abbrevLength())
+
+    def test_reftable(self):
+        self.write(".git/config", "[extensions]\n\trefStorage = reftable\n")
+        with self.assertRaises(prmpt.gitdir.GitDirError):
+            prmpt.gitdir.GitDir.find(self.workTree)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_lazyStatus(self, mock_sp):
+        self.write(".git/FETCH_HEAD", "")
+        mock_sp.Popen.side_effect = [MockProc((
+            b"# branch.oid " + self.COMMIT.encode("ascii") + b"\0# branch.head master\0? x\0",
+            b"", 0, None
+        ))]
+        g = prmpt.git.Git(prmpt.status.Status(0, self.subDir))
+        self.assertEqual(True, g.isRepo)
+        self.assertEqual("master", g.branch)
+        self.assertEqual("0123456", g.commit)
+        self.assertEqual("../../", g.relative_root)
+        self.assertGreaterEqual(g.last_fetched, 0)
+        self.assertEqual(0, mock_sp.Popen.call_count)
+
+        # Only the status attributes need git
+        self.assertEqual(1, g.untracked)
+        self.assertEqual(True, g.installed)
+        self.assertEqual(1, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_detachedTag(self, mock_sp):
+        self.write(".git/HEAD", self.COMMIT + "\n")
+        self.write(".git/refs/tags/v1", self.COMMIT + "\n")
+        mock_sp.Popen.side_effect = [MockProc((b"# branch.oid " + self.COMMIT.encode("ascii") + b"\0# branch.head (detached)\0", b"", 0, None))]
+        g = prmpt.git.Git(prmpt.status.Status(0, self.workTree))
+        self.assertEqual("v1", g.branch)
+        self.assertEqual(0, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_fallback(self, mock_sp):
+        self.write(".git/config", "[extensions]\n\trefStorage = reftable\n")
+        mock_sp.Popen.side_effect = [
+            MockProc((b"# branch.oid " + self.COMMIT.encode("ascii") + b"\0# branch.head master\0", b"", 0, None)),
+            MockProc((b"\n012345678\n", b"", 0, None)),
+        ]
+        g = prmpt.git.Git(prmpt.status.Status(0, self.workTree))
+        # Abbreviated to the length rev-parse chose
+        self.assertEqual("012345678", g.commit)
+        self.assertEqual(2, mock_sp.Popen.call_count)
+
+
+class GitIndexTests(UnitTestWrapper):
+    def setUp(self):
+        self.workTree = os.path.realpath(tempfile.mkdtemp())
+        self.gitDir = os.path.join(self.workTree, ".git")
+        os.makedirs(os.path.join(self.gitDir, "refs", "heads"))
+        with open(os.path.join(self.gitDir, "HEAD"), "w") as f:
+            f.write("ref: refs/heads/master\n")
+        self.environ = dict(os.environ)
+        os.environ.pop("GIT_DIR", None)
+        # Ignore the user's own git config
+        os.environ["HOME"] = self.workTree
+        os.environ["XDG_CONFIG_HOME"] = self.workTree
+
+        self.files = {b"a": b"apple\n", b"d/b": b"banana\n", b"d/c": b"cherry\n"}
+        for path, contents in self.files.items():
+            self.writeFile(path, contents)
+        self.commit(self.files)
+        self.index = [self.entry(path) for path in sorted(self.files)]
+
+    def tearDown(self):
+        shutil.rmtree(self.workTree)
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def writeFile(self, path, contents):
+        path = os.path.join(self.workTree, path.decode("utf-8"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(contents)
+
+    def writeObject(self, kind, data):
+        raw = kind + (" %d" % len(data)).encode("ascii") + b"\0" + data
+        sha = hashlib.sha1(raw).hexdigest()
+        directory = os.path.join(self.gitDir, "objects", sha[:2])
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, sha[2:]), "wb") as f:
+            f.write(zlib.compress(raw))
+        return sha
+
+    def writeTree(self, files, prefix=b""):
+        names = {}
+        for path, contents in files.items():
+            if path.startswith(prefix):
+                name = path[len(prefix):].split(b"/")[0]
+                names[name] = b"/" in path[len(prefix):]
+        data = b""
+        for name in sorted(names):
+            if names[name]:
+                sha = self.writeTree(files, prefix + name + b"/")
+                data += b"40000 " + name + b"\0" + binascii.unhexlify(sha)
+            else:
+                sha = self.writeObject(b"blob", files[prefix + name])
+                data += b"100644 " + name + b"\0" + binascii.unhexlify(sha)
+        return self.writeObject(b"tree", data)
+
+    def commit(self, files):
+        self.tree = self.writeTree(files)
+        commit = self.writeObject(b"commit", ("tree %s\n\nmessage\n" % self.tree).encode("ascii"))
+        with open(os.path.join(self.gitDir, "refs", "heads", "master"), "w") as f:
+            f.write(commit + "\n")
+
+    def entry(self, path, contents=None, stage=0):
+        if contents is None:
+            contents = self.files[path]
+        st = os.lstat(os.path.join(self.workTree, path.decode("utf-8")))
+        sha = hashlib.sha1(b"blob %d\0" % len(contents) + contents).digest()
+        return (path, st, sha, stage)
+
+    def writeIndex(self, version=2, extensions=b"", assumeValid=()):
+        data = struct.pack(">4sII", b"DIRC", version, len(self.index))
+        previous = b""
+        for path, st, sha, stage in sorted(self.index, key=lambda e: (e[0], e[3])):
+            flags = (stage << 12) | min(len(path), 0xfff)
+            if path in assumeValid:
+                flags |= prmpt.gitdir.GitIndex.ASSUME_VALID
+            entry = struct.pack(
+                ">10I20sH",
+                int(st.st_ctime), 0, int(st.st_mtime), 0, st.st_dev & 0xffffffff,
+                st.st_ino & 0xffffffff, 0o100644, st.st_uid, st.st_gid, st.st_size,
+                sha, flags
+            )
+            if version == 4:
+                common = len(os.path.commonprefix([previous, path]))
+                entry += bytearray([len(previous) - common]) + path[common:] + b"\0"
+                previous = path
+            else:
+                entry += path
+                entry += b"\0" * (8 - len(entry) % 8)
+            data += entry
+        data += extensions
+        data += hashlib.sha1(data).digest()
+        with open(os.path.join(self.gitDir, "index"), "wb") as f:
+            f.write(data)
+
+    def status(self):
+        return prmpt.gitdir.GitDir.find(self.workTree).indexStatus()
+
+    def test_clean(self):
+        self.writeIndex()
+        self.assertEqual((0, 0, 0), self.status())
+
+    def test_version4(self):
+        self.writeFile(b"d/b", b"BANANA\n")
+        self.writeIndex(version=4)
+        self.assertEqual((0, 1, 0), self.status())
+
+    def test_changed(self):
+        # Same size and (probably) same mtime, so the contents are hashed
+        self.writeFile(b"a", b"APPLE\n")
+        os.remove(os.path.join(self.workTree, "d", "c"))
+        self.writeIndex()
+        self.assertEqual((0, 2, 0), self.status())
+
+    def test_assumeUnchanged(self):
+        # Files marked with git update-index --assume-unchanged are not
+        # checked, as in git status
+        self.writeFile(b"a", b"APPLE\n")
+        os.remove(os.path.join(self.workTree, "d", "c"))
+        self.writeIndex(assumeValid=[b"a", b"d/c"])
+        self.assertEqual((0, 0, 0), self.status())
+
+    def test_hashCache(self):
+        prmpt.gitdir._hashCache.clear()
+        self.writeIndex()
+        # Written after the files, so they are not racily clean
+        indexTime = time.time() + 10
+        os.utime(os.path.join(self.gitDir, "index"), (indexTime, indexTime))
+        # Touched since it was added, so the stat data is out of date
+        os.utime(os.path.join(self.workTree, "a"), (1, 1))
+        with mock.patch('prmpt.gitdir._hashFile', wraps=prmpt.gitdir._hashFile) as hashFile:
+            self.assertEqual((0, 0, 0), self.status())
+            self.assertEqual(1, hashFile.call_count)
+            # The hash is remembered until the file changes
+            self.assertEqual((0, 0, 0), self.status())
+            self.assertEqual(1, hashFile.call_count)
+            self.writeFile(b"a", b"APPLE\n")
+            os.utime(os.path.join(self.workTree, "a"), (2, 2))
+            self.assertEqual((0, 1, 0), self.status())
+            self.assertEqual(2, hashFile.call_count)
+
+    def test_hashLimit(self):
+        self.writeIndex()
+        for path in ("a", "d/b", "d/c"):
+            os.utime(os.path.join(self.workTree, path), (1, 1))
+        prmpt.gitdir._hashCache.clear()
+        with mock.patch('prmpt.gitdir.MAX_HASHED_FILES', 2):
+            # git status is quicker
+            with self.assertRaises(prmpt.gitdir.GitDirError):
+                self.status()
+        prmpt.gitdir._hashCache.clear()
+        with mock.patch('prmpt.gitdir.MAX_HASHED_BYTES', 10):
+            with self.assertRaises(prmpt.gitdir.GitDirError):
+                self.status()
+
+    def test_staged(self):
+        self.writeFile(b"a", b"apple pie\n")
+        self.writeFile(b"e", b"elderberry\n")
+        self.index[0] = self.entry(b"a", b"apple pie\n")
+        self.index.append(self.entry(b"e", b"elderberry\n"))
+        self.writeIndex()
+        self.assertEqual((2, 0, 0), self.status())
+
+    def test_rename(self):
+        os.rename(os.path.join(self.workTree, "a"), os.path.join(self.workTree, "z"))
+        self.index[0] = self.entry(b"z", self.files[b"a"])
+        self.writeIndex()
+        self.assertEqual((1, 0, 0), self.status())
+
+    def test_possibleRename(self):
+        os.rename(os.path.join(self.workTree, "a"), os.path.join(self.workTree, "z"))
+        self.writeFile(b"z", b"apple tart\n")
+        self.index[0] = self.entry(b"z", b"apple tart\n")
+        self.writeIndex()
+        with self.assertRaises(prmpt.gitdir.GitDirError):
+            self.status()
+
+    def test_unmerged(self):
+        self.index[0] = self.entry(b"a", stage=2)
+        self.index.append(self.entry(b"a", stage=3))
+        self.writeIndex()
+        self.assertEqual((0, 0, 1), self.status())
+
+    def test_cacheTree(self):
+        # A valid root entry that matches HEAD means nothing is staged,
+        # without reading any trees
+        cacheTree = b"\0" + b"3 0\n" + binascii.unhexlify(self.tree)
+        self.writeIndex(extensions=b"TREE" + struct.pack(">I", len(cacheTree)) + cacheTree)
+        shutil.rmtree(os.path.join(self.gitDir, "objects", self.tree[:2]))
+        self.assertEqual((0, 0, 0), self.status())
+
+    def test_unsupported(self):
+        self.writeIndex(extensions=b"link" + struct.pack(">I", 20) + b"\0"*20)
+        with self.assertRaises(prmpt.gitdir.GitDirError):
+            self.status()
+
+        self.writeIndex()
+        self.writeFile(b".gitattributes", b"* text=auto\n")
+        self.index.append(self.entry(b".gitattributes", b"* text=auto\n"))
+        self.writeIndex()
+        with self.assertRaises(prmpt.gitdir.GitDirError):
+            self.status()
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_noSubprocess(self, mock_sp):
+        self.writeFile(b"a", b"APPLE\n")
+        self.writeIndex()
+        g = prmpt.git.Git(prmpt.status.Status(0, self.workTree))
+        self.assertEqual(1, g.changed)
+        self.assertEqual(0, g.staged)
+        self.assertFalse(mock_sp.Popen.called)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_fallback(self, mock_sp):
+        self.writeIndex(extensions=b"link" + struct.pack(">I", 20) + b"\0"*20)
+        mock_sp.Popen.side_effect = [MockProc((
+            b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0" +
+            b"1 .M N... 100644 100644 100644 " + b"a"*40 + b" " + b"a"*40 + b" a\0",
+            b"", 0, None
+        ))]
+        g = prmpt.git.Git(prmpt.status.Status(0, self.workTree))
+        self.assertEqual(1, g.changed)
+        self.assertEqual(1, mock_sp.Popen.call_count)
+        # Read only
+        self.assertEqual("0", mock_sp.Popen.call_args[1]["env"]["GIT_OPTIONAL_LOCKS"])
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_cache(self, mock_sp):
+        cacheDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDir)
+        cache = prmpt.cache.VCSCache(cacheDir)
+        output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0? x\0? y\0", b"", 0, None)
+        mock_sp.Popen.side_effect = [MockProc(output), MockProc(output)]
+        self.writeIndex()
+
+        status = prmpt.status.Status(0, self.workTree)
+        status.vcsCache = cache
+        self.assertEqual(2, prmpt.git.Git(status).untracked)
+        self.assertEqual(1, mock_sp.Popen.call_count)
+
+        # A later prompt reuses the result
+        g = prmpt.git.Git(status)
+        self.assertEqual(2, g.untracked)
+        self.assertEqual(0, g.changed)
+        self.assertEqual(1, mock_sp.Popen.call_count)
+
+        # Until the repository changes
+        self.index.append(self.entry(b"a", stage=2))
+        self.writeIndex()
+        os.utime(os.path.join(self.gitDir, "index"), (0, 0))
+        self.assertEqual(2, prmpt.git.Git(status).untracked)
+        self.assertEqual(2, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_cacheEditedFile(self, mock_sp):
+        cacheDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDir)
+        output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0", b"", 0, None)
+        mock_sp.Popen.side_effect = [MockProc(output)]
+        self.writeIndex()
+        status = prmpt.status.Status(0, self.workTree)
+        status.vcsCache = prmpt.cache.VCSCache(cacheDir)
+        g = prmpt.git.Git(status)
+        self.assertEqual((0, 0), (g.untracked, g.changed))
+
+        # Editing a file below the top of the work tree changes nothing
+        # in the fingerprint
+        fingerprint = prmpt.git.Git(status).fingerprint()
+        self.writeFile(b"d/b", b"blueberry\n")
+        self.assertEqual(fingerprint, prmpt.git.Git(status).fingerprint())
+        g = prmpt.git.Git(status)
+        self.assertEqual((0, 1), (g.untracked, g.changed))
+        self.assertEqual(1, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_staleWhileLocked(self, mock_sp):
+        cacheDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDir)
+        output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0? x\0", b"", 0, None)
+        mock_sp.Popen.side_effect = [MockProc(output)]
+        self.writeIndex()
+        status = prmpt.status.Status(0, self.workTree)
+        status.vcsCache = prmpt.cache.VCSCache(cacheDir)
+        g = prmpt.git.Git(status)
+        self.assertEqual((1, 0), (g.untracked, g.changed))
+
+        # Another git command is part way through changing the index
+        self.index.append(self.entry(b"a", stage=2))
+        self.writeIndex()
+        os.utime(os.path.join(self.gitDir, "index"), (0, 0))
+        with open(os.path.join(self.gitDir, "index.lock"), "w"):
+            pass
+        g = prmpt.git.Git(status)
+        # The index itself is still read as it is
+        self.assertEqual((1, 1), (g.untracked, g.unmerged))
+        self.assertEqual(1, mock_sp.Popen.call_count)
+
+    def test_staleAfterTimeout(self):
+        cacheDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDir)
+        output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0? x\0", b"", 0, None)
+        self.writeIndex()
+        status = prmpt.status.Status(0, self.workTree)
+        status.vcsCache = prmpt.cache.VCSCache(cacheDir)
+        with mock.patch('prmpt.vcs.subprocess') as mock_sp:
+            mock_sp.Popen.side_effect = [MockProc(output)]
+            g = prmpt.git.Git(status)
+            self.assertEqual((1, 0), (g.untracked, g.changed))
+
+        # The next git status hangs
+        hang = os.path.join(cacheDir, "hang")
+        with open(hang, "w") as f:
+            f.write("#!/bin/sh\nexec sleep 5\n")
+        os.chmod(hang, 0o755)
+        status.config.commandTimeout = 0.2
+        self.index.append(self.entry(b"a", stage=2))
+        self.writeIndex()
+        os.utime(os.path.join(self.gitDir, "index"), (0, 0))
+        start = time.time()
+        g = prmpt.git.Git(status, hang)
+        self.assertEqual((1, 1), (g.untracked, g.unmerged))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual("master", g.branch)
+        self.assertEqual("stale (git status timed out)", status.timer.info["vcs"])
+        self.assertEqual(1, len(status.timeouts))
+
+        # With nothing stored, the attributes that need git status time
+        # out, and the rest are still read from the git directory
+        status.vcsCache = None
+        g = prmpt.git.Git(status, hang)
+        self.assertRaises(prmpt.functionBase.Timeout, getattr, g, "untracked")
+        self.assertRaises(prmpt.functionBase.Timeout, getattr, g, "ahead")
+        self.assertEqual(1, g.unmerged)
+        self.assertEqual("master", g.branch)
+        self.assertEqual(2, len(status.timeouts))
+
+    def largeStatus(self, **config):
+        cacheDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cacheDir)
+        status = prmpt.status.Status(0, self.workTree)
+        status.repoStats = prmpt.cache.RepoStats(cacheDir)
+        for name, value in config.items():
+            setattr(status.config, name, value)
+        return status
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_largeByFiles(self, mock_sp):
+        self.writeIndex()
+        status = self.largeStatus(largeRepoFiles=3)
+        output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0" +
+                  b"1 M. N... 100644 100644 100644 " + b"a"*40 + b" " + b"b"*40 + b" a\0",
+                  b"", 0, None)
+        mock_sp.Popen.side_effect = [MockProc(output), mock.Mock()]
+
+        g = prmpt.git.Git(status)
+        self.assertEqual(1, g.staged)
+        self.assertEqual(0, g.untracked)
+        self.assertTrue(g.large)
+
+        # Tracked files are read without looking for untracked ones,
+        # which are counted in the background
+        statusCall, backgroundCall = mock_sp.Popen.call_args_list
+        self.assertIn("--untracked-files=no", statusCall[0][0])
+        background = backgroundCall[0][0]
+        self.assertEqual(["status", "--porcelain=v2", "-z"], background[-3:])
+
+        # Once that has finished, its count is used
+        outputFile = background[3]
+        with open(outputFile, "wb") as f:
+            f.write(b"? x\0? y\0? z\0")
+        mock_sp.Popen.side_effect = [MockProc(output)]
+        self.assertEqual(3, prmpt.git.Git(status).untracked)
+        self.assertFalse(os.path.exists(outputFile))
+        self.assertEqual(3, mock_sp.Popen.call_count)
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_largeByTime(self, mock_sp):
+        self.writeIndex()
+        status = self.largeStatus(largeRepoTime=1.0)
+        status.repoStats.set(self.workTree, {"statusTime": 0.5})
+        self.assertFalse(prmpt.git.Git(status)._isLarge())
+        status.repoStats.set(self.workTree, {"statusTime": 1.5})
+        self.assertTrue(prmpt.git.Git(status)._isLarge())
+
+    @mock.patch('prmpt.vcs.subprocess')
+    def test_statusTime(self, mock_sp):
+        self.writeIndex()
+        output = (b"# branch.oid " + b"a"*40 + b"\0# branch.head master\0", b"", 0, None)
+        mock_sp.Popen.side_effect = [MockProc(output)]
+        status = self.largeStatus()
+        g = prmpt.git.Git(status)
+        g.changed, g.untracked
+        self.assertIn("statusTime", status.repoStats.get(self.workTree))
+        self.assertFalse(g.large)
+
+    def test_applyDelta(self):
+        base = b"The quick brown fox"
+        # Sizes, copy 10 bytes from offset 4, then insert 4 bytes
+        delta = bytearray([19, 14, 0x91, 4, 10, 4]) + b" cat"
+        self.assertEqual(b"quick brow cat", prmpt.gitdir.applyDelta(base, bytes(delta)))